@@ -0,0 +1,105 @@
+"""帳務查詢短效快取（/margin、/positions、/unliquidations）。
+
+每個開著的部位頁 / 儀表板都會各自呼叫 api.daccount.*，同一秒內對券商帳務
+服務送出多個完全相同的查詢。這裡以 (查詢種類, 帳號, 幣別) 為 key：
+
+- ACCOUNT_CACHE_TTL 秒內重複的查詢直接回快取結果。
+- 同一 key 同時間只有一個請求真的送往券商，其餘並行請求等待同一個結果
+  （single-flight）；失敗不快取，例外會傳給所有等待者。
+- 成交事件（on_match 發佈的 fill，閘道模式下經事件轉發）會立即清空快取，
+  成交後的下一次查詢一定是最新數字。進行中的查詢若遇到失效，結果只回給
+  已在等待的請求，不寫入快取。
+"""
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from metrics import ACCOUNT_QUERY_SECONDS, timed
+
+logger = logging.getLogger(__name__)
+
+ACCOUNT_CACHE_TTL = float(os.getenv("ACCOUNT_CACHE_TTL", "1.5"))
+
+
+class _Flight:
+    def __init__(self, generation: int):
+        self.generation = generation
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+_lock = threading.Lock()
+_values: Dict[Hashable, tuple] = {}        # key → (expires_at, generation, value)
+_flights: Dict[Hashable, _Flight] = {}
+_generation = 0
+
+
+def cached_account_query(key: Hashable, fetch: Callable[[], Any]) -> Any:
+    """回傳 key 的快取結果；未命中時由第一個請求執行 fetch，其餘並行請求等待同一結果。
+
+    key 為 tuple 時第一個元素作為 account_query_seconds 的 query 標記。
+    """
+    query = key[0] if isinstance(key, tuple) else str(key)
+    if ACCOUNT_CACHE_TTL <= 0:
+        with timed(ACCOUNT_QUERY_SECONDS, query=query):
+            return fetch()
+
+    with _lock:
+        cached = _values.get(key)
+        if cached is not None and cached[0] > time.monotonic() and cached[1] == _generation:
+            return cached[2]
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _Flight(_generation)
+            _flights[key] = flight
+
+    if not leader:
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    try:
+        with timed(ACCOUNT_QUERY_SECONDS, query=query):
+            flight.result = fetch()
+    except BaseException as exc:
+        flight.error = exc
+        raise
+    else:
+        with _lock:
+            if flight.generation == _generation:
+                _values[key] = (time.monotonic() + ACCOUNT_CACHE_TTL, flight.generation, flight.result)
+        return flight.result
+    finally:
+        with _lock:
+            if _flights.get(key) is flight:
+                del _flights[key]
+        flight.done.set()
+
+
+def invalidate_account_cache(reason: str = "") -> None:
+    """清空所有帳務快取；進行中的查詢結果不會寫回。"""
+    global _generation
+    with _lock:
+        _generation += 1
+        _values.clear()
+        # 之後的請求另起新查詢，不再等待失效前就送出的那一個
+        _flights.clear()
+    if reason:
+        logger.debug("Account cache invalidated: %s", reason)
+
+
+def _on_event(event: dict) -> None:
+    if event.get("type") in ("fill", "reset"):
+        invalidate_account_cache(event["type"])
+
+
+def register_account_cache_invalidation() -> None:
+    """訂閱事件匯流排：成交（或事件續傳中斷）時清空帳務快取。"""
+    from event_stream import get_event_bus
+
+    get_event_bus().add_listener(_on_event)
@@ -0,0 +1,277 @@
+"""券商閘道（Broker Gateway）：單一程序持有 Unitrade session。
+
+`uvicorn --workers 4` 時每個 worker 都會各自登入、各自掛 on_reply/on_match、
+各自啟動同步排程，造成重複登入與重複的成交記錄。閘道模式下：
+
+- 閘道程序（`python broker_gateway.py`）獨佔登入、callbacks 與 APScheduler 排程，
+  並在 Unix socket 上提供下單 / 帳務查詢 / 歷史同步服務。
+- HTTP worker 設定 UNITRADE_GATEWAY_SOCKET 後，get_unitrade_client() 回傳
+  GatewayClient 代理物件，介面與 Unitrade SDK 相同（dtrade.order、daccount.* 等），
+  呼叫透過 socket 轉送給閘道。
+
+通訊協定：每行一個 JSON（newline-delimited），
+  請求 {"method": "...", "args": [...]}
+  回應 {"ok": true, "result": ...} 或 {"ok": false, "error": "...", "error_type": "..."}
+SDK 回傳的物件以 {"__obj__": {...}} 編碼，客戶端還原為 SimpleNamespace，
+讓既有的 getattr(...) 存取方式不必修改。
+"events.subscribe" 例外：該連線之後持續推送事件（每行一筆），供 worker 轉發 SSE。
+
+重試：只在請求寫出前（連線失敗、閒置連線已被閘道關閉）重連一次。請求寫出後的
+逾時或斷線一律不重送；dtrade.order 此時拋出 UnitradeOutcomeUnknown，委託標記為
+unknown，由歷史同步以帳號 / 商品 / 買賣 / 口數認領回報。
+"""
+import json
+import logging
+import os
+import select
+import socket
+import socketserver
+import threading
+from types import SimpleNamespace
+from typing import Any, Optional
+
+from callback_writer import stop_callback_writer
+from unitrade_client import UnitradeLoginError, UnitradeOrderError, UnitradeOutcomeUnknown
+
+logger = logging.getLogger(__name__)
+
+GATEWAY_TIMEOUT = float(os.getenv("UNITRADE_GATEWAY_TIMEOUT", "15"))
+
+# 會下單的方法：請求一旦可能送達閘道就不可重送，否則逾時 / 斷線會造成重複委託
+_ORDER_METHODS = {"dtrade.order"}
+
+
+class GatewayError(RuntimeError):
+    pass
+
+
+# ==================== 編碼 ====================
+
+def _to_wire(obj: Any) -> Any:
+    if obj is None or isinstance(obj, (str, int, float, bool)):
+        return obj
+    if isinstance(obj, (list, tuple)):
+        return [_to_wire(v) for v in obj]
+    if isinstance(obj, dict):
+        return {str(k): _to_wire(v) for k, v in obj.items()}
+    if hasattr(obj, "__dict__"):
+        return {"__obj__": {k: _to_wire(v) for k, v in vars(obj).items() if not k.startswith("_")}}
+    return str(obj)
+
+
+def _from_wire(value: Any) -> Any:
+    if isinstance(value, list):
+        return [_from_wire(v) for v in value]
+    if isinstance(value, dict):
+        if len(value) == 1 and "__obj__" in value:
+            return SimpleNamespace(**{k: _from_wire(v) for k, v in value["__obj__"].items()})
+        return {k: _from_wire(v) for k, v in value.items()}
+    return value
+
+
+_ERROR_TYPES = {
+    "UnitradeLoginError": UnitradeLoginError,
+    "UnitradeOrderError": UnitradeOrderError,
+}
+
+
+# ==================== 客戶端（HTTP worker 端） ====================
+
+class _RemoteNamespace:
+    """將 api.dtrade.xxx(...) / api.daccount.xxx(...) 轉為 "dtrade.xxx" 遠端呼叫。"""
+
+    def __init__(self, client: "GatewayClient", prefix: str):
+        self._client = client
+        self._prefix = prefix
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        method = f"{self._prefix}.{name}"
+        return lambda *args: self._client.call(method, *args)
+
+
+class GatewayClient:
+    """Unitrade SDK 的 socket 代理。每個執行緒維持一條持久連線。"""
+
+    def __init__(self, socket_path: str, timeout: float = GATEWAY_TIMEOUT):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+        self.dtrade = _RemoteNamespace(self, "dtrade")
+        self.daccount = _RemoteNamespace(self, "daccount")
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and _is_stale(conn[0]):
+            # 閘道重啟後的舊連線：在寫入任何位元組前就換新連線
+            self._reset()
+            conn = None
+        if conn is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            conn = (sock, sock.makefile("rb"))
+            self._local.conn = conn
+        return conn
+
+    def _reset(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        self._local.conn = None
+        if conn is not None:
+            try:
+                conn[1].close()
+                conn[0].close()
+            except OSError:
+                pass
+
+    def call(self, method: str, *args) -> Any:
+        payload = (json.dumps({"method": method, "args": _to_wire(list(args))}, ensure_ascii=False) + "\n").encode()
+        # 只有尚未寫出任何位元組的連線失敗可以重試（閘道重啟中：重連一次再放棄）
+        for attempt in (1, 2):
+            try:
+                sock, reader = self._connection()
+                break
+            except OSError as exc:
+                self._reset()
+                if attempt == 2:
+                    raise UnitradeLoginError(f"券商閘道無法連線 ({self.socket_path}): {exc}") from exc
+
+        try:
+            sock.sendall(payload)
+            line = reader.readline()
+            if not line:
+                raise ConnectionError("gateway closed connection")
+        except (OSError, ConnectionError) as exc:
+            # 請求可能已送達閘道（逾時、送出後斷線）：不重送
+            self._reset()
+            if method in _ORDER_METHODS:
+                raise UnitradeOutcomeUnknown(
+                    f"券商閘道在送出委託後中斷，結果未知，待歷史同步對帳 ({self.socket_path}): {exc}"
+                ) from exc
+            raise UnitradeLoginError(f"券商閘道連線中斷 ({self.socket_path}): {exc}") from exc
+
+        response = json.loads(line)
+        if response.get("ok"):
+            return _from_wire(response.get("result"))
+        error_cls = _ERROR_TYPES.get(response.get("error_type"), GatewayError)
+        raise error_cls(response.get("error") or "gateway error")
+
+    def get_accounts(self):
+        return self.call("get_accounts")
+
+    def ping(self) -> dict:
+        return self.call("ping")
+
+    def history_sync(self, incremental: bool = False) -> dict:
+        return self.call("history_sync", incremental)
+
+
+def _is_stale(sock: socket.socket) -> bool:
+    """閒置的持久連線在送出請求前就可讀，表示閘道已關閉連線（EOF）或殘留前次逾時的回應。"""
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (OSError, ValueError):
+        return True
+    return bool(readable)
+
+
+# ==================== 伺服端（閘道程序） ====================
+
+def _dispatch(method: str, args: list) -> Any:
+    from unitrade_client import get_unitrade_client, trigger_history_sync
+
+    if method == "ping":
+        return {"status": "ok", "pid": os.getpid()}
+    if method == "history_sync":
+        return trigger_history_sync(incremental=bool(args and args[0]))
+    if method == "events.publish":
+        from event_stream import publish
+        publish(args[0], args[1])
+        return None
+
+    api = get_unitrade_client()
+    if method == "get_accounts":
+        return api.get_accounts()
+    if method == "dtrade.order":
+        from unitrade.trade.ddata import DOrderObject
+        fields = args[0]["__obj__"] if isinstance(args[0], dict) and "__obj__" in args[0] else args[0]
+        return api.dtrade.order(DOrderObject(**fields))
+    if method in ("daccount.get_margin", "daccount.get_position", "daccount.get_unliquidation"):
+        return getattr(api.daccount, method.split(".", 1)[1])(*args)
+    raise GatewayError(f"unsupported gateway method: {method}")
+
+
+class _GatewayHandler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                if request.get("method") == "events.subscribe":
+                    self._stream_events(request.get("args") or [None])
+                    return
+                result = _dispatch(request.get("method", ""), request.get("args") or [])
+                response = {"ok": True, "result": _to_wire(result)}
+            except Exception as exc:
+                logger.error("Gateway call failed: %s", exc)
+                response = {"ok": False, "error": str(exc), "error_type": type(exc).__name__}
+            self._write(response)
+
+    def _write(self, message: dict) -> None:
+        self.wfile.write((json.dumps(message, ensure_ascii=False, default=str) + "\n").encode())
+        self.wfile.flush()
+
+    def _stream_events(self, args: list) -> None:
+        """事件訂閱連線：此後整條連線只用於推送事件（見 event_stream）。"""
+        from event_stream import serve_gateway_subscription
+
+        try:
+            serve_gateway_subscription(self._write, args[0] if args else None)
+        except OSError:
+            pass
+
+
+class _GatewayServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def run_gateway(socket_path: Optional[str] = None) -> None:
+    """啟動閘道：登入 Unitrade、啟動同步排程，並在 Unix socket 上提供服務。"""
+    from apscheduler.schedulers.background import BackgroundScheduler
+
+    import unitrade_client
+
+    socket_path = socket_path or os.getenv("UNITRADE_GATEWAY_SOCKET", "/tmp/unitrade-gateway.sock")
+    unitrade_client.enable_gateway_server_mode()
+
+    # 先登入（含 callbacks 與啟動時歷史同步），失敗則直接結束讓容器重啟
+    unitrade_client.get_unitrade_client()
+
+    scheduler = BackgroundScheduler(timezone="Asia/Taipei")
+    unitrade_client.register_history_sync_jobs(scheduler)
+    scheduler.start()
+    logger.info("Gateway scheduler started")
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = _GatewayServer(socket_path, _GatewayHandler)
+    os.chmod(socket_path, 0o660)
+    logger.info("Broker gateway listening on %s (pid=%s)", socket_path, os.getpid())
+    try:
+        server.serve_forever()
+    finally:
+        scheduler.shutdown(wait=False)
+        server.server_close()
+        stop_callback_writer()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    run_gateway()
@@ -0,0 +1,228 @@
+"""券商回報的批次寫入（write-behind）：單一 writer 執行緒 group commit。
+
+on_reply / on_match 原本在 SDK 的 callback 執行緒上各自開 session、查詢、commit，
+一串部分成交就是數十個小 transaction，DB 慢的時候直接卡住 SDK 的事件接收。
+改為 callback 只把回報放進有界佇列（不碰 DB），由專用 writer 執行緒處理：
+
+- 取到第一筆後最多再等 CALLBACK_BATCH_WINDOW_MS 毫秒（或湊滿 CALLBACK_BATCH_MAX 筆），
+  整批在同一個 session 依到達順序套用，每筆之後 flush（後一筆看得到前一筆的結果，
+  例如 on_reply 寫入的 ordno 讓同批的 on_match 找得到委託），最後只 commit 一次。
+- 單一 writer、FIFO 順序：同一委託的回報順序與券商送達順序相同，
+  狀態不回降等既有規則（_apply_reply / _apply_match）不變。
+- 事件（SSE / 部位帳）在 commit 成功後才發佈。
+- 整批失敗（例如與歷史同步競爭寫入同一筆成交被唯一索引擋下）時回滾，改為逐筆
+  各自一個 transaction 重試，只有出錯的那一筆被略過。
+- 佇列滿或回報無法寫入時不阻塞 callback 執行緒：記錄錯誤、計入
+  callback_events_dropped_total，並排程一次增量歷史同步，由券商的 query_reply /
+  query_match 補回。
+
+佇列深度、每批筆數、commit 耗時與回報延遲（收到 → commit）見 /metrics。
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Any, Callable, List, Optional, Tuple
+
+from sqlalchemy.exc import IntegrityError
+
+from metrics import (
+    CALLBACK_BATCH_SIZE,
+    CALLBACK_COMMIT_SECONDS,
+    CALLBACK_EVENT_LAG_SECONDS,
+    CALLBACK_EVENTS_DROPPED,
+    CALLBACK_QUEUE_DEPTH,
+)
+
+logger = logging.getLogger(__name__)
+
+CALLBACK_QUEUE_SIZE = int(os.getenv("CALLBACK_QUEUE_SIZE", "10000"))
+CALLBACK_BATCH_MAX = int(os.getenv("CALLBACK_BATCH_MAX", "200"))
+CALLBACK_BATCH_WINDOW_MS = float(os.getenv("CALLBACK_BATCH_WINDOW_MS", "5"))
+
+# apply(db, payload, received_at) → 要在 commit 後發佈的 [(kind, data), ...]
+ApplyFn = Callable[[Any, Any, float], Optional[List[Tuple[str, dict]]]]
+
+_STOP = object()
+
+
+class CallbackWriter:
+    def __init__(
+        self,
+        max_size: int = CALLBACK_QUEUE_SIZE,
+        batch_max: int = CALLBACK_BATCH_MAX,
+        window_ms: float = CALLBACK_BATCH_WINDOW_MS,
+    ):
+        self.batch_max = batch_max
+        self.window = window_ms / 1000
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_size)
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._recovery_pending = threading.Event()
+        self.batches = 0
+        self.events = 0
+        self.dropped = 0
+
+    # ── callback 執行緒端 ─────────────────────────────────────────
+    def submit(self, apply: ApplyFn, payload: Any) -> bool:
+        """放入佇列後立即返回；佇列滿時回 False（已排程補同步）。"""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((apply, payload, time.time()))
+            return True
+        except queue.Full:
+            self._drop(f"queue full ({self._queue.maxsize})", apply)
+            return False
+
+    def _ensure_started(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="callback-writer", daemon=True)
+                self._thread.start()
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def drain(self, timeout: float) -> bool:
+        """等佇列中與寫入中的回報都處理完（signal_replay 結算用）；逾時回 False。"""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.depth(),
+            "queue_size": self._queue.maxsize,
+            "batches": self.batches,
+            "events": self.events,
+            "dropped": self.dropped,
+        }
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """寫完佇列中的回報後結束 writer（lifespan / 閘道關閉時呼叫）。"""
+        thread = self._thread
+        if thread is None or not thread.is_alive():
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            logger.warning("Callback writer queue still full at shutdown; %d events not written", self.depth())
+            return
+        thread.join(timeout)
+
+    # ── writer 執行緒 ─────────────────────────────────────────────
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                self._queue.task_done()
+                return
+            batch = [item]
+            stop = False
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.batch_max:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            try:
+                self._write(batch)
+            except Exception as exc:  # writer 不可中斷
+                logger.exception("Callback writer error: %s", exc)
+            for _ in range(len(batch) + stop):
+                self._queue.task_done()
+            if stop:
+                return
+
+    def _write(self, batch: list) -> None:
+        started = time.monotonic()
+        try:
+            events = self._apply(batch)
+        except Exception as exc:
+            logger.warning("Callback batch of %d failed (%s), retrying one by one", len(batch), exc)
+            events = []
+            for item in batch:
+                try:
+                    events.extend(self._apply([item]))
+                except IntegrityError:
+                    # 同一筆成交已由並行的歷史同步寫入（唯一索引擋下），累加一併回滾
+                    logger.info("Callback %s: duplicate rejected by unique index", item[0].__name__)
+                except Exception as item_exc:
+                    self._drop(f"apply failed: {item_exc}", item[0])
+        committed = time.time()
+        CALLBACK_COMMIT_SECONDS.observe(time.monotonic() - started)
+        CALLBACK_BATCH_SIZE.observe(len(batch))
+        for _, _, received_at in batch:
+            CALLBACK_EVENT_LAG_SECONDS.observe(max(0.0, committed - received_at))
+        self.batches += 1
+        self.events += len(batch)
+
+        from event_stream import publish
+
+        for kind, data in events:
+            publish(kind, data)
+
+    @staticmethod
+    def _apply(batch: list) -> List[Tuple[str, dict]]:
+        from database import SessionLocal
+
+        db = SessionLocal()
+        events: List[Tuple[str, dict]] = []
+        try:
+            for apply, payload, received_at in batch:
+                events.extend(apply(db, payload, received_at) or ())
+                db.flush()
+            db.commit()
+            return events
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    # ── 補救 ──────────────────────────────────────────────────────
+    def _drop(self, reason: str, apply: ApplyFn) -> None:
+        self.dropped += 1
+        CALLBACK_EVENTS_DROPPED.inc(kind=getattr(apply, "__name__", ""))
+        logger.error("Broker callback not written (%s); scheduling history sync to recover", reason)
+        if self._recovery_pending.is_set():
+            return
+        self._recovery_pending.set()
+        threading.Thread(target=self._recover, name="callback-recovery", daemon=True).start()
+
+    def _recover(self) -> None:
+        from unitrade_client import trigger_history_sync
+
+        time.sleep(1.0)  # 讓 writer 先消化佇列
+        try:
+            result = trigger_history_sync(incremental=True)
+            logger.info("Callback recovery history sync: %s", result)
+        finally:
+            self._recovery_pending.clear()
+
+
+_writer = CallbackWriter()
+CALLBACK_QUEUE_DEPTH.set_function(_writer.depth)
+
+
+def get_callback_writer() -> CallbackWriter:
+    return _writer
+
+
+def submit_callback(apply: ApplyFn, payload: Any) -> bool:
+    return _writer.submit(apply, payload)
+
+
+def stop_callback_writer() -> None:
+    _writer.stop()
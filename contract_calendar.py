@@ -0,0 +1,244 @@
+"""台灣期交所（TAIFEX）月契約行事曆：自動換月用的近月 / 次月合約代碼。
+
+每筆 auto_rollover 訊號原本都從 date.today()（伺服器時區）重新推算第三個週三，
+忽略了休市日與夜盤。這裡一次預先算好前後數年所有月契約的最後交易日，並建立
+「交易日 → (近月, 次月)」查詢表，訊號熱路徑只做一次 dict 查詢：
+
+- 時間一律以台北時間（UTC+8，無日光節約）計算，與伺服器時區無關。
+- 最後交易日為交割月份第三個週三；遇休市日順延至次一營業日。
+  休市日由 TAIFEX_HOLIDAYS_FILE（每行一個 YYYY-MM-DD，# 之後為註解）載入。
+- 交易時段：一般盤 08:45–13:45，夜盤 15:00–翌日 05:00；夜盤屬於次一營業日。
+  到期契約只交易到最後交易日一般盤 13:30，該日之前的夜盤已不含到期契約，
+  因此最後交易日前一營業日 15:00 起的夜盤即以次月為近月，最後交易日一般盤
+  仍為到期契約，13:30 之後改為次月。
+- 查詢表在台北日期變更時重建一次（同時重新讀取休市日檔案）。
+
+月份代碼：A=1月 … L=12月，年份取西元末碼（例：MXF + 2026 年 6 月 → MXFF6）。
+所有月契約期貨（TXF、MXF、個股期貨…）共用同一份行事曆，代碼只差在基底。
+券商回傳的 PRODUCTID 可能補空白或以 YYYYMM 表示月份（TXF202606），
+比對前以 normalize_product() 統一成下單用的代碼。
+"""
+import logging
+import os
+import re
+import threading
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+TAIPEI = timezone(timedelta(hours=8), "Asia/Taipei")
+
+TAIFEX_HOLIDAYS_FILE = os.getenv(
+    "TAIFEX_HOLIDAYS_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "taifex_holidays.txt"),
+)
+CONTRACT_CALENDAR_YEARS = int(os.getenv("CONTRACT_CALENDAR_YEARS", "3"))
+
+DAY_SESSION_OPEN = time(8, 45)
+DAY_SESSION_CLOSE = time(13, 45)
+EXPIRY_CLOSE = time(13, 30)       # 到期契約最後交易日收盤
+NIGHT_SESSION_OPEN = time(15, 0)
+NIGHT_SESSION_CLOSE = time(5, 0)
+
+Month = Tuple[int, int]  # (year, month)
+
+
+def month_code(base_code: str, month: Month) -> str:
+    year, mon = month
+    return f"{base_code}{chr(ord('A') + mon - 1)}{year % 10}"
+
+
+_YYYYMM_CODE = re.compile(r"^([A-Z0-9]+?)(20\d{2})(0[1-9]|1[0-2])$")
+
+
+def normalize_product(product: str) -> str:
+    """商品代碼正規化：去除空白、轉大寫，YYYYMM 月份改為月份代碼（TXF202606 → TXFF6）。"""
+    code = re.sub(r"\s+", "", product or "").upper()
+    match = _YYYYMM_CODE.match(code)
+    if match:
+        return month_code(match.group(1), (int(match.group(2)), int(match.group(3))))
+    return code
+
+
+def _next_month(month: Month) -> Month:
+    year, mon = month
+    return (year + 1, 1) if mon == 12 else (year, mon + 1)
+
+
+def load_holidays(path: str = TAIFEX_HOLIDAYS_FILE) -> Set[date]:
+    """讀取休市日檔案；檔案不存在時回傳空集合（只排除週末）。"""
+    holidays: Set[date] = set()
+    try:
+        with open(path, encoding="utf-8") as f:
+            for lineno, line in enumerate(f, 1):
+                text = line.split("#", 1)[0].strip()
+                if not text:
+                    continue
+                try:
+                    holidays.add(date.fromisoformat(text))
+                except ValueError:
+                    logger.warning("Ignoring invalid holiday %r at %s:%d", text, path, lineno)
+    except FileNotFoundError:
+        logger.warning("TAIFEX holiday file not found: %s — only weekends are treated as closed", path)
+    return holidays
+
+
+class ContractCalendar:
+    """某一天建立的唯讀行事曆（最後交易日 + 每個交易日的近月 / 次月）。"""
+
+    def __init__(self, built_on: date, holidays: Set[date], years: int = CONTRACT_CALENDAR_YEARS):
+        self.built_on = built_on
+        self.holidays = holidays
+        first = (built_on.year - 1, 1)
+        last = (built_on.year + years, 12)
+
+        # 每個契約月份的最後交易日
+        self.expiries: Dict[Month, date] = {}
+        month = first
+        while month <= last:
+            self.expiries[month] = self._last_trading_day(*month)
+            month = _next_month(month)
+
+        # 交易日 → 近月（最後交易日 >= 該交易日的最早契約）
+        self._front: Dict[date, Month] = {}
+        months = sorted(self.expiries)
+        i = 0
+        day = self.expiries[months[0]] - timedelta(days=40)
+        end = self.expiries[months[-2]]
+        while day <= end:
+            while self.expiries[months[i]] < day:
+                i += 1
+            self._front[day] = months[i]
+            day += timedelta(days=1)
+
+    def is_business_day(self, day: date) -> bool:
+        return day.weekday() < 5 and day not in self.holidays
+
+    def next_business_day(self, day: date) -> date:
+        day += timedelta(days=1)
+        while not self.is_business_day(day):
+            day += timedelta(days=1)
+        return day
+
+    def previous_business_day(self, day: date) -> date:
+        day -= timedelta(days=1)
+        while not self.is_business_day(day):
+            day -= timedelta(days=1)
+        return day
+
+    def _last_trading_day(self, year: int, month: int) -> date:
+        first = date(year, month, 1)
+        third_wednesday = first + timedelta(days=(2 - first.weekday()) % 7, weeks=2)
+        if self.is_business_day(third_wednesday):
+            return third_wednesday
+        return self.next_business_day(third_wednesday)
+
+    def trading_session(self, at: datetime) -> Tuple[date, str]:
+        """台北時間 at 所屬（或即將開始）的交易時段：(交易日, "day" | "night")。
+
+        夜盤屬於次一營業日；收盤後的空檔歸入下一個時段。
+        """
+        local = at.astimezone(TAIPEI)
+        day, t = local.date(), local.time()
+        if t < NIGHT_SESSION_CLOSE:
+            return self.next_business_day(day - timedelta(days=1)), "night"
+        if t >= DAY_SESSION_CLOSE:
+            return self.next_business_day(day), "night"
+        if self.is_business_day(day):
+            return day, "day"
+        return self.next_business_day(day), "day"
+
+    def front_month(self, at: datetime) -> Month:
+        trading_day, session = self.trading_session(at)
+        month = self._front[trading_day]
+        if trading_day == self.expiries[month]:
+            # 最後交易日只有一般盤 13:30 前交易到期契約
+            if session == "night" or at.astimezone(TAIPEI).time() >= EXPIRY_CLOSE:
+                month = _next_month(month)
+        return month
+
+    def roll_times(self, month: Month) -> Tuple[datetime, datetime]:
+        """(夜盤改以次月為近月的時間, 到期契約最後收盤時間)。"""
+        expiry = self.expiries[month]
+        night = datetime.combine(self.previous_business_day(expiry), NIGHT_SESSION_OPEN, TAIPEI)
+        close = datetime.combine(expiry, EXPIRY_CLOSE, TAIPEI)
+        return night, close
+
+
+_lock = threading.Lock()
+_calendar: Optional[ContractCalendar] = None
+_clock: Optional[Callable[[], datetime]] = None
+
+
+def now_taipei() -> datetime:
+    if _clock is not None:
+        return _clock().astimezone(TAIPEI)
+    return datetime.now(TAIPEI)
+
+
+def set_clock(clock: Optional[Callable[[], datetime]]) -> None:
+    """以指定時鐘取代系統時間（訊號重播依原始訊號時間換月；None 還原）。"""
+    global _clock
+    _clock = clock
+
+
+def get_contract_calendar(at: Optional[datetime] = None) -> ContractCalendar:
+    """取得行事曆；台北日期變更後第一次呼叫時重建（並重新讀取休市日）。"""
+    global _calendar
+    today = (at or now_taipei()).astimezone(TAIPEI).date()
+    calendar = _calendar
+    if calendar is not None and calendar.built_on == today:
+        return calendar
+    with _lock:
+        if _calendar is None or _calendar.built_on != today:
+            holidays = load_holidays()
+            _calendar = ContractCalendar(today, holidays)
+            if not any(h.year == today.year for h in holidays):
+                logger.warning("No TAIFEX holidays listed for %d in %s", today.year, TAIFEX_HOLIDAYS_FILE)
+            logger.info(
+                "Contract calendar built for %s: %d holidays, %d contract months",
+                today, len(holidays), len(_calendar.expiries),
+            )
+        return _calendar
+
+
+def reload_contract_calendar() -> ContractCalendar:
+    """強制重建（休市日檔案更新後呼叫）。"""
+    global _calendar
+    with _lock:
+        _calendar = None
+    return get_contract_calendar()
+
+
+def front_month_contract(base_code: str, at: Optional[datetime] = None) -> str:
+    """近月合約代碼（例：front_month_contract('MXF') -> 'MXFF6'）。"""
+    at = at or now_taipei()
+    return month_code(base_code, get_contract_calendar(at).front_month(at))
+
+
+def next_month_contract(base_code: str, at: Optional[datetime] = None) -> str:
+    at = at or now_taipei()
+    return month_code(base_code, _next_month(get_contract_calendar(at).front_month(at)))
+
+
+def upcoming_rolls(base_code: str, count: int = 6, at: Optional[datetime] = None) -> List[dict]:
+    """從目前近月起的 count 個契約月份及其換月時間。"""
+    at = at or now_taipei()
+    calendar = get_contract_calendar(at)
+    month = calendar.front_month(at)
+    rolls = []
+    for _ in range(count):
+        if month not in calendar.expiries:
+            break
+        night, close = calendar.roll_times(month)
+        rolls.append({
+            "contract": month_code(base_code, month),
+            "contract_month": f"{month[0]}-{month[1]:02d}",
+            "last_trading_day": calendar.expiries[month].isoformat(),
+            "night_session_roll_at": night.isoformat(),
+            "expires_at": close.isoformat(),
+            "rolls_to": month_code(base_code, _next_month(month)),
+        })
+        month = _next_month(month)
+    return rolls
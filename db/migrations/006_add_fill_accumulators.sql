@@ -0,0 +1,66 @@
+-- Migration: Incremental fill aggregation for on_match
+-- Version: 006
+-- Description: on_match 不再每筆成交重撈所有 trade_records 計算均價，
+--              改為在 order_history 上累加成交口數 / 成交金額（O(1)）。
+--              trade_records 以 (network_id, match_seq, match_time) 建唯一索引，
+--              確保重播的成交回報不會重複累加。
+
+-- trade_records 原本僅由應用程式 create_all 建立，這裡補上以便新資料庫依序執行 migration
+CREATE TABLE IF NOT EXISTS trade_records (
+    id SERIAL PRIMARY KEY,
+    seq VARCHAR,
+    network_id VARCHAR,
+    orderno VARCHAR,
+    account VARCHAR,
+    sub_account VARCHAR,
+    product_kind VARCHAR,
+    product_id VARCHAR,
+    bs VARCHAR,
+    match_price FLOAT,
+    match_qty INTEGER,
+    match_seq VARCHAR,
+    match_time VARCHAR,
+    note VARCHAR,
+    mdate VARCHAR,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS ix_trade_records_id ON trade_records (id);
+CREATE INDEX IF NOT EXISTS ix_trade_records_seq ON trade_records (seq);
+CREATE INDEX IF NOT EXISTS ix_trade_records_network_id ON trade_records (network_id);
+CREATE INDEX IF NOT EXISTS ix_trade_records_orderno ON trade_records (orderno);
+CREATE INDEX IF NOT EXISTS ix_trade_records_product_id ON trade_records (product_id);
+CREATE INDEX IF NOT EXISTS ix_trade_records_created_at ON trade_records (created_at);
+
+ALTER TABLE order_history
+    ADD COLUMN IF NOT EXISTS matched_qty INTEGER DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS matched_notional FLOAT DEFAULT 0;
+
+-- 清除多 worker 重複處理同一筆成交所留下的重複列（保留最早一筆）
+DELETE FROM trade_records t
+USING trade_records d
+WHERE t.network_id IS NOT NULL
+  AND t.network_id = d.network_id
+  AND COALESCE(t.match_seq, '') = COALESCE(d.match_seq, '')
+  AND COALESCE(t.match_time, '') = COALESCE(d.match_time, '')
+  AND t.id > d.id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS ux_trade_records_fill_key
+    ON trade_records (network_id, COALESCE(match_seq, ''), COALESCE(match_time, ''))
+    WHERE network_id IS NOT NULL;
+
+-- 以既有成交記錄（已去重）回填累加器，並修正先前被重複成交灌大的成交量 / 均價
+UPDATE order_history o
+SET matched_qty = a.qty,
+    matched_notional = a.notional,
+    fill_quantity = a.qty,
+    fill_price = CASE WHEN a.qty > 0 THEN ROUND((a.notional / a.qty)::numeric, 2) ELSE o.fill_price END
+FROM (
+    SELECT seq,
+           SUM(COALESCE(match_qty, 0)) AS qty,
+           SUM(COALESCE(match_price, 0) * COALESCE(match_qty, 0)) AS notional
+    FROM trade_records
+    WHERE seq IS NOT NULL
+    GROUP BY seq
+) a
+WHERE o.order_id = a.seq;
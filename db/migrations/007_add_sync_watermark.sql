@@ -0,0 +1,12 @@
+-- Migration: Per-account high-water mark for paginated history sync
+-- Version: 007
+-- Description: _sync_history 以 network_id 為游標翻頁查詢 query_reply / query_match，
+--              並記錄「仍在途中委託的最小 network_id」作為下次增量同步的起點。
+
+CREATE TABLE IF NOT EXISTS sync_watermark (
+    account VARCHAR(50) PRIMARY KEY,
+    resume_network_id VARCHAR,   -- 下次增量同步的起始 network_id（含）
+    last_network_id VARCHAR,     -- 上次同步看到的最大 network_id
+    trade_date VARCHAR(8),       -- 券商交易日（tradedate），換日後改為完整同步
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
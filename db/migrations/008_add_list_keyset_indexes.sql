@@ -0,0 +1,27 @@
+-- Migration: Composite indexes for keyset pagination and filters on list endpoints
+-- Version: 008
+-- Description: /orders、/signals、/trades、/order-replies 改用 (排序欄位, id) keyset 分頁，
+--              並支援依狀態 / 策略 / 商品 / 來源篩選。每個篩選欄位搭配排序欄位建立複合索引，
+--              讓「篩選 + 排序 + LIMIT」直接走索引，不需排序整張表。
+
+-- order_history：/orders（created_at 排序）
+CREATE INDEX IF NOT EXISTS ix_order_history_created_id ON order_history (created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS ix_order_history_status_created_id ON order_history (status, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS ix_order_history_strategy_created_id ON order_history (strategy, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS ix_order_history_symbol_created_id ON order_history (symbol, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS ix_order_history_source_created_id ON order_history (source, created_at DESC, id DESC);
+
+-- order_history：/order-replies（僅 fill_status 不為空，updated_at 排序）
+CREATE INDEX IF NOT EXISTS ix_order_history_replies_updated_id
+    ON order_history (updated_at DESC, id DESC)
+    WHERE fill_status IS NOT NULL;
+
+-- signal_history：/signals
+CREATE INDEX IF NOT EXISTS ix_signal_history_created_id ON signal_history (created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS ix_signal_history_strategy_created_id ON signal_history (strategy_name, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS ix_signal_history_status_created_id ON signal_history (status, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS ix_signal_history_product_created_id ON signal_history (actual_product, created_at DESC, id DESC);
+
+-- trade_records：/trades
+CREATE INDEX IF NOT EXISTS ix_trade_records_created_id ON trade_records (created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS ix_trade_records_product_created_id ON trade_records (product_id, created_at DESC, id DESC);
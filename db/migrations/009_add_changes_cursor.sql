@@ -0,0 +1,14 @@
+-- Migration: updated_at cursors for dashboard delta polling
+-- Version: 009
+-- Description: /orders/changes、/signals/changes 以 (updated_at, id) 游標回傳變更。
+--              order_history.updated_at 改為新增時即填入；signal_history 新增 updated_at。
+
+UPDATE order_history SET updated_at = created_at WHERE updated_at IS NULL;
+ALTER TABLE order_history ALTER COLUMN updated_at SET DEFAULT CURRENT_TIMESTAMP;
+CREATE INDEX IF NOT EXISTS ix_order_history_updated_id ON order_history (updated_at, id);
+
+ALTER TABLE signal_history ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;
+UPDATE signal_history SET updated_at = created_at WHERE updated_at IS NULL OR updated_at > created_at;
+CREATE INDEX IF NOT EXISTS ix_signal_history_updated_id ON signal_history (updated_at, id);
+
+-- trade_records 只新增不更新，/trades/changes 直接使用 008 的 (created_at, id) 索引
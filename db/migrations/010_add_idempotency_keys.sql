@@ -0,0 +1,15 @@
+-- Migration: Idempotency keys for webhook retries
+-- Version: 010
+-- Description: TradingView 逾時重送時以冪等鍵去重（見 idempotency.py）。
+--              唯一索引是跨 worker / 重啟後的最後防線：重複的 INSERT 會被擋下，
+--              改以原記錄回覆，不再送出第二筆委託。未帶鍵的請求（NULL）不受影響。
+
+ALTER TABLE signal_history ADD COLUMN IF NOT EXISTS idempotency_key VARCHAR(64);
+CREATE UNIQUE INDEX IF NOT EXISTS ux_signal_history_idempotency_key
+    ON signal_history (idempotency_key)
+    WHERE idempotency_key IS NOT NULL;
+
+ALTER TABLE order_history ADD COLUMN IF NOT EXISTS idempotency_key VARCHAR(64);
+CREATE UNIQUE INDEX IF NOT EXISTS ux_order_history_idempotency_key
+    ON order_history (idempotency_key)
+    WHERE idempotency_key IS NOT NULL;
@@ -0,0 +1,8 @@
+-- Migration: Per-order stage timings
+-- Version: 011
+-- Description: 訊號 → 委託 → 券商回報各階段的累計耗時（ms），供收盤後分析長尾延遲。
+--              格式：{"received_at": epoch, "received": 0, "validated": ..., "broker_end": ..., "reply": ..., "first_match": ...}
+--              例：SELECT percentile_cont(0.99) WITHIN GROUP (ORDER BY (stage_timings->>'broker_end')::float)
+--                  FROM order_history WHERE created_at >= CURRENT_DATE;
+
+ALTER TABLE order_history ADD COLUMN IF NOT EXISTS stage_timings JSONB;
@@ -0,0 +1,27 @@
+-- Migration: Indexes for broker callback / history sync lookups
+-- Version: 012
+-- Description: on_match 與歷史同步以 ordno 找委託（order_history.ordno 原本沒有索引，
+--              每筆成交都是整表掃描）；on_reply / 同步以 order_id 找委託並取最新一筆。
+--              部位帳對帳依 (account, symbol, strategy) 加總 matched_qty。
+--              查詢計畫由 explain_check.py 在大量測試資料上檢查，不可退回 Seq Scan。
+--              order_history 是持續寫入的大表：CONCURRENTLY 建立 / 移除索引不阻擋寫入
+--              （不可包在 transaction 內；migrate.sh 以 psql -f 逐句執行）。
+--              建立中斷時會留下 INVALID 索引，需先 DROP INDEX CONCURRENTLY 再重跑。
+
+-- on_match / _apply_matches：ordno = ? / ordno IN (...) ORDER BY created_at
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_order_history_ordno_created
+    ON order_history (ordno, created_at)
+    WHERE ordno IS NOT NULL;
+
+-- on_reply / _apply_replies：order_id = ? ORDER BY created_at DESC LIMIT 1
+-- 取代 001 的單欄 ix_order_history_order_id（複合索引的前綴即可涵蓋）
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_order_history_order_id_created
+    ON order_history (order_id, created_at);
+
+-- position_ledger._strategy_positions：只含有成交的策略委託，index-only scan 即可加總
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_order_history_strategy_positions
+    ON order_history (strategy, account, symbol) INCLUDE (action, matched_qty)
+    WHERE strategy IS NOT NULL AND matched_qty > 0;
+
+-- 新索引全部建立完成後才移除舊的單欄索引
+DROP INDEX CONCURRENTLY IF EXISTS ix_order_history_order_id;
@@ -0,0 +1,14 @@
+-- Migration: /order-replies keyset on created_at
+-- Version: 013
+-- Description: /order-replies 原本以 updated_at 分頁，但回報會持續更新 updated_at，翻頁期間
+--              被更新的委託會重複或漏掉；改以不變的 (created_at, id) 分頁。
+--              order_history 是持續寫入的大表：CONCURRENTLY 建立 / 移除索引不阻擋寫入
+--              （不可包在 transaction 內；migrate.sh 以 psql -f 逐句執行）。
+--              建立中斷時會留下 INVALID 索引，需先 DROP INDEX CONCURRENTLY 再重跑。
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_order_history_replies_created_id
+    ON order_history (created_at DESC, id DESC)
+    WHERE fill_status IS NOT NULL;
+
+-- 新索引建立完成後才移除 008 的 updated_at 索引
+DROP INDEX CONCURRENTLY IF EXISTS ix_order_history_replies_updated_id;
@@ -0,0 +1,37 @@
+-- Migration: Database-assigned change timestamps for /…/changes cursors
+-- Version: 014
+-- Description: updated_at（trade_records 為 created_at）原本在 Python 端產生、稍後才 commit；
+--              commit 比 CHANGES_SETTLE_MS 慢的交易會拿到游標已經越過的時間戳而永遠不被送出。
+--              改由 trigger 以 clock_timestamp()（UTC，與既有 naive UTC 欄位一致）在寫入列時填入，
+--              /…/changes 另以 pg_stat_activity 中最早仍在進行的寫入交易開始時間作為游標上限：
+--              未 commit 的列時間戳必晚於其交易開始時間，游標因此不會越過尚未可見的變更。
+
+CREATE OR REPLACE FUNCTION set_updated_at_clock() RETURNS trigger AS $$
+BEGIN
+    NEW.updated_at := clock_timestamp() AT TIME ZONE 'UTC';
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION set_created_at_clock() RETURNS trigger AS $$
+BEGIN
+    NEW.created_at := clock_timestamp() AT TIME ZONE 'UTC';
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_order_history_updated_at ON order_history;
+CREATE TRIGGER trg_order_history_updated_at
+    BEFORE INSERT OR UPDATE ON order_history
+    FOR EACH ROW EXECUTE FUNCTION set_updated_at_clock();
+
+DROP TRIGGER IF EXISTS trg_signal_history_updated_at ON signal_history;
+CREATE TRIGGER trg_signal_history_updated_at
+    BEFORE INSERT OR UPDATE ON signal_history
+    FOR EACH ROW EXECUTE FUNCTION set_updated_at_clock();
+
+-- trade_records 只新增不更新：/trades/changes 以 created_at 為游標
+DROP TRIGGER IF EXISTS trg_trade_records_created_at ON trade_records;
+CREATE TRIGGER trg_trade_records_created_at
+    BEFORE INSERT ON trade_records
+    FOR EACH ROW EXECUTE FUNCTION set_created_at_clock();
@@ -0,0 +1,10 @@
+-- Migration: Index for working strategy orders
+-- Version: 015
+-- Description: 多個 worker 時 max_position 以 DB 為準（position_ledger.lock_shared_positions）：
+--              每筆策略訊號都在 advisory lock 下加總該策略未終結委託的剩餘口數。
+--              未終結的委託只占 order_history 極小部分，以 partial index 涵蓋，index-only scan 即可加總。
+--              與 012 相同以 CONCURRENTLY 建立，不阻擋寫入（不可包在 transaction 內）。
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_order_history_working_strategy
+    ON order_history (strategy, account, symbol) INCLUDE (action, quantity, matched_qty)
+    WHERE strategy IS NOT NULL AND status IN ('pending', 'submitted', 'partial_filled', 'unknown');
@@ -0,0 +1,345 @@
+"""即時事件匯流排：委託狀態 / 成交 / 訊號事件推播（SSE）。
+
+on_reply、on_match、下單管線與 process_signal 在 commit 後呼叫 publish()，
+事件帶遞增的 event id 廣播給所有 /events/stream 連線，前端不必再每 3 秒輪詢 /orders。
+
+- 每個連線有自己的有界佇列（EVENT_CLIENT_BUFFER）。消費太慢而佇列滿時不阻塞
+  發佈端（callback 執行緒），而是標記 overflow 並中斷該連線；客戶端以
+  Last-Event-ID 重連即可從歷史緩衝補回漏掉的事件。
+- 最近 EVENT_HISTORY_SIZE 筆事件保留在記憶體供續傳；要求的 id 已超出緩衝範圍
+  （或程序重啟使 id 歸零）時送出 reset 事件，提示客戶端重新載入完整清單。
+- 閘道模式下 callbacks 在閘道程序觸發：閘道持有唯一的匯流排，HTTP worker
+  透過 socket 訂閱並原樣轉發（保留閘道的 event id），process_signal 的事件也送回
+  閘道發佈，event id 全域一致。閘道重啟使 id 歸零時，worker 對齊新編號並送出 reset。
+- 內嵌模式且 WEB_CONCURRENCY > 1 時，每個 worker 的匯流排只有自己處理的事件；
+  stream_complete() 為 False，SSE 的 hello 事件告知前端串流不完整，須繼續增量輪詢。
+"""
+import asyncio
+import json
+import logging
+import os
+import queue
+import threading
+from abc import ABC, abstractmethod
+from collections import deque
+from datetime import datetime
+from typing import Any, Callable, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+EVENT_HISTORY_SIZE = int(os.getenv("EVENT_HISTORY_SIZE", "2000"))
+EVENT_CLIENT_BUFFER = int(os.getenv("EVENT_CLIENT_BUFFER", "256"))
+EVENT_MAX_CLIENTS = int(os.getenv("EVENT_MAX_CLIENTS", "100"))
+EVENT_KEEPALIVE = float(os.getenv("EVENT_KEEPALIVE", "15"))
+
+EVENT_TYPES = ("order", "fill", "signal")
+
+# 與 database.py 相同：uvicorn worker 數
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+
+
+class StreamOverflow(RuntimeError):
+    pass
+
+
+class TooManySubscribers(RuntimeError):
+    pass
+
+
+# ==================== 訂閱者 ====================
+
+class _Subscriber(ABC):
+    def __init__(self, kinds: Optional[Iterable[str]] = None):
+        self.kinds = set(kinds) if kinds else None
+        self.overflowed = False
+
+    def wants(self, event: dict) -> bool:
+        return self.kinds is None or event["type"] in self.kinds or event["type"] == "reset"
+
+    @abstractmethod
+    def notify(self, event: dict) -> None:
+        """由發佈端（任意執行緒）呼叫，不可阻塞。"""
+
+
+class AsyncSubscriber(_Subscriber):
+    """SSE 連線：事件以 call_soon_threadsafe 交給 event loop，放入有界 asyncio.Queue。"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, kinds=None, maxsize: int = EVENT_CLIENT_BUFFER):
+        super().__init__(kinds)
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+
+    def notify(self, event: dict) -> None:
+        try:
+            self.loop.call_soon_threadsafe(self._offer, event)
+        except RuntimeError:
+            # event loop 已關閉
+            self.overflowed = True
+
+    def _offer(self, event: dict) -> None:
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    async def get(self, timeout: float) -> Optional[dict]:
+        """取下一筆事件；timeout 內無事件回 None，已 overflow 且佇列清空時拋 StreamOverflow。"""
+        if self.overflowed and self.queue.empty():
+            raise StreamOverflow()
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class ThreadSubscriber(_Subscriber):
+    """執行緒端訂閱（閘道轉發給 HTTP worker 使用）。"""
+
+    def __init__(self, kinds=None, maxsize: int = EVENT_CLIENT_BUFFER):
+        super().__init__(kinds)
+        self.queue: "queue.Queue[dict]" = queue.Queue(maxsize=maxsize)
+
+    def notify(self, event: dict) -> None:
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout: float) -> Optional[dict]:
+        if self.overflowed and self.queue.empty():
+            raise StreamOverflow()
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+# ==================== 匯流排 ====================
+
+class EventBus:
+    def __init__(self, history_size: int = EVENT_HISTORY_SIZE):
+        self._lock = threading.Lock()
+        self._history: deque = deque(maxlen=history_size)
+        self._subscribers: List[_Subscriber] = []
+        self._listeners: List[Callable[[dict], None]] = []
+        self._last_id = 0
+
+    @property
+    def last_id(self) -> int:
+        return self._last_id
+
+    def publish(self, kind: str, data: Any) -> dict:
+        with self._lock:
+            self._last_id += 1
+            event = {"id": self._last_id, "type": kind, "ts": datetime.utcnow().isoformat(), "data": data}
+            self._append(event)
+            return event
+
+    def publish_event(self, event: dict) -> None:
+        """轉發已編號的事件（閘道 → worker），保留原 event id。"""
+        with self._lock:
+            if event["id"] <= self._last_id:
+                return
+            self._last_id = event["id"]
+            self._append(event)
+
+    def rebase(self, last_id: int) -> dict:
+        """上游（閘道）編號重新開始：清空歷史、改用上游的 last_id，並廣播 reset。
+
+        reset 帶新編號的 id，客戶端之後以 Last-Event-ID 續傳時即對應新的編號；
+        仍帶舊編號重連的客戶端，subscribe 也會因 id 超出範圍而收到 reset。
+        """
+        with self._lock:
+            self._history.clear()
+            self._last_id = last_id
+            event = {
+                "id": last_id, "type": "reset", "ts": datetime.utcnow().isoformat(),
+                "data": {"last_event_id": last_id},
+            }
+            self._append(event)
+            return event
+
+    def _append(self, event: dict) -> None:
+        # 呼叫端須持有 _lock；notify 只做 put_nowait / call_soon_threadsafe，不會阻塞
+        self._history.append(event)
+        if any(sub.overflowed for sub in self._subscribers):
+            # overflow 的連線已不再接收事件，先移出名單（消費端會自行結束）
+            self._subscribers = [sub for sub in self._subscribers if not sub.overflowed]
+        for sub in self._subscribers:
+            if sub.wants(event):
+                sub.notify(event)
+        for listener in self._listeners:
+            try:
+                listener(event)
+            except Exception as exc:
+                logger.warning("Event listener failed: %s", exc)
+
+    def add_listener(self, listener: Callable[[dict], None]) -> None:
+        """註冊程序內監聽者（同步呼叫、須立即返回，例如清除快取）。"""
+        with self._lock:
+            if listener not in self._listeners:
+                self._listeners.append(listener)
+
+    def subscribe(
+        self, subscriber: _Subscriber, last_event_id: Optional[int] = None,
+    ) -> Tuple[List[dict], bool, int]:
+        """註冊訂閱者並回傳 (需補送的事件, 是否需要 reset, 補送起點 id)。
+
+        三者與註冊在同一把鎖內取得：之後的事件一定經由 notify 送達，不會漏也不會重複。
+        """
+        with self._lock:
+            if len(self._subscribers) >= EVENT_MAX_CLIENTS:
+                raise TooManySubscribers(f"事件串流連線數已達上限（{EVENT_MAX_CLIENTS}）")
+            self._subscribers.append(subscriber)
+            if last_event_id is None:
+                return [], False, self._last_id
+            oldest = self._history[0]["id"] if self._history else self._last_id + 1
+            if last_event_id > self._last_id or last_event_id < oldest - 1:
+                return [], True, self._last_id
+            backlog = [e for e in self._history if e["id"] > last_event_id and subscriber.wants(e)]
+            return backlog, False, last_event_id
+
+    def unsubscribe(self, subscriber: _Subscriber) -> None:
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "last_event_id": self._last_id,
+                "history": len(self._history),
+                "subscribers": len(self._subscribers),
+                "overflowed": sum(1 for s in self._subscribers if s.overflowed),
+            }
+
+
+_bus = EventBus()
+
+
+def get_event_bus() -> EventBus:
+    return _bus
+
+
+def stream_complete() -> bool:
+    """本 worker 的 SSE 是否涵蓋所有事件（閘道轉發或單一 worker）。"""
+    return _relay is not None or WEB_CONCURRENCY == 1
+
+
+# ==================== 發佈 ====================
+
+_relay: Optional["_GatewayRelay"] = None
+
+
+def publish(kind: str, data: Any) -> None:
+    """發佈事件（呼叫端須在 DB commit 之後呼叫）。任何錯誤只記錄，不影響下單流程。"""
+    try:
+        if _relay is not None:
+            _relay.forward(kind, data)
+        else:
+            _bus.publish(kind, data)
+    except Exception as exc:
+        logger.warning("Event publish failed: type=%s %s", kind, exc)
+
+
+# ==================== 閘道轉發（gateway-client 模式） ====================
+
+class _GatewayRelay:
+    """HTTP worker 端：訂閱閘道的事件並在本地匯流排重播；本地事件送回閘道發佈。"""
+
+    def __init__(self, socket_path: str):
+        self.socket_path = socket_path
+        self._outbox: "queue.Queue[Tuple[str, Any]]" = queue.Queue(maxsize=EVENT_CLIENT_BUFFER)
+        self._stop = threading.Event()
+
+    def start(self) -> None:
+        threading.Thread(target=self._listen, name="event-relay-in", daemon=True).start()
+        threading.Thread(target=self._send, name="event-relay-out", daemon=True).start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def forward(self, kind: str, data: Any) -> None:
+        try:
+            self._outbox.put_nowait((kind, data))
+        except queue.Full:
+            logger.warning("Event relay outbox full, dropping %s event", kind)
+
+    def _send(self) -> None:
+        from unitrade_client import get_unitrade_client
+
+        while not self._stop.is_set():
+            try:
+                kind, data = self._outbox.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                get_unitrade_client().call("events.publish", kind, data)
+            except Exception as exc:
+                logger.warning("Event relay publish failed: %s", exc)
+
+    def _listen(self) -> None:
+        import socket
+
+        gateway_last: Optional[int] = None
+        while not self._stop.is_set():
+            try:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(self.socket_path)
+                request = {"method": "events.subscribe", "args": [gateway_last]}
+                sock.sendall((json.dumps(request) + "\n").encode())
+                with sock, sock.makefile("rb") as reader:
+                    for line in reader:
+                        message = json.loads(line)
+                        if "keepalive" in message:
+                            continue
+                        if "hello" in message:
+                            # 閘道無法續傳（重啟 / 落後太多）或首次連線編號不同：
+                            # 改用閘道的編號並送 reset，之後的事件 id 與閘道完全一致
+                            if message.get("reset") or message["last_id"] != _bus.last_id:
+                                _bus.rebase(message["last_id"])
+                            gateway_last = message["last_id"]
+                            continue
+                        gateway_last = message["id"]
+                        _bus.publish_event(message)
+            except Exception as exc:
+                logger.warning("Event relay disconnected from gateway: %s", exc)
+            self._stop.wait(1)
+
+
+def start_event_relay(socket_path: str) -> None:
+    global _relay
+    if _relay is None:
+        _relay = _GatewayRelay(socket_path)
+        _relay.start()
+        logger.info("Event relay subscribed to gateway %s", socket_path)
+
+
+def stop_event_relay() -> None:
+    global _relay
+    if _relay is not None:
+        _relay.stop()
+        _relay = None
+
+
+def serve_gateway_subscription(write: Callable[[dict], None], last_event_id: Optional[int]) -> None:
+    """閘道端：持續把事件寫給一個 worker 連線，直到連線中斷或 worker 消費過慢。"""
+    subscriber = ThreadSubscriber()
+    backlog, reset, last_id = _bus.subscribe(subscriber, last_event_id)
+    try:
+        # hello 帶補送起點的 event id，讓 worker 對齊本地編號
+        write({"hello": True, "reset": reset, "last_id": last_id})
+        for event in backlog:
+            write(event)
+        while True:
+            event = subscriber.get(EVENT_KEEPALIVE)
+            # 無事件時送 keepalive，worker 斷線時才能及早發現並釋放訂閱
+            write(event if event is not None else {"keepalive": True})
+    except StreamOverflow:
+        logger.warning("Gateway event subscriber overflowed, closing")
+    finally:
+        _bus.unsubscribe(subscriber)
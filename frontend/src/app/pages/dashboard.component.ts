@@ -3,7 +3,7 @@ import { CommonModule } from '@angular/common';
 import { RouterLink } from '@angular/router';
 import { Subscription, timer, of, forkJoin } from 'rxjs';
 import { switchMap, catchError } from 'rxjs/operators';
-import { ApiService, Margin, OrderHistory, SignalHistory } from '../services/api.service';
+import { ApiService, Margin, OrderHistory, SignalHistory, StreamEvent, mergeChanges } from '../services/api.service';
 
 const HEALTH_POLL_MS = 30_000;
 
@@ -37,6 +37,9 @@ export class DashboardComponent implements OnInit, OnDestroy {
     return false;
   }
   private orderPoll?: Subscription;
+  private orderCursor?: string;
+  private eventStream?: Subscription;
+  private streamOpen = false;
   margin: Margin | null = null;
   marginError = false;
   marginErrorMsg = '';
@@ -87,6 +90,9 @@ export class DashboardComponent implements OnInit, OnDestroy {
     // 進入頁面時載入一次保證金
     this.loadMargin();
 
+    // 委託與訊號由 SSE 即時推送；串流中斷或不完整時才退回增量輪詢
+    this.eventStream = this.api.streamEvents(['order', 'signal']).subscribe(e => this.onStreamEvent(e));
+
     // 只在進入頁面時載入一次
     this.api.getStrategies(true).subscribe({
       next: d => (this.strategyCount = d.length),
@@ -105,22 +111,56 @@ export class DashboardComponent implements OnInit, OnDestroy {
         this.todaySignals = 0;
       },
     });
-    this.api.listOrders().subscribe({
+    this.api.orderChanges().pipe(
+      switchMap(page => {
+        this.orderCursor = page?.cursor;
+        return this.api.listOrders();
+      }),
+    ).subscribe({
       next: d => {
-        const all = d || [];
-        this.allOrders = all;
-        this.recentOrders = all.filter(o => o.source !== 'sync').slice(0, 5);
-        this.orderMap = new Map(all.map(o => [o.id, o]));
-        // 最近 3 筆拒單或失敗單（含交易所拒絕 PSC + 送單失敗）
-        this.rejectedOrders = all
-          .filter(o => this._parseFillStatus(o.fill_status).isReject || o.status === 'failed')
-          .slice(0, 3);
+        this.setOrders(d || []);
         this.startOrderPolling();
       },
       error: () => (this.recentOrders = []),
     });
   }
 
+  private setOrders(all: OrderHistory[]): void {
+    this.allOrders = all;
+    this.recentOrders = all.filter(o => o.source !== 'sync').slice(0, 5);
+    this.orderMap = new Map(all.map(o => [o.id, o]));
+    // 最近 3 筆拒單或失敗單（含交易所拒絕 PSC + 送單失敗）
+    this.rejectedOrders = all
+      .filter(o => this._parseFillStatus(o.fill_status).isReject || o.status === 'failed')
+      .slice(0, 3);
+  }
+
+  private onStreamEvent(e: StreamEvent): void {
+    switch (e.type) {
+      case 'open':
+        this.streamOpen = true;
+        break;
+      case 'error':
+        this.streamOpen = false;
+        break;
+      case 'reset':
+        this.api.listOrders().subscribe(d => this.setOrders(d || []));
+        break;
+      case 'order':
+        this.setOrders(mergeChanges(this.allOrders, [e.data as OrderHistory]));
+        break;
+      case 'signal': {
+        const signal = e.data as SignalHistory;
+        const isNew = !this.recentSignals.some(s => s.id === signal.id);
+        if (isNew && new Date(signal.created_at).toDateString() === new Date().toDateString()) {
+          this.todaySignals++;
+        }
+        this.recentSignals = mergeChanges(this.recentSignals, [signal]).slice(0, 5);
+        break;
+      }
+    }
+  }
+
   /** 找訊號對應的委託：order_id 相同且建立時間最近者 */
   private findOrderForSignal(signal: SignalHistory): OrderHistory | undefined {
     if (!signal.order_id) return undefined;
@@ -139,15 +179,13 @@ export class DashboardComponent implements OnInit, OnDestroy {
     this.orderPoll?.unsubscribe();
     if (!this.recentOrders.some(o => this.isOrderPending(o))) return;
     this.orderPoll = timer(3000, 3000).subscribe(() => {
-      this.api.listOrders().subscribe({
-        next: d => {
-          const all = d || [];
-          this.allOrders = all;
-          this.recentOrders = all.filter(o => o.source !== 'sync').slice(0, 5);
-          this.orderMap = new Map(all.map(o => [o.id, o]));
-          this.rejectedOrders = all
-            .filter(o => this._parseFillStatus(o.fill_status).isReject || o.status === 'failed')
-            .slice(0, 3);
+      if (this.streamOpen) return;
+      // 只拉取游標之後變更的委託；無變更時回 204（null）
+      this.api.orderChanges(this.orderCursor).subscribe({
+        next: page => {
+          if (!page) return;
+          this.orderCursor = page.cursor;
+          this.setOrders(mergeChanges(this.allOrders, page.items));
           if (!this.recentOrders.some(o => this.isOrderPending(o))) {
             this.orderPoll?.unsubscribe();
           }
@@ -159,6 +197,7 @@ export class DashboardComponent implements OnInit, OnDestroy {
   ngOnDestroy(): void {
     this.healthPoll?.unsubscribe();
     this.orderPoll?.unsubscribe();
+    this.eventStream?.unsubscribe();
   }
 
   loadMargin(): void {
@@ -2,7 +2,8 @@
 import { CommonModule } from '@angular/common';
 import { FormBuilder, ReactiveFormsModule, Validators } from '@angular/forms';
 import { Subscription, timer } from 'rxjs';
-import { ApiService, OrderHistory } from '../services/api.service';
+import { switchMap } from 'rxjs/operators';
+import { ApiService, OrderHistory, StreamEvent, mergeChanges } from '../services/api.service';
 
 @Component({
   selector: 'app-orders',
@@ -20,6 +21,9 @@ export class OrdersComponent implements OnInit, OnDestroy {
 
   private readonly FINAL_STATUSES = new Set(['filled', 'cancelled', 'failed']);
   private orderPoll?: Subscription;
+  private orderCursor?: string;
+  private eventStream?: Subscription;
+  private streamOpen = false;
 
   // ─── 商品代碼查詢器 ───
   showLookup = false;
@@ -103,6 +107,17 @@ export class OrdersComponent implements OnInit, OnDestroy {
   ngOnInit(): void {
     this.buildProductSuggestions();
     this.loadOrders();
+    // 委託狀態由 SSE 即時推送；串流中斷或不完整時才退回增量輪詢
+    this.eventStream = this.api.streamEvents(['order']).subscribe(e => this.onStreamEvent(e));
+  }
+
+  private onStreamEvent(e: StreamEvent<OrderHistory>): void {
+    switch (e.type) {
+      case 'open':  this.streamOpen = true; break;
+      case 'error': this.streamOpen = false; break;
+      case 'reset': this.loadOrders(); break;
+      case 'order': this.orders = mergeChanges(this.orders, [e.data]); break;
+    }
   }
 
   submit(): void {
@@ -125,7 +140,13 @@ export class OrdersComponent implements OnInit, OnDestroy {
   }
 
   loadOrders(): void {
-    this.api.listOrders().subscribe((data) => {
+    // 先取游標再載入清單：兩者之間的變更會在下次輪詢重複送達，合併時以 id 取代即可
+    this.api.orderChanges().pipe(
+      switchMap(page => {
+        this.orderCursor = page?.cursor;
+        return this.api.listOrders();
+      }),
+    ).subscribe((data) => {
       this.orders = data || [];
       this.startOrderPolling();
     });
@@ -142,9 +163,13 @@ export class OrdersComponent implements OnInit, OnDestroy {
     this.orderPoll?.unsubscribe();
     if (!this.orders.some(o => !this.FINAL_STATUSES.has(o.status))) return;
     this.orderPoll = timer(3000, 3000).subscribe(() => {
-      this.api.listOrders().subscribe({
-        next: data => {
-          this.orders = data || [];
+      if (this.streamOpen) return;
+      // 只拉取游標之後變更的委託；無變更時回 204（null）
+      this.api.orderChanges(this.orderCursor).subscribe({
+        next: page => {
+          if (!page) return;
+          this.orderCursor = page.cursor;
+          this.orders = mergeChanges(this.orders, page.items);
           if (!this.orders.some(o => !this.FINAL_STATUSES.has(o.status))) {
             this.orderPoll?.unsubscribe();
           }
@@ -155,6 +180,7 @@ export class OrdersComponent implements OnInit, OnDestroy {
 
   ngOnDestroy(): void {
     this.orderPoll?.unsubscribe();
+    this.eventStream?.unsubscribe();
   }
 
   // ── 四段式流程揭露 helpers ───────────────────────────────────────
@@ -1,7 +1,9 @@
-﻿import { Component, OnInit } from '@angular/core';
+﻿import { Component, OnDestroy, OnInit } from '@angular/core';
 import { CommonModule } from '@angular/common';
 import { FormsModule } from '@angular/forms';
-import { ApiService, StrategyConfig } from '../services/api.service';
+import { Subject, Subscription, of } from 'rxjs';
+import { catchError, debounceTime, distinctUntilChanged, map, switchMap } from 'rxjs/operators';
+import { ApiService, ProductSearchItem, StrategyConfig } from '../services/api.service';
 
 @Component({
   selector: 'app-strategies',
@@ -10,7 +12,7 @@ import { ApiService, StrategyConfig } from '../services/api.service';
   templateUrl: './strategies.component.html',
   styleUrl: './strategies.component.scss',
 })
-export class StrategiesComponent implements OnInit {
+export class StrategiesComponent implements OnInit, OnDestroy {
   strategies: StrategyConfig[] = [];
   showForm = false;
   isEditing = false;
@@ -19,10 +21,30 @@ export class StrategiesComponent implements OnInit {
 
   currentStrategy: Partial<StrategyConfig> = this.getEmptyStrategy();
 
+  // 實際下單商品自動完成（/product-lookup/search）
+  productSuggestions: ProductSearchItem[] = [];
+  private productQuery = new Subject<string>();
+  private productSearch?: Subscription;
+
   constructor(private api: ApiService) {}
 
   ngOnInit() {
     this.loadStrategies();
+    this.productSearch = this.productQuery.pipe(
+      debounceTime(150),
+      distinctUntilChanged(),
+      switchMap(q => q
+        ? this.api.searchProducts(q).pipe(map(r => r.items), catchError(() => of([])))
+        : of([])),
+    ).subscribe(items => (this.productSuggestions = items));
+  }
+
+  ngOnDestroy() {
+    this.productSearch?.unsubscribe();
+  }
+
+  onTargetProductInput(value: string) {
+    this.productQuery.next((value || '').trim());
   }
 
   loadStrategies() {
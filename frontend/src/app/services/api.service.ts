@@ -84,8 +84,15 @@ export interface SignalHistory {
   error_message?: string;
   raw_payload?: any;
   created_at: string;
+  updated_at?: string;
 }
 
+/** 列表輪詢只取需要的欄位（?fields=），略過 raw_payload；明細頁用 getSignal 取得完整資料 */
+const SIGNAL_LIST_FIELDS = [
+  'strategy_name', 'signal_type', 'signal_product', 'signal_quantity', 'signal_price', 'signal_note',
+  'actual_product', 'actual_quantity', 'actual_bs', 'status', 'order_id', 'error_message', 'created_at', 'updated_at',
+].join(',');
+
 export interface OrderHistory {
   id: number;
   symbol: string;
@@ -132,6 +139,30 @@ export interface TradeRecord {
   created_at: string;
 }
 
+/** /orders/changes 等增量端點的回應；無變更時後端回 204，HttpClient 得到 null */
+export interface ChangesPage<T> {
+  cursor: string;
+  items: T[];
+  has_more: boolean;
+}
+
+/** 將增量資料合併進既有清單：同 id 取代，新資料依 id 由新到舊放在最前面 */
+export function mergeChanges<T extends { id: number }>(list: T[], items: T[]): T[] {
+  if (!items.length) return list;
+  const changed = new Map(items.map(i => [i.id, i]));
+  const merged = list.map(i => changed.get(i.id) ?? i);
+  const known = new Set(list.map(i => i.id));
+  const added = items.filter(i => !known.has(i.id)).sort((a, b) => b.id - a.id);
+  return [...added, ...merged];
+}
+
+/** /events/stream 推送的事件；open / error 為本地連線狀態 */
+export interface StreamEvent<T = any> {
+  id: number;
+  type: 'order' | 'fill' | 'signal' | 'reset' | 'overflow' | 'open' | 'error';
+  data: T;
+}
+
 @Injectable({ providedIn: 'root' })
 export class ApiService {
   constructor(private http: HttpClient) {}
@@ -148,6 +179,46 @@ export class ApiService {
     return this.http.get<OrderHistory[]>('/orders');
   }
 
+  /** 不帶 since 時只取得目前游標 */
+  orderChanges(since?: string) {
+    const params: Record<string, string> = since === undefined ? {} : { since };
+    return this.http.get<ChangesPage<OrderHistory> | null>('/orders/changes', { params });
+  }
+
+  signalChanges(since?: string) {
+    const params: Record<string, string> = since === undefined ? {} : { since, fields: SIGNAL_LIST_FIELDS };
+    return this.http.get<ChangesPage<SignalHistory> | null>('/signals/changes', { params });
+  }
+
+  /** 訂閱 SSE 事件串流；EventSource 斷線時會自動帶 Last-Event-ID 重連並補送事件 */
+  streamEvents(types: Array<'order' | 'fill' | 'signal'> = []): Observable<StreamEvent> {
+    return new Observable<StreamEvent>(subscriber => {
+      const query = types.length ? `?types=${types.join(',')}` : '';
+      const source = new EventSource(`${getApiBaseUrl()}/events/stream${query}`);
+      const kinds = [...(types.length ? types : ['order', 'fill', 'signal']), 'reset', 'overflow'];
+      for (const kind of kinds) {
+        source.addEventListener(kind, (e: MessageEvent) => subscriber.next({
+          id: Number(e.lastEventId),
+          type: kind as StreamEvent['type'],
+          data: e.data ? JSON.parse(e.data) : null,
+        }));
+      }
+      // hello 表示串流已建立；complete 為 false（多 worker 各自發佈）時串流不完整，元件須繼續輪詢
+      source.addEventListener('hello', (e: MessageEvent) => {
+        if (JSON.parse(e.data).complete) {
+          subscriber.next({ id: 0, type: 'open', data: null });
+        }
+      });
+      source.onerror = () => subscriber.next({ id: 0, type: 'error', data: null });
+      return () => source.close();
+    });
+  }
+
+  tradeChanges(since?: string) {
+    const params: Record<string, string> = since === undefined ? {} : { since };
+    return this.http.get<ChangesPage<TradeRecord> | null>('/trades/changes', { params });
+  }
+
   placeOrder(payload: OrderRequest) {
     return this.http.post<Record<string, unknown>>('/order', payload);
   }
@@ -180,7 +251,7 @@ export class ApiService {
 
   // ========== Signal History ==========
   getSignals(limit = 100, offset = 0, strategy?: string) {
-    let params: any = { limit: limit.toString(), offset: offset.toString() };
+    let params: any = { limit: limit.toString(), offset: offset.toString(), fields: SIGNAL_LIST_FIELDS };
     if (strategy) {
       params.strategy = strategy;
     }
@@ -234,6 +305,28 @@ export class ApiService {
   getProductLookupForeign() {
     return this.http.get<any[]>('/product-lookup/foreign');
   }
+
+  /** 商品代號 / 名稱搜尋（後端索引，回傳已分頁的少量結果） */
+  searchProducts(q: string, limit = 10, exchange?: string) {
+    const params: Record<string, string | number> = { q, limit };
+    if (exchange) params['exchange'] = exchange;
+    return this.http.get<ProductSearchResult>('/product-lookup/search', { params });
+  }
+}
+
+export interface ProductSearchItem {
+  exchange?: string;
+  code: string;
+  name?: string;
+  original_margin?: number | string;
+  maintenance_margin?: number | string;
+  currency?: string;
+  source: 'tw' | 'foreign';
+}
+
+export interface ProductSearchResult {
+  total: number;
+  items: ProductSearchItem[];
 }
 
 export interface Margin {
@@ -0,0 +1,95 @@
+"""Webhook 冪等鍵（/signal、/signal/simple、/webhook）。
+
+TradingView 在逾時時會重送 webhook；下單路徑若卡在券商，就會產生重複的
+SignalHistory 與重複的實單。每筆請求帶一個冪等鍵：
+
+- 明確指定：payload 的 idempotency_key 欄位或 Idempotency-Key header。
+- 自動推導（僅訊號）：payload 帶 bar_time（例如 TradingView 的 {{time}}）時，
+  以 strategy / signal / price / bar_time 雜湊。
+
+檢查分兩層：本程序的 TTL 索引（dict 查詢，命中即以原記錄回覆，不碰券商），
+以及 signal_history / order_history 上的唯一索引（跨 worker 或重啟後的重送在
+INSERT 時被擋下，再改回原記錄）。未命中時熱路徑只多一次 dict 查詢。
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENCY_MAX_KEYS = int(os.getenv("IDEMPOTENCY_MAX_KEYS", "100000"))
+
+KEY_MAX_LENGTH = 64
+
+
+class DuplicateRequest(RuntimeError):
+    """INSERT 被冪等鍵唯一索引擋下：同一個鍵已由其他請求寫入（transaction 已回滾）。"""
+
+    def __init__(self, key: str):
+        super().__init__(f"duplicate idempotency key: {key}")
+        self.key = key
+
+
+class IdempotencyIndex:
+    """冪等鍵 → 記錄 id 的 TTL 索引（插入順序即過期順序）。"""
+
+    def __init__(self, ttl: float = IDEMPOTENCY_TTL, max_keys: int = IDEMPOTENCY_MAX_KEYS):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[int]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def remember(self, key: str, record_id: int) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._entries[key] = (now + self.ttl, record_id)
+            self._entries.move_to_end(key)
+            while self._entries:
+                oldest_key, (expires_at, _) = next(iter(self._entries.items()))
+                if expires_at >= now and len(self._entries) <= self.max_keys:
+                    break
+                del self._entries[oldest_key]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+signal_index = IdempotencyIndex()
+order_index = IdempotencyIndex()
+
+
+def normalize_key(key: Optional[str]) -> Optional[str]:
+    """去除空白；超過欄位長度的鍵改存雜湊。"""
+    if key is None:
+        return None
+    key = key.strip()
+    if not key:
+        return None
+    if len(key) > KEY_MAX_LENGTH:
+        return "h:" + hashlib.sha1(key.encode()).hexdigest()
+    return key
+
+
+def signal_idempotency_key(
+    strategy: str,
+    signal: str,
+    price: Optional[float],
+    bar_time: Optional[str],
+    explicit: Optional[str] = None,
+) -> Optional[str]:
+    """明確指定的鍵優先；否則有 bar_time 時以 strategy/signal/price/bar_time 推導，沒有則不去重。"""
+    key = normalize_key(explicit)
+    if key is not None:
+        return key
+    if not bar_time:
+        return None
+    raw = f"{strategy}|{signal}|{price if price is not None else ''}|{bar_time.strip()}"
+    return "d:" + hashlib.sha1(raw.encode()).hexdigest()
@@ -0,0 +1,78 @@
+"""列表端點的精簡讀取路徑：只查需要的欄位，直接以 orjson 編碼成回應。
+
+/orders、/signals、/trades、/order-replies 與 /…/changes 每 3 秒輪詢一次。原本每列都
+建立完整的 ORM 物件、呼叫 to_dict()（逐欄 isoformat）再交給 FastAPI 轉換與編碼；
+這裡改為 SELECT 指定欄位取得 tuple，zip 成 dict 後一次 orjson.dumps，跳過 ORM 與
+jsonable_encoder。輸出格式與 to_dict() 相同（datetime 同為 ISO 8601）。
+
+?fields=id,status,created_at 只回傳指定欄位，可略過 order_result / raw_payload 等大欄位；
+id 與排序欄位（分頁游標需要）一律包含。未指定時回傳與 to_dict() 相同的全部欄位。
+"""
+from typing import Iterable, List, Optional, Sequence
+
+import orjson
+from fastapi import HTTPException, Response
+
+from models import OrderHistory, SignalHistory, TradeRecord
+
+# 與各 model 的 to_dict() 相同的欄位與順序
+LIST_FIELDS = {
+    OrderHistory: (
+        "id", "symbol", "code", "action", "quantity", "price", "strategy", "order_type",
+        "order_condition", "open_close_flag", "dtrade", "note", "account", "sub_account", "source",
+        "status", "order_result", "error_message", "created_at", "order_id", "fill_status",
+        "fill_quantity", "fill_price", "matched_qty", "updated_at",
+    ),
+    SignalHistory: (
+        "id", "strategy_name", "signal_type", "signal_product", "signal_quantity", "signal_price",
+        "signal_note", "actual_product", "actual_quantity", "actual_bs", "status", "order_id",
+        "error_message", "raw_payload", "created_at", "updated_at",
+    ),
+    TradeRecord: (
+        "id", "seq", "network_id", "orderno", "account", "sub_account", "product_kind", "product_id",
+        "bs", "match_price", "match_qty", "match_seq", "match_time", "note", "mdate", "created_at",
+    ),
+}
+
+
+class FastJSONResponse(Response):
+    """以 orjson 編碼的 JSON 回應；content 已是 bytes 時直接輸出。"""
+
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        if isinstance(content, bytes):
+            return content
+        return orjson.dumps(content)
+
+
+def list_fields(model, fields: Optional[str], *required: str) -> List[str]:
+    """解析 ?fields=，回傳依 to_dict() 順序排列的欄位名稱；未知欄位回 400。"""
+    allowed = LIST_FIELDS[model]
+    if not fields:
+        return list(allowed)
+    requested = {f.strip() for f in fields.split(",") if f.strip()}
+    unknown = sorted(requested.difference(allowed))
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"未知的欄位: {', '.join(unknown)}（可用欄位: {', '.join(allowed)}）",
+        )
+    requested.update(("id",) + required)
+    return [f for f in allowed if f in requested]
+
+
+def list_columns(model, names: Sequence[str]) -> list:
+    return [getattr(model, name) for name in names]
+
+
+def rows_to_dicts(names: Sequence[str], rows: Iterable) -> List[dict]:
+    return [dict(zip(names, row)) for row in rows]
+
+
+def rows_response(names: Sequence[str], rows: Iterable, response: Optional[Response] = None) -> FastJSONResponse:
+    """將查詢結果 tuple 編碼為 JSON 陣列；保留 _keyset_page 寫入的分頁標頭。"""
+    headers = None
+    if response is not None and "X-Next-Before-Id" in response.headers:
+        headers = {"X-Next-Before-Id": response.headers["X-Next-Before-Id"]}
+    return FastJSONResponse(orjson.dumps(rows_to_dicts(names, rows)), headers=headers)
@@ -1,28 +1,91 @@
+import asyncio
+import json
 import logging
 import os
+import time
 from contextlib import asynccontextmanager
-from datetime import datetime, date, timedelta
-from typing import Literal, Optional, List
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, Literal, Optional, List, Tuple, Union
 
 import httpx
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.cron import CronTrigger
-from fastapi import Depends, FastAPI, HTTPException
+from fastapi import Depends, FastAPI, Header, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field, model_validator
+from sqlalchemy import DateTime, and_, func, inspect, literal, literal_column, or_, select, text, tuple_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
-from database import get_db
+from database import async_engine, get_async_db, get_db
 from models import OrderHistory, StrategyConfig, SignalHistory, SignalType, TradeRecord
+from contract_calendar import (
+    front_month_contract,
+    get_contract_calendar,
+    next_month_contract,
+    now_taipei,
+    upcoming_rolls,
+)
+from strategy_cache import get_strategy_config_async, get_strategy_configs_async, invalidate_strategy_cache
+from metrics import SIGNALS_TOTAL, OrderTrace, render_metrics
+from callback_writer import get_callback_writer, stop_callback_writer
+from list_query import FastJSONResponse, list_columns, list_fields, rows_response, rows_to_dicts
+from idempotency import (
+    DuplicateRequest,
+    normalize_key,
+    order_index,
+    signal_idempotency_key,
+    signal_index,
+)
+from position_ledger import (
+    POSITION_LIMITS_ENABLED,
+    get_position_ledger,
+    lock_shared_positions,
+    shared_position_limits,
+    start_position_ledger,
+    stop_position_ledger,
+)
+from account_cache import cached_account_query, register_account_cache_invalidation
+from product_lookup import (
+    PRODUCT_LOOKUP_STALE_TTL,
+    PRODUCT_LOOKUP_TTL,
+    MARGIN_SOURCES,
+    close_product_lookup_client,
+    get_margin_table,
+    search_products,
+)
+from event_stream import (
+    EVENT_KEEPALIVE,
+    EVENT_TYPES,
+    AsyncSubscriber,
+    StreamOverflow,
+    TooManySubscribers,
+    get_event_bus,
+    publish as publish_event,
+    start_event_relay,
+    stop_event_relay,
+    stream_complete,
+)
 
-from unitrade.trade.ddata import DOrderObject
-
+from order_pipeline import (
+    ORDER_WAIT_TIMEOUT,
+    OrderPipelineFull,
+    shutdown_order_pipeline,
+    submit_order,
+    schedule_orders_in_phases,
+)
 from unitrade_client import (
     UnitradeLoginError,
-    extract_order_id,
+    UnitradeOrderError,
+    UnitradeOutcomeUnknown,
+    broker_backend,
+    broker_mode,
     get_unitrade_client,
-    serialize_order_result,
+    register_history_sync_jobs,
     trigger_history_sync,
 )
 
@@ -43,6 +106,7 @@ class OrderRequest(BaseModel):
     dtrade: Optional[Literal["Y", "N"]] = "N"
     note: Optional[str] = ""
     strategy: Optional[str] = None
+    idempotency_key: Optional[str] = Field(default=None, description="冪等鍵（亦可用 Idempotency-Key header）")
 
     @model_validator(mode="after")
     def normalize(self):
@@ -58,6 +122,7 @@ class OrderRequest(BaseModel):
 class OrderResponse(BaseModel):
     status: str
     order_id: Optional[str] = None
+    record_id: Optional[int] = None
     result: Optional[dict] = None
 
 
@@ -69,6 +134,8 @@ class SignalRequest(BaseModel):
     price: Optional[float] = Field(default=None, description="訊號價格（選填）")
     product: Optional[str] = Field(default=None, description="訊號商品（選填，若未提供則使用策略設定）")
     note: Optional[str] = Field(default=None, max_length=10, description="備註")
+    bar_time: Optional[str] = Field(default=None, description="K 棒時間（TradingView {{time}}，用於重送去重）")
+    idempotency_key: Optional[str] = Field(default=None, description="冪等鍵（選填，優先於 bar_time 推導）")
 
 
 class SimpleSignalRequest(BaseModel):
@@ -81,6 +148,8 @@ class SimpleSignalRequest(BaseModel):
     stop_loss: Optional[float] = Field(default=None, description="止損價格")
     take_profit: Optional[float] = Field(default=None, description="止盈價格")
     note: Optional[str] = Field(default=None, max_length=10, description="備註")
+    bar_time: Optional[str] = Field(default=None, description="K 棒時間（TradingView {{time}}，用於重送去重）")
+    idempotency_key: Optional[str] = Field(default=None, description="冪等鍵（選填，優先於 bar_time 推導）")
 
 
 class SignalResponse(BaseModel):
@@ -117,13 +186,6 @@ class StrategyConfigRequest(BaseModel):
 _scheduler = AsyncIOScheduler(timezone="Asia/Taipei")
 
 
-def _scheduled_sync_job(label: str) -> None:
-    """排程觸發的歷史同步作業（同步執行，在 scheduler 執行緒中呼叫）。"""
-    logger.info("[排程同步] 觸發點: %s", label)
-    result = trigger_history_sync()
-    logger.info("[排程同步] 結果: %s", result)
-
-
 @asynccontextmanager
 async def lifespan(app_instance):
     # ── 啟動 ─────────────────────────────────────────────────────
@@ -132,31 +194,38 @@ async def lifespan(app_instance):
     Base.metadata.create_all(bind=engine)
     logger.info("Database tables created/verified")
 
-    # 台灣期貨換日時間表（Asia/Taipei）：
-    #   凌晨場結束：每日 05:00 → 排程 04:50 同步，確保夜盤資料不遺漏
-    #   日盤收盤後：每日 14:00 → 排程 13:55 同步，保存日盤完整紀錄
-    _scheduler.add_job(
-        _scheduled_sync_job,
-        CronTrigger(hour=4, minute=50, timezone="Asia/Taipei"),
-        args=["換日前(04:50)"],
-        id="sync_before_rollover",
-        replace_existing=True,
-    )
-    _scheduler.add_job(
-        _scheduled_sync_job,
-        CronTrigger(hour=13, minute=55, timezone="Asia/Taipei"),
-        args=["日盤收盤後(13:55)"],
-        id="sync_after_day_close",
-        replace_existing=True,
-    )
-    _scheduler.start()
-    logger.info("APScheduler started — 自動同步排程：04:50 / 13:55 (Asia/Taipei)")
+    # 換月行事曆：預先建立並檢查休市日檔案
+    get_contract_calendar()
+
+    # 成交事件清空 /margin、/positions、/unliquidations 快取
+    register_account_cache_invalidation()
+    # 部位帳：以 get_position 建立並定期對帳，成交事件即時更新
+    if POSITION_LIMITS_ENABLED:
+        start_position_ledger()
+
+    # 閘道模式下由 broker_gateway 程序負責排程，HTTP worker 不重複執行同步
+    if broker_mode() == "gateway-client":
+        logger.info("Broker gateway client mode — 同步排程由閘道程序執行")
+        # 委託 / 成交事件由閘道程序發佈，這裡訂閱後轉給本 worker 的 SSE 連線
+        start_event_relay(os.getenv("UNITRADE_GATEWAY_SOCKET"))
+    else:
+        register_history_sync_jobs(_scheduler)
+        _scheduler.start()
+        logger.info("APScheduler started — 自動同步排程：04:50 / 13:55 (Asia/Taipei)")
 
     yield
 
     # ── 關閉 ─────────────────────────────────────────────────────
-    _scheduler.shutdown(wait=False)
-    logger.info("APScheduler stopped")
+    if _scheduler.running:
+        _scheduler.shutdown(wait=False)
+        logger.info("APScheduler stopped")
+    stop_event_relay()
+    stop_position_ledger()
+    await close_product_lookup_client()
+    shutdown_order_pipeline()
+    # 寫完佇列中剩餘的委託 / 成交回報
+    stop_callback_writer()
+    await async_engine.dispose()
 
 
 cors_origins = os.getenv("CORS_ORIGINS", "*")
@@ -171,90 +240,311 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # 跨來源時瀏覽器只讓前端讀取列出的回應標頭（keyset 分頁游標）
+    expose_headers=["X-Next-Before-Id"],
 )
 
+# 大頁面的 JSON 回應以 gzip 壓縮（SSE 串流不壓縮）；設為 0 停用
+GZIP_MINIMUM_SIZE = int(os.getenv("GZIP_MINIMUM_SIZE", "4096"))
+if GZIP_MINIMUM_SIZE > 0:
+    app.add_middleware(GZipMiddleware, minimum_size=GZIP_MINIMUM_SIZE, compresslevel=5)
+
+
+class _ReceivedAtMiddleware:
+    """在 ASGI scope 記錄請求抵達時間（payload 驗證之前），作為訊號延遲打點的起點。"""
+
+    def __init__(self, app_instance):
+        self.app = app_instance
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            scope.setdefault("state", {})["received_at"] = time.monotonic()
+        await self.app(scope, receive, send)
+
+
+app.add_middleware(_ReceivedAtMiddleware)
+
 
 # ==================== 商品查詢轟助函式 ====================
 def get_taifex_front_month_contract(base_code: str) -> str:
-    """計算台灣期交所近月合約代碼。
+    """計算台灣期交所近月合約代碼（台北時間、含休市日與夜盤換月，見 contract_calendar.py）。
 
     月份代碼：A=1月, B=2月, C=3月, D=4月, E=5月, F=6月,
                 G=7月, H=8月, I=9月, J=10月, K=11月, L=12月
-    到期日：每月第三個週三。
-    
+
     範例：get_taifex_front_month_contract('MXF') -> 'MXFF6'  (若目前是2026年6月)
     """
-    today = date.today()
+    return front_month_contract(base_code)
 
-    def third_wednesday(year: int, month: int) -> date:
-        d = date(year, month, 1)
-        days_until_wed = (2 - d.weekday()) % 7  # 0=Mon, 2=Wed
-        first_wed = d + timedelta(days=days_until_wed)
-        return first_wed + timedelta(weeks=2)
 
-    expiry = third_wednesday(today.year, today.month)
+# ==================== 列表分頁（keyset） ====================
 
-    if today > expiry:
-        if today.month == 12:
-            contract_year, contract_month = today.year + 1, 1
+async def _keyset_page(
+    db: AsyncSession,
+    query,
+    model,
+    sort_col,
+    response: Response,
+    limit: int,
+    offset: int = 0,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+) -> list:
+    """以 (sort_col, id) 做 keyset 分頁，結果一律依 sort_col DESC NULLS FIRST, id DESC 排序。
+
+    - before_id：取比該筆更舊的資料（往下翻頁）
+    - after_id ：取比該筆更新的資料（輪詢新資料）
+    - 皆未提供時沿用 offset（相容舊前端），建議改用回應標頭 X-Next-Before-Id 翻頁
+
+    sort_col 須為不會變動的欄位（created_at），否則翻頁期間被更新的資料會重複或漏掉。
+    sort_col 為 NULL 的舊資料排在最前面（與 PostgreSQL DESC 預設及索引順序相同），
+    以 id 排序並在游標條件中另外處理（NULL 與任何值比較都不成立）。
+    """
+    limit = max(1, min(limit, 1000))
+    if date_from is not None:
+        query = query.filter(sort_col >= date_from)
+    if date_to is not None:
+        query = query.filter(sort_col < date_to)
+
+    anchor_id = before_id if before_id is not None else after_id
+    if anchor_id is not None:
+        anchor = (await db.execute(select(sort_col).where(model.id == anchor_id))).first()
+        if anchor is None:
+            raise HTTPException(status_code=400, detail=f"無效的游標 id: {anchor_id}")
+        if anchor[0] is None:
+            # 游標在 NULL 區段內：只依 id 比較；往舊翻頁時接著是所有非 NULL 的資料
+            in_nulls = sort_col.is_(None)
+            if before_id is not None:
+                query = query.filter(or_(and_(in_nulls, model.id < anchor_id), sort_col.isnot(None)))
+            else:
+                query = query.filter(in_nulls, model.id > anchor_id)
         else:
-            contract_year, contract_month = today.year, today.month + 1
+            anchor_key = tuple_(anchor[0], anchor_id)
+            if before_id is not None:
+                query = query.filter(tuple_(sort_col, model.id) < anchor_key)
+            else:
+                query = query.filter(or_(tuple_(sort_col, model.id) > anchor_key, sort_col.is_(None)))
+
+    if after_id is not None and before_id is None:
+        rows = (await db.execute(
+            query.order_by(sort_col.asc().nulls_last(), model.id.asc()).limit(limit)
+        )).all()
+        rows.reverse()
+    else:
+        query = query.order_by(sort_col.desc().nulls_first(), model.id.desc())
+        if anchor_id is None and offset:
+            query = query.offset(offset)
+        rows = (await db.execute(query.limit(limit))).all()
+
+    if len(rows) == limit:
+        response.headers["X-Next-Before-Id"] = str(rows[-1].id)
+    return rows
+
+
+# ==================== 增量變更（changes since cursor） ====================
+
+# 游標上限：較早時間戳但較晚 commit 的交易不可被游標跳過。
+# PostgreSQL 上時間戳由 trigger 在寫入列時填入（014_changes_commit_timestamps.sql），上限取
+# 「最早仍在進行的寫入交易開始時間」與 now - CHANGES_SETTLE_MS 的較小者：未 commit 的列時間戳
+# 必不早於其交易開始時間，不論 commit 多慢都不會被越過。其他資料庫（本機 SQLite）只靠沉澱時間。
+CHANGES_SETTLE_MS = int(os.getenv("CHANGES_SETTLE_MS", "500"))
+CHANGES_MAX_ROWS = 500
+
+# 同一資料庫中已取得 transaction id（已寫入）且尚未結束的交易；需以服務本身的角色查詢
+_OLDEST_WRITE_XACT = (
+    select(func.timezone("UTC", func.min(literal_column("xact_start"))))
+    .select_from(text("pg_stat_activity"))
+    .where(literal_column("backend_xid").isnot(None))
+    .where(literal_column("datname") == func.current_database())
+    .scalar_subquery()
+)
+
+
+def _changes_bound(db: AsyncSession):
+    """游標可前進到的上限（不含）：見 CHANGES_SETTLE_MS 說明。"""
+    settled = literal(datetime.utcnow() - timedelta(milliseconds=CHANGES_SETTLE_MS), DateTime())
+    if db.bind.dialect.name == "postgresql":
+        return func.least(settled, _OLDEST_WRITE_XACT)
+    return settled
+
+
+def _parse_changes_cursor(since: str) -> tuple:
+    if not since:
+        return datetime.min, 0
+    try:
+        ts_raw, id_raw = since.rsplit(",", 1)
+        return datetime.fromisoformat(ts_raw), int(id_raw)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"無效的 since 游標: {since}")
+
+
+async def _changes_since(db: AsyncSession, model, ts_col, since: Optional[str], limit: int, fields: Optional[str] = None):
+    """回傳游標之後新增或更新的資料與新游標；沒有變更時回 204。
+
+    游標格式為 "<ISO 時間>,<id>"；未提供 since 時只回傳目前的游標，供前端初次載入後開始輪詢。
+    fields 同列表端點（見 list_query.py），只查詢並回傳指定欄位。
+    """
+    names = list_fields(model, fields, ts_col.key)
+    bound = _changes_bound(db)
+    if since is None:
+        latest = (await db.execute(
+            select(ts_col, model.id)
+            .where(ts_col < bound)
+            .order_by(ts_col.desc(), model.id.desc())
+            .limit(1)
+        )).first()
+        cursor = f"{latest[0].isoformat()},{latest[1]}" if latest else ""
+        return {"cursor": cursor, "items": [], "has_more": False}
+
+    cursor_ts, cursor_id = _parse_changes_cursor(since)
+    limit = max(1, min(limit, CHANGES_MAX_ROWS))
+    rows = (await db.execute(
+        select(*list_columns(model, names))
+        .where(tuple_(ts_col, model.id) > tuple_(cursor_ts, cursor_id))
+        .where(ts_col < bound)
+        .order_by(ts_col.asc(), model.id.asc())
+        .limit(limit + 1)
+    )).all()
+    if not rows:
+        return Response(status_code=204)
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    last = rows[-1]
+    last_ts = getattr(last, ts_col.key)
+    return FastJSONResponse({
+        "cursor": f"{last_ts.isoformat()},{last.id}",
+        "items": rows_to_dicts(names, rows),
+        "has_more": has_more,
+    })
+
+
+# ==================== 即時事件串流（SSE） ====================
+
+def _sse(event: dict) -> str:
+    data = json.dumps(event.get("data"), ensure_ascii=False, default=str)
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {data}\n\n"
+
+
+@app.get("/events/stream")
+async def stream_events(
+    request: Request,
+    types: Optional[str] = None,
+    last_event_id: Optional[int] = None,
+):
+    """以 Server-Sent Events 推送 order / fill / signal 事件。
+
+    types 以逗號分隔過濾事件類型；斷線重連時瀏覽器會帶 Last-Event-ID header
+    （或以 ?last_event_id= 指定），從記憶體緩衝補送期間的事件。無法續傳時先送
+    reset 事件，客戶端應重新載入完整清單。消費過慢時送 overflow 後中斷，重連即可續傳。
+    連線後先送 hello：complete 為 False（內嵌模式多 worker）表示本連線只看得到
+    所在 worker 的事件，客戶端須保留增量輪詢。
+    """
+    kinds = None
+    if types:
+        kinds = {t.strip() for t in types.split(",") if t.strip()}
+        unknown = kinds - set(EVENT_TYPES)
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"未知的事件類型: {', '.join(sorted(unknown))}")
+
+    header_id = request.headers.get("last-event-id")
+    if header_id:
+        try:
+            last_event_id = int(header_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"無效的 Last-Event-ID: {header_id}")
+
+    bus = get_event_bus()
+    subscriber = AsyncSubscriber(asyncio.get_running_loop(), kinds)
+    try:
+        backlog, reset, resume_id = bus.subscribe(subscriber, last_event_id)
+    except TooManySubscribers as exc:
+        raise HTTPException(status_code=503, detail=str(exc))
+
+    async def event_source():
+        try:
+            yield "retry: 3000\n\n"
+            # hello 不帶 id，不影響瀏覽器的 Last-Event-ID；complete 為 False 時前端繼續輪詢
+            yield f"event: hello\ndata: {json.dumps({'complete': stream_complete()})}\n\n"
+            if reset:
+                yield _sse({"id": resume_id, "type": "reset", "data": {"last_event_id": resume_id}})
+            for event in backlog:
+                yield _sse(event)
+            while True:
+                try:
+                    event = await subscriber.get(EVENT_KEEPALIVE)
+                except StreamOverflow:
+                    logger.warning("SSE client too slow, closing stream")
+                    yield "event: overflow\ndata: {}\n\n"
+                    return
+                if event is None:
+                    if await request.is_disconnected():
+                        return
+                    yield ": keepalive\n\n"
+                    continue
+                yield _sse(event)
+        finally:
+            bus.unsubscribe(subscriber)
+
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/contracts/rolls")
+def contract_rolls(
+    db: Session = Depends(get_db),
+    base: Optional[str] = None,
+    count: int = 6,
+):
+    """自動換月行事曆：近月 / 次月代碼與即將到來的換月時間（台北時間）。
+
+    未指定 base 時列出所有 auto_rollover 策略的商品基底。
+    """
+    if base:
+        bases = [base.strip().upper()]
     else:
-        contract_year, contract_month = today.year, today.month
-
-    # A=Jan(印碼65), B=Feb, ..., L=Dec(印碼76)
-    month_code = chr(ord('A') + contract_month - 1)
-    year_code = str(contract_year)[-1]
-    return f"{base_code}{month_code}{year_code}"
-
-def _parse_margin_html(html_text: str) -> list:
-    """Parse pfctrade margin HTML table into list of dicts."""
-    from html.parser import HTMLParser
-
-    class _TblParser(HTMLParser):
-        def __init__(self):
-            super().__init__()
-            self.rows = []
-            self._row = None
-            self._cell = None
-
-        def handle_starttag(self, tag, attrs):
-            if tag == "tr":
-                self._row = []
-            elif tag in ("td", "th") and self._row is not None:
-                self._cell = ""
-
-        def handle_endtag(self, tag):
-            if tag in ("td", "th") and self._cell is not None:
-                self._row.append(self._cell.strip())
-                self._cell = None
-            elif tag == "tr" and self._row is not None:
-                if any(c for c in self._row):
-                    self.rows.append(self._row)
-                self._row = None
-
-        def handle_data(self, data):
-            if self._cell is not None:
-                self._cell += data
-
-    parser = _TblParser()
-    parser.feed(html_text)
-    if len(parser.rows) < 2:
-        return []
-    HEADER_MAP = {
-        "交易所": "exchange",
-        "商品代號": "code",
-        "商品名稱": "name",
-        "原始保證金": "original_margin",
-        "維持保證金": "maintenance_margin",
-        "幣別": "currency",
+        bases = sorted({
+            c.target_product
+            for c in db.query(StrategyConfig).filter(StrategyConfig.auto_rollover.is_(True))
+        }) or ["TXF"]
+    count = max(1, min(count, 24))
+    calendar = get_contract_calendar()
+    return {
+        "now": now_taipei().isoformat(),
+        "holidays_loaded": len(calendar.holidays),
+        "products": [
+            {
+                "base": b,
+                "front": front_month_contract(b),
+                "next": next_month_contract(b),
+                "rolls": upcoming_rolls(b, count),
+            }
+            for b in bases
+        ],
     }
-    headers = [HEADER_MAP.get(h, h) for h in parser.rows[0]]
-    return [
-        {headers[i]: row[i] for i in range(len(headers))}
-        for row in parser.rows[1:]
-        if len(row) >= len(headers)
-    ]
+
+
+@app.get("/positions/ledger")
+def position_ledger_status():
+    """程序內部位帳快照（帳戶層 / 策略層淨部位與未成交預約量）"""
+    return get_position_ledger().snapshot()
+
+
+@app.get("/metrics")
+def prometheus_metrics():
+    """Prometheus 指標：訊號各階段延遲、委託 / 訊號結果計數、券商呼叫、帳務查詢與歷史同步耗時"""
+    return Response(content=render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/events/status")
+def event_stream_status():
+    """事件匯流排狀態：最新 event id、緩衝筆數、連線數，以及回報寫入佇列"""
+    return {**get_event_bus().stats(), "complete": stream_complete(), "callback_writer": get_callback_writer().stats()}
 
 
 # ==================== Health Check ====================
@@ -273,7 +563,6 @@ def health_check():
 def db_health_check(db: Session = Depends(get_db)):
     """Check database connectivity"""
     try:
-        from sqlalchemy import text
         db.execute(text("SELECT 1"))
         return {"status": "ok", "database": "connected"}
     except Exception as exc:
@@ -284,8 +573,10 @@ def db_health_check(db: Session = Depends(get_db)):
 def unitrade_health_check():
     """Check Unitrade API connection (may be slow on first call)"""
     try:
-        _ = get_unitrade_client()
-        return {"status": "ok", "unitrade": "connected"}
+        api = get_unitrade_client()
+        if broker_mode() == "gateway-client":
+            api.ping()
+        return {"status": "ok", "unitrade": "connected", "mode": broker_mode(), "backend": broker_backend()}
     except Exception as exc:
         return {"status": "error", "unitrade": "disconnected", "error": str(exc)}
 
@@ -311,15 +602,12 @@ def accounts_check():
 
 # ==================== 下單核心函式 ====================
 
-def submit_unitrade_order(
+def _new_order_record(
     payload: OrderRequest,
-    db: Session,
     source: str,
-) -> OrderResponse:
-    logger.info(
-        "Order request received: source=%s productid=%s bs=%s qty=%s",
-        source, payload.productid, payload.bs, payload.orderqty,
-    )
+    idempotency_key: Optional[str] = None,
+) -> Tuple[OrderHistory, dict]:
+    """建立 pending 委託記錄（尚未寫入 session）與送往券商的 DOrderObject 欄位。"""
     actno = payload.actno or os.getenv("UNITRADE_ACTNO")
     if not actno:
         raise HTTPException(status_code=400, detail="缺少 actno (帳號)")
@@ -339,110 +627,339 @@ def submit_unitrade_order(
         sub_account=payload.subactno,
         source=source,
         status="pending",
+        idempotency_key=idempotency_key,
     )
+    order_fields = dict(
+        actno=actno,
+        subactno=payload.subactno or "",
+        productid=payload.productid,
+        bs=payload.bs,
+        ordertype=payload.ordertype,
+        price=payload.price,
+        orderqty=payload.orderqty,
+        ordercondition=payload.ordercondition,
+        opencloseflag=payload.opencloseflag or "",
+        dtrade=payload.dtrade or "N",
+        note=payload.note or "",
+    )
+    return order_record, order_fields
 
-    db.add(order_record)
-    db.commit()
-    db.refresh(order_record)
 
+async def _wait_order(future, timeout: float):
+    """在 event loop 上等待下單管線的結果；逾時不取消委託（仍在背景完成）。timeout=0 即不等待。"""
+    return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), max(0.0, timeout))
+
+
+async def submit_unitrade_order(
+    payload: OrderRequest,
+    db: AsyncSession,
+    source: str,
+    wait: bool = True,
+    timeout: Optional[float] = None,
+    signal_id: Optional[int] = None,
+    idempotency_key: Optional[str] = None,
+    trace: Optional[OrderTrace] = None,
+) -> OrderResponse:
+    """寫入 pending 委託後交給下單管線送往券商。
+
+    委託與 session 中尚未 commit 的資料（例如訊號記錄）在同一個 transaction 寫入；
+    wait=False 或等待逾時時回覆 status="accepted"，委託會在背景完成並寫回 DB。
+    寫入失敗時整個 transaction 回滾（含同 session 尚未 commit 的訊號記錄）；
+    idempotency_key 撞到唯一索引時拋出 DuplicateRequest。
+    """
+    logger.info(
+        "Order request received: source=%s productid=%s bs=%s qty=%s",
+        source, payload.productid, payload.bs, payload.orderqty,
+    )
+    order_record, order_fields = _new_order_record(payload, source, idempotency_key)
+    trace = trace or OrderTrace(strategy=payload.strategy or "", product=payload.productid)
+    order_record.stage_timings = trace.timings()
+    db.add(order_record)
     try:
-        api = get_unitrade_client()
-        order_obj = DOrderObject(
-            actno=actno,
-            subactno=payload.subactno or "",
-            productid=payload.productid,
-            bs=payload.bs,
-            ordertype=payload.ordertype,
-            price=payload.price,
-            orderqty=payload.orderqty,
-            ordercondition=payload.ordercondition,
-            opencloseflag=payload.opencloseflag or "",
-            dtrade=payload.dtrade or "N",
-            note=payload.note or "",
-        )
-        result = api.dtrade.order(order_obj)
-    except UnitradeLoginError as exc:
+        await db.flush()
+        record_id = order_record.id
+
+        # 事件須先於下單管線的狀態更新發佈，前端才會依序看到 pending → submitted
+        events = [("order", order_record.to_dict())]
+        if signal_id is not None:
+            events.append(("signal", (await db.get(SignalHistory, signal_id)).to_dict()))
+        await db.commit()
+    except Exception as exc:
+        await db.rollback()
+        if isinstance(exc, IntegrityError) and idempotency_key is not None:
+            raise DuplicateRequest(idempotency_key)
+        raise
+    if idempotency_key is not None:
+        # commit 後即登記，等待券商回應期間的重送也直接命中記憶體索引
+        order_index.remember(idempotency_key, record_id)
+    trace.mark("order_persisted")
+    for kind, data in events:
+        publish_event(kind, data)
+    try:
+        future = submit_order(record_id, order_fields, signal_id=signal_id, trace=trace)
+    except OrderPipelineFull as exc:
         order_record.status = "failed"
         order_record.error_message = str(exc)
         order_record.updated_at = datetime.utcnow()
-        db.commit()
+        event = order_record.to_dict()
+        await db.commit()
+        publish_event("order", event)
+        raise HTTPException(status_code=503, detail=str(exc)) from exc
+
+    if not wait:
+        return OrderResponse(status="accepted", record_id=record_id)
+
+    try:
+        order_id, result = await _wait_order(future, ORDER_WAIT_TIMEOUT if timeout is None else timeout)
+    except asyncio.TimeoutError:
+        logger.warning("Order still in flight after wait timeout: record_id=%s", record_id)
+        return OrderResponse(status="accepted", record_id=record_id)
+    except UnitradeOutcomeUnknown:
+        # 不可重送：回覆 unknown，委託待歷史同步對帳
+        return OrderResponse(status="unknown", record_id=record_id)
+    except UnitradeLoginError as exc:
         raise HTTPException(status_code=503, detail=str(exc)) from exc
+    except UnitradeOrderError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
     except Exception as exc:
-        order_record.status = "failed"
-        order_record.error_message = str(exc)
-        order_record.updated_at = datetime.utcnow()
-        db.commit()
         raise HTTPException(status_code=500, detail=str(exc)) from exc
 
-    # DOrderResponse: issend=False 表示本地端即拒絕（如帳號格式錯誤）
-    issend = getattr(result, "issend", True)
-    if not issend:
-        err_msg = getattr(result, "errormsg", None) or getattr(result, "errorcode", "下單失敗")
-        order_record.status = "failed"
-        order_record.error_message = err_msg
-        order_record.order_result = serialize_order_result(result)
-        order_record.updated_at = datetime.utcnow()
-        db.commit()
-        raise HTTPException(status_code=400, detail=err_msg)
-
-    # seq 可能帶有尾端空白，需 strip
-    order_id = (getattr(result, "seq", None) or "").strip() or extract_order_id(result)
-    order_record.order_id = order_id
-    order_record.status = "submitted"
-    order_record.order_result = serialize_order_result(result)
-    order_record.updated_at = datetime.utcnow()
-    db.commit()
-
     result_dict = None
     if isinstance(result, dict):
         result_dict = result
 
-    return OrderResponse(status="ok", order_id=order_id, result=result_dict)
+    return OrderResponse(status="ok", order_id=order_id, record_id=record_id, result=result_dict)
 
 
 # ==================== Webhook & Order API ====================
 
+def _replay_order(record: OrderHistory, response: Response) -> OrderResponse:
+    """以原委託記錄回覆重送的請求（不重新下單）。"""
+    response.headers["Idempotent-Replay"] = "true"
+    if record.status == "pending":
+        status = "accepted"
+    elif record.status in ("failed", "unknown"):
+        status = record.status
+    else:
+        status = "ok"
+    return OrderResponse(status=status, order_id=record.order_id, record_id=record.id)
+
+
+async def _submit_idempotent_order(
+    payload: OrderRequest,
+    response: Response,
+    db: AsyncSession,
+    source: str,
+    wait: bool,
+    timeout: Optional[float],
+    header_key: Optional[str],
+    trace: Optional[OrderTrace] = None,
+) -> OrderResponse:
+    """帶冪等鍵的直接下單：重送時回覆原委託，不碰券商；未帶鍵時照常下單。"""
+    key = normalize_key(payload.idempotency_key or header_key)
+    if key is not None:
+        known_id = order_index.get(key)
+        if known_id is not None:
+            record = await db.get(OrderHistory, known_id)
+            if record is not None:
+                logger.info("Duplicate order replayed: source=%s key=%s record_id=%s", source, key, known_id)
+                return _replay_order(record, response)
+    try:
+        return await submit_unitrade_order(
+            payload, db, source=source, wait=wait, timeout=timeout, idempotency_key=key, trace=trace,
+        )
+    except DuplicateRequest:
+        record = (await db.execute(
+            select(OrderHistory).where(OrderHistory.idempotency_key == key)
+        )).scalars().first()
+        if record is None:
+            raise HTTPException(status_code=409, detail="重複委託，原請求尚未完成")
+        order_index.remember(key, record.id)
+        logger.info("Duplicate order rejected by unique index: source=%s key=%s record_id=%s", source, key, record.id)
+        return _replay_order(record, response)
+
+
 @app.post("/webhook", response_model=OrderResponse)
-def tradingview_webhook(
+async def tradingview_webhook(
     payload: OrderRequest,
-    db: Session = Depends(get_db),
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(get_async_db),
+    wait: bool = True,
+    timeout: Optional[float] = None,
+    idempotency_key: Optional[str] = Header(default=None),
 ):
-    """TradingView Webhook 直接下單端點"""
-    return submit_unitrade_order(payload, db, source="webhook")
+    """TradingView Webhook 直接下單端點（wait=false 時受理後立即回覆；帶冪等鍵時重送不會重複下單）"""
+    trace = OrderTrace(
+        started=getattr(request.state, "received_at", None),
+        strategy=payload.strategy or "", product=payload.productid,
+    )
+    trace.mark("validated")
+    return await _submit_idempotent_order(payload, response, db, "webhook", wait, timeout, idempotency_key, trace)
 
 
 @app.post("/order", response_model=OrderResponse)
-def manual_order(
+async def manual_order(
     payload: OrderRequest,
-    db: Session = Depends(get_db),
+    response: Response,
+    db: AsyncSession = Depends(get_async_db),
+    wait: bool = True,
+    timeout: Optional[float] = None,
+    idempotency_key: Optional[str] = Header(default=None),
 ):
     """手動下單端點"""
-    return submit_unitrade_order(payload, db, source="manual")
+    return await _submit_idempotent_order(payload, response, db, "manual", wait, timeout, idempotency_key)
 
 
 @app.get("/orders")
-def list_orders(
-    db: Session = Depends(get_db),
+async def list_orders(
+    response: Response,
+    db: AsyncSession = Depends(get_async_db),
     limit: int = 100,
     offset: int = 0,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    status: Optional[str] = None,
+    strategy: Optional[str] = None,
+    symbol: Optional[str] = None,
+    source: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    fields: Optional[str] = None,
 ):
-    """列出訂單歷史"""
-    orders = (
-        db.query(OrderHistory)
-        .order_by(OrderHistory.created_at.desc())
-        .offset(offset)
-        .limit(min(limit, 1000))
-        .all()
+    """列出訂單歷史（keyset 分頁：before_id / after_id，可依狀態、策略、商品、來源、日期篩選；
+    fields 以逗號分隔只回傳指定欄位）"""
+    names = list_fields(OrderHistory, fields, "created_at")
+    query = select(*list_columns(OrderHistory, names))
+    if status:
+        query = query.filter(OrderHistory.status == status)
+    if strategy:
+        query = query.filter(OrderHistory.strategy == strategy)
+    if symbol:
+        query = query.filter(OrderHistory.symbol == symbol)
+    if source:
+        query = query.filter(OrderHistory.source == source)
+    rows = await _keyset_page(
+        db, query, OrderHistory, OrderHistory.created_at, response,
+        limit, offset, before_id, after_id, date_from, date_to,
     )
-    return [o.to_dict() for o in orders]
+    return rows_response(names, rows, response)
+
+
+@app.get("/orders/changes")
+async def list_order_changes(
+    db: AsyncSession = Depends(get_async_db),
+    since: Optional[str] = None,
+    limit: int = CHANGES_MAX_ROWS,
+    fields: Optional[str] = None,
+):
+    """回傳 since 游標（updated_at,id）之後新增或狀態變更的委託；無變更回 204"""
+    return await _changes_since(db, OrderHistory, OrderHistory.updated_at, since, limit, fields)
 
 
 # ==================== 訊號處理 API ====================
 
+async def _add_signal_record(db: AsyncSession, signal_record: SignalHistory) -> None:
+    """寫入訊號記錄；冪等鍵撞到唯一索引時回滾並拋出 DuplicateRequest。"""
+    db.add(signal_record)
+    try:
+        await db.flush()
+    except IntegrityError:
+        await db.rollback()
+        if signal_record.idempotency_key is None:
+            raise
+        raise DuplicateRequest(signal_record.idempotency_key)
+
+
+def _replay_signal(record: SignalHistory, response: Optional[Response] = None) -> SignalResponse:
+    """以原訊號記錄回覆重送的請求（不重新下單）。"""
+    if response is not None:
+        response.headers["Idempotent-Replay"] = "true"
+    if record.status in ("processing", "processed"):
+        message = f"重複訊號，沿用原處理結果：{record.actual_product} {record.actual_bs} {record.actual_quantity}口"
+    else:
+        message = f"重複訊號，原訊號狀態 {record.status}：{record.error_message or ''}"
+    return SignalResponse(
+        status={"processing": "accepted", "processed": "ok"}.get(record.status, record.status),
+        signal_id=record.id,
+        order_id=record.order_id,
+        message=message,
+        actual_product=record.actual_product,
+        actual_quantity=record.actual_quantity,
+    )
+
+
+async def _process_idempotent_signal(
+    signal: SignalRequest,
+    response: Response,
+    db: AsyncSession,
+    wait: bool,
+    timeout: Optional[float],
+    header_key: Optional[str],
+    trace: OrderTrace,
+) -> SignalResponse:
+    """冪等鍵檢查：記憶體索引命中或 INSERT 撞到唯一索引時回覆原訊號結果，不碰券商。"""
+    key = signal_idempotency_key(
+        signal.strategy, signal.signal, signal.price, signal.bar_time,
+        signal.idempotency_key or header_key,
+    )
+    if key is None:
+        return await _process_signal(signal, db, wait, timeout, trace=trace)
+
+    known_id = signal_index.get(key)
+    if known_id is not None:
+        record = await db.get(SignalHistory, known_id)
+        if record is not None:
+            logger.info("Duplicate signal replayed: strategy=%s key=%s signal_id=%s", signal.strategy, key, known_id)
+            return _replay_signal(record, response)
+
+    try:
+        result = await _process_signal(signal, db, wait, timeout, idempotency_key=key, trace=trace)
+    except DuplicateRequest:
+        record = (await db.execute(
+            select(SignalHistory).where(SignalHistory.idempotency_key == key)
+        )).scalars().first()
+        if record is None:
+            raise HTTPException(status_code=409, detail="重複訊號，原請求尚未完成")
+        signal_index.remember(key, record.id)
+        logger.info("Duplicate signal rejected by unique index: strategy=%s key=%s signal_id=%s", signal.strategy, key, record.id)
+        return _replay_signal(record, response)
+    if result.signal_id is not None:
+        signal_index.remember(key, result.signal_id)
+    return result
+
+
+async def _handle_signal(
+    signal: SignalRequest,
+    request: Request,
+    response: Response,
+    db: AsyncSession,
+    wait: bool,
+    timeout: Optional[float],
+    header_key: Optional[str],
+) -> SignalResponse:
+    """/signal 與 /signal/simple 共用入口：階段打點、冪等鍵檢查與結果計數。"""
+    trace = OrderTrace(started=getattr(request.state, "received_at", None), strategy=signal.strategy)
+    trace.mark("validated")
+    try:
+        result = await _process_idempotent_signal(signal, response, db, wait, timeout, header_key, trace)
+    except Exception:
+        SIGNALS_TOTAL.inc(strategy=signal.strategy, product=trace.product, outcome="failed")
+        raise
+    outcome = "replayed" if "Idempotent-Replay" in response.headers else result.status
+    SIGNALS_TOTAL.inc(strategy=signal.strategy, product=result.actual_product or trace.product, outcome=outcome)
+    return result
+
+
 @app.post("/signal", response_model=SignalResponse)
-def process_signal(
+async def process_signal(
     signal: SignalRequest,
-    db: Session = Depends(get_db),
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(get_async_db),
+    wait: bool = True,
+    timeout: Optional[float] = None,
+    idempotency_key: Optional[str] = Header(default=None),
 ):
     """
     處理 TradingView 訊號 - 根據策略設定自動轉換為實際訂單
@@ -453,52 +970,82 @@ def process_signal(
         "signal": "long_entry",
         "quantity": 1,
         "price": 21500,
-        "note": "Buy"
+        "note": "Buy",
+        "bar_time": "{{time}}"
     }
+
+    帶 idempotency_key（或 Idempotency-Key header）或 bar_time 時，重送的訊號
+    回覆原處理結果（header Idempotent-Replay: true），不會重複下單。
     """
-    logger.info(
-        "Signal received: strategy=%s signal=%s qty=%s",
-        signal.strategy, signal.signal, signal.quantity,
-    )
+    return await _handle_signal(signal, request, response, db, wait, timeout, idempotency_key)
 
-    # 查詢策略設定
-    strategy_config = db.query(StrategyConfig).filter(
-        StrategyConfig.strategy_name == signal.strategy
-    ).first()
+
+@dataclass
+class _SignalPlan:
+    """單筆訊號的處理計畫：record 為待寫入的訊號記錄，order 為 None 時不下單、response 即結果。"""
+    record: SignalHistory
+    response: Optional[SignalResponse] = None
+    order: Optional[OrderRequest] = None
+    reservation: Optional[Any] = None
+    is_entry: bool = False
+    error_status: Optional[int] = None  # 單筆 /signal 改以 HTTPException 回覆
+
+
+def _position_account(strategy_config: StrategyConfig) -> str:
+    return strategy_config.account or os.getenv("UNITRADE_ACTNO", "")
+
+
+async def _lock_positions(
+    db: AsyncSession, signals: Iterable[SignalRequest], configs: Dict[str, Optional[StrategyConfig]],
+) -> Optional[dict]:
+    """多個 worker 時在目前的 transaction 鎖定並讀取 DB 上的策略部位（見 position_ledger）；
+    單一 worker 回傳 None，沿用記憶體帳本。鎖在委託寫入後 commit / rollback 時釋放。"""
+    if not shared_position_limits():
+        return None
+    pairs = []
+    for signal in signals:
+        config = configs.get(signal.strategy)
+        if config is not None and config.enabled:
+            pairs.append((_position_account(config), signal.strategy))
+    return await lock_shared_positions(db, pairs)
+
+
+def _plan_signal(
+    signal: SignalRequest,
+    strategy_config: Optional[StrategyConfig],
+    idempotency_key: Optional[str] = None,
+    shared_positions: Optional[dict] = None,
+) -> _SignalPlan:
+    """依策略設定把訊號轉為委託參數（含部位上限檢查）；不寫入 DB。
+
+    shared_positions 為 _lock_positions 的結果時，上限依 DB 上的部位計算。
+    """
+    recorded = dict(
+        strategy_name=signal.strategy,
+        signal_type=signal.signal,
+        signal_product=signal.product,
+        signal_quantity=signal.quantity,
+        signal_price=signal.price,
+        signal_note=signal.note,
+        raw_payload=signal.model_dump(),
+        idempotency_key=idempotency_key,
+    )
 
     if not strategy_config:
-        signal_record = SignalHistory(
-            strategy_name=signal.strategy,
-            signal_type=signal.signal,
-            signal_product=signal.product,
-            signal_quantity=signal.quantity,
-            signal_price=signal.price,
-            signal_note=signal.note,
-            status="failed",
-            error_message=f"Strategy '{signal.strategy}' not found",
-            raw_payload=signal.model_dump(),
+        return _SignalPlan(
+            record=SignalHistory(
+                **recorded,
+                status="failed",
+                error_message=f"Strategy '{signal.strategy}' not found",
+            ),
+            response=SignalResponse(status="failed", message=f"未找到策略設定: {signal.strategy}"),
+            error_status=404,
         )
-        db.add(signal_record)
-        db.commit()
-        raise HTTPException(status_code=404, detail=f"未找到策略設定: {signal.strategy}")
 
     if not strategy_config.enabled:
-        signal_record = SignalHistory(
-            strategy_name=signal.strategy,
-            signal_type=signal.signal,
-            signal_product=signal.product,
-            signal_quantity=signal.quantity,
-            signal_price=signal.price,
-            signal_note=signal.note,
-            status="ignored",
-            error_message="Strategy is disabled",
-            raw_payload=signal.model_dump(),
-        )
-        db.add(signal_record)
-        db.commit()
-        return SignalResponse(
-            status="ignored",
-            message=f"策略 '{signal.strategy}' 已停用",
+        return _SignalPlan(
+            record=SignalHistory(**recorded, status="ignored", error_message="Strategy is disabled"),
+            response=SignalResponse(status="ignored", message=f"策略 '{signal.strategy}' 已停用"),
         )
 
     # 計算實際下單參數
@@ -535,6 +1082,38 @@ def process_signal(
     else:
         actual_price = 0  # 市價單
 
+    # 部位上限：進場超過 max_position 截量或拒絕，出場只平實際持有的口數
+    reservation = None
+    if POSITION_LIMITS_ENABLED:
+        decision, reservation = get_position_ledger().size_order(
+            _position_account(strategy_config), actual_product, signal.strategy, actual_bs,
+            actual_quantity, is_entry, strategy_config.max_position, shared=shared_positions,
+        )
+        if decision.allowed == 0:
+            logger.warning("Signal rejected by position limit: strategy=%s %s", signal.strategy, decision.reason)
+            return _SignalPlan(
+                record=SignalHistory(
+                    **recorded,
+                    actual_product=actual_product,
+                    actual_quantity=0,
+                    actual_bs=actual_bs,
+                    status="rejected",
+                    error_message=decision.reason,
+                ),
+                response=SignalResponse(
+                    status="rejected",
+                    message=f"部位限制拒單：{decision.reason}",
+                    actual_product=actual_product,
+                    actual_quantity=0,
+                ),
+            )
+        if decision.allowed < actual_quantity:
+            logger.warning(
+                "Signal clipped by position limit: strategy=%s %s→%s %s",
+                signal.strategy, actual_quantity, decision.allowed, decision.reason,
+            )
+            actual_quantity = decision.allowed
+
     # 建立訂單請求
     order_payload = OrderRequest(
         actno=strategy_config.account,
@@ -547,56 +1126,143 @@ def process_signal(
         ordercondition=order_condition,
         opencloseflag=open_close_flag,
         dtrade=strategy_config.dtrade or "N",
-        note=signal.note or signal.signal,
+        note=(signal.note or signal.signal)[:10],  # DOrderObject note 上限 10 字元（short_entry 為 11）
         strategy=signal.strategy,
     )
 
-    # 記錄訊號
-    signal_record = SignalHistory(
-        strategy_name=signal.strategy,
-        signal_type=signal.signal,
-        signal_product=signal.product,
-        signal_quantity=signal.quantity,
-        signal_price=signal.price,
-        signal_note=signal.note,
-        actual_product=actual_product,
-        actual_quantity=actual_quantity,
-        actual_bs=actual_bs,
-        status="processing",
-        raw_payload=signal.model_dump(),
+    return _SignalPlan(
+        record=SignalHistory(
+            **recorded,
+            actual_product=actual_product,
+            actual_quantity=actual_quantity,
+            actual_bs=actual_bs,
+            status="processing",
+        ),
+        order=order_payload,
+        reservation=reservation,
+        is_entry=is_entry,
     )
-    db.add(signal_record)
-    db.commit()
-    db.refresh(signal_record)
 
-    # 提交訂單
-    try:
-        order_response = submit_unitrade_order(order_payload, db, source="signal")
 
-        signal_record.status = "processed"
-        signal_record.order_id = order_response.order_id
-        db.commit()
+_UNKNOWN_MESSAGE = "券商閘道在送出委託後中斷，委託結果未知，待歷史同步對帳"
 
-        return SignalResponse(
-            status="ok",
-            signal_id=signal_record.id,
-            order_id=order_response.order_id,
-            message=f"訊號已處理：{actual_product} {actual_bs} {actual_quantity}口",
-            actual_product=actual_product,
-            actual_quantity=actual_quantity,
-        )
 
+def _order_signal_response(
+    order: OrderRequest,
+    signal_id: int,
+    status: str,
+    order_id: Optional[str] = None,
+    message: Optional[str] = None,
+) -> SignalResponse:
+    summary = f"{order.productid} {order.bs} {order.orderqty}口"
+    if message is None:
+        message = f"訊號已受理，委託送出中：{summary}" if status == "accepted" else f"訊號已處理：{summary}"
+    return SignalResponse(
+        status=status,
+        signal_id=signal_id,
+        order_id=order_id,
+        message=message,
+        actual_product=order.productid,
+        actual_quantity=order.orderqty,
+    )
+
+
+async def _process_signal(
+    signal: SignalRequest,
+    db: AsyncSession,
+    wait: bool = True,
+    timeout: Optional[float] = None,
+    idempotency_key: Optional[str] = None,
+    trace: Optional[OrderTrace] = None,
+) -> SignalResponse:
+    """訊號轉委託的主流程（冪等鍵已由呼叫端檢查）。"""
+    logger.info(
+        "Signal received: strategy=%s signal=%s qty=%s",
+        signal.strategy, signal.signal, signal.quantity,
+    )
+    trace = trace or OrderTrace(strategy=signal.strategy)
+
+    # 查詢策略設定（程序內快取，避免每筆訊號都查 DB）
+    strategy_config = await get_strategy_config_async(db, signal.strategy)
+    shared = await _lock_positions(db, [signal], {signal.strategy: strategy_config})
+    plan = _plan_signal(signal, strategy_config, idempotency_key, shared)
+    trace.product = plan.record.actual_product or ""
+    trace.mark("strategy_resolved")
+
+    # 記錄訊號（下單時與委託在同一個 transaction 寫入）
+    signal_record = plan.record
+    try:
+        await _add_signal_record(db, signal_record)
+    except DuplicateRequest:
+        get_position_ledger().release(plan.reservation)
+        raise
+    signal_id = signal_record.id
+    trace.mark("signal_persisted")
+
+    if plan.order is None:
+        event = signal_record.to_dict()
+        await db.commit()
+        publish_event("signal", event)
+        if plan.error_status is not None:
+            raise HTTPException(status_code=plan.error_status, detail=plan.response.message)
+        plan.response.signal_id = signal_id
+        return plan.response
+
+    # 提交訂單（訊號狀態由下單管線在券商回應後寫回）
+    try:
+        order_response = await submit_unitrade_order(
+            plan.order, db, source="signal",
+            wait=wait, timeout=timeout, signal_id=signal_id, trace=trace,
+        )
     except Exception as exc:
+        get_position_ledger().release(plan.reservation)
+        if inspect(signal_record).transient:
+            # 委託寫入失敗時訊號記錄隨同一個 transaction 回滾：重新加入（保留原 id），失敗紀錄才會保存
+            db.add(signal_record)
         signal_record.status = "failed"
         signal_record.error_message = str(exc)
-        db.commit()
+        signal_record.updated_at = datetime.utcnow()
+        event = signal_record.to_dict()
+        await db.commit()
+        publish_event("signal", event)
         raise
+    if plan.reservation is not None and order_response.record_id is not None:
+        get_position_ledger().bind(plan.reservation, order_response.record_id)
+
+    if order_response.status == "accepted":
+        return _order_signal_response(plan.order, signal_id, "accepted")
+    if order_response.status == "unknown":
+        return _order_signal_response(plan.order, signal_id, "unknown", message=_UNKNOWN_MESSAGE)
+    return _order_signal_response(plan.order, signal_id, "ok", order_id=order_response.order_id)
+
+
+def _to_standard_signal(signal: SimpleSignalRequest) -> SignalRequest:
+    """極簡訊號（action + side）轉換為標準訊號格式。"""
+    if signal.action == "entry":
+        signal_type = "long_entry" if signal.side == "buy" else "short_entry"
+    else:  # exit
+        signal_type = "long_exit" if signal.side == "sell" else "short_exit"
+
+    return SignalRequest(
+        strategy=signal.strategy,
+        signal=signal_type,
+        quantity=signal.quantity,
+        price=signal.price,
+        note=signal.note or f"{signal.action}_{signal.side}",
+        bar_time=signal.bar_time,
+        idempotency_key=signal.idempotency_key,
+    )
 
 
 @app.post("/signal/simple", response_model=SignalResponse)
-def process_simple_signal(
+async def process_simple_signal(
     signal: SimpleSignalRequest,
-    db: Session = Depends(get_db),
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(get_async_db),
+    wait: bool = True,
+    timeout: Optional[float] = None,
+    idempotency_key: Optional[str] = Header(default=None),
 ):
     """
     處理極簡訊號 - 適用於 TradingView Alert 佔位符
@@ -616,21 +1282,195 @@ def process_simple_signal(
         signal.strategy, signal.action, signal.side, signal.quantity,
     )
 
-    # 轉換為標準訊號格式
-    if signal.action == "entry":
-        signal_type = "long_entry" if signal.side == "buy" else "short_entry"
-    else:  # exit
-        signal_type = "long_exit" if signal.side == "sell" else "short_exit"
+    standard_signal = _to_standard_signal(signal)
+    return await _handle_signal(standard_signal, request, response, db, wait, timeout, idempotency_key)
 
-    standard_signal = SignalRequest(
-        strategy=signal.strategy,
-        signal=signal_type,
-        quantity=signal.quantity,
-        price=signal.price,
-        note=signal.note or f"{signal.action}_{signal.side}",
-    )
 
-    return process_signal(standard_signal, db)
+SIGNAL_BATCH_MAX = int(os.getenv("SIGNAL_BATCH_MAX", "50"))
+
+
+@app.post("/signals/batch", response_model=List[SignalResponse])
+async def process_signal_batch(
+    signals: List[Union[SignalRequest, SimpleSignalRequest]],
+    request: Request,
+    db: AsyncSession = Depends(get_async_db),
+    wait: bool = True,
+    timeout: Optional[float] = None,
+):
+    """
+    批次處理同一根 K 棒的多筆訊號（可混用 /signal 與 /signal/simple 格式），
+    回傳與輸入順序相同的結果陣列；單筆失敗以 status="failed" 表示，不影響其他筆。
+
+    - 策略設定一次取得，所有訊號與委託記錄在同一個 transaction 寫入
+    - 出場委託先送出，得到券商回應後才送進場委託（先平倉再開倉）
+    - 同時送往券商的委託數受下單管線 BROKER_IO_WORKERS 限制
+    - timeout（預設 ORDER_WAIT_TIMEOUT）從收到請求起算，含等待出場組回應的時間；
+      逾時的委託回覆 accepted，仍在背景依序送出
+    - 冪等鍵規則與 /signal 相同，重送的訊號回覆原結果
+    """
+    # 等待期限從收到請求起算，涵蓋出場組等待券商回應的時間
+    deadline = time.monotonic() + (ORDER_WAIT_TIMEOUT if timeout is None else timeout)
+    if len(signals) > SIGNAL_BATCH_MAX:
+        raise HTTPException(status_code=413, detail=f"單次最多 {SIGNAL_BATCH_MAX} 筆訊號")
+    items = [s if isinstance(s, SignalRequest) else _to_standard_signal(s) for s in signals]
+    logger.info("Signal batch received: %d signals", len(items))
+    received_at = getattr(request.state, "received_at", None)
+    traces = [OrderTrace(started=received_at, strategy=s.strategy) for s in items]
+    for trace in traces:
+        trace.mark("validated")
+
+    keys = [
+        signal_idempotency_key(s.strategy, s.signal, s.price, s.bar_time, s.idempotency_key)
+        for s in items
+    ]
+    results: List[Optional[SignalResponse]] = [None] * len(items)
+
+    # 冪等鍵：記憶體索引命中直接回覆原結果；同一批內重複的鍵只處理第一筆
+    first_of: Dict[str, int] = {}
+    repeats: Dict[int, int] = {}
+    for i, key in enumerate(keys):
+        if key is None:
+            continue
+        if key in first_of:
+            repeats[i] = first_of[key]
+            continue
+        first_of[key] = i
+        known_id = signal_index.get(key)
+        if known_id is not None:
+            record = await db.get(SignalHistory, known_id)
+            if record is not None:
+                results[i] = _replay_signal(record)
+
+    configs = await get_strategy_configs_async(db, {s.strategy for s in items})
+
+    plans: Dict[int, _SignalPlan] = {}
+    try:
+        for _attempt in range(2):
+            # 出場先規劃，部位帳的預約量依送單順序計算
+            pending = sorted(
+                (i for i in range(len(items)) if results[i] is None and i not in repeats),
+                key=lambda i: items[i].signal.endswith("_entry"),
+            )
+            # 每次嘗試都在新的 transaction 重新加鎖（回滾會釋放 advisory lock）
+            shared = await _lock_positions(db, [items[i] for i in pending], configs)
+            plans = {}
+            for i in pending:
+                plans[i] = _plan_signal(items[i], configs.get(items[i].strategy), keys[i], shared)
+            for i, plan in plans.items():
+                traces[i].product = plan.record.actual_product or ""
+                traces[i].mark("strategy_resolved")
+                db.add(plan.record)
+            try:
+                await db.flush()
+                break
+            except IntegrityError:
+                # 其他 worker 已寫入同一個冪等鍵：整批回滾，改回覆原結果後重新規劃其餘訊號
+                await db.rollback()
+                for plan in plans.values():
+                    get_position_ledger().release(plan.reservation)
+                pending_keys = [keys[i] for i in pending if keys[i] is not None]
+                if not pending_keys:
+                    raise
+                existing = {
+                    r.idempotency_key: r
+                    for r in (await db.execute(
+                        select(SignalHistory).where(SignalHistory.idempotency_key.in_(pending_keys))
+                    )).scalars()
+                }
+                for i in pending:
+                    record = existing.get(keys[i])
+                    if record is not None:
+                        signal_index.remember(keys[i], record.id)
+                        results[i] = _replay_signal(record)
+        else:
+            raise HTTPException(status_code=409, detail="批次中的重複訊號尚未完成，請稍後重試")
+
+        # 委託記錄與訊號記錄同一個 transaction
+        orders = {}
+        for i, plan in plans.items():
+            if plan.order is None:
+                continue
+            try:
+                order_record, order_fields = _new_order_record(plan.order, source="signal")
+            except HTTPException as exc:
+                get_position_ledger().release(plan.reservation)
+                plan.record.status = "failed"
+                plan.record.error_message = exc.detail
+                continue
+            traces[i].mark("signal_persisted")
+            order_record.stage_timings = traces[i].timings()
+            db.add(order_record)
+            orders[i] = (order_record, order_fields)
+        await db.flush()
+
+        events = [("order", order_record.to_dict()) for order_record, _ in orders.values()]
+        events += [("signal", plan.record.to_dict()) for plan in plans.values()]
+        await db.commit()
+    except BaseException:
+        # 規劃或寫入中途失敗：已建立的預約量不會再綁定委託，全部釋放（release 可重複呼叫）
+        for plan in plans.values():
+            get_position_ledger().release(plan.reservation)
+        raise
+    for i in orders:
+        traces[i].mark("order_persisted")
+    for kind, data in events:
+        publish_event(kind, data)
+
+    for i, plan in plans.items():
+        if keys[i] is not None:
+            signal_index.remember(keys[i], plan.record.id)
+        if i in orders:
+            order_record = orders[i][0]
+            if plan.reservation is not None:
+                get_position_ledger().bind(plan.reservation, order_record.id)
+        elif plan.order is not None:
+            results[i] = SignalResponse(status="failed", signal_id=plan.record.id, message=plan.record.error_message)
+        else:
+            plan.response.signal_id = plan.record.id
+            results[i] = plan.response
+
+    # 出場 → 進場兩階段送出
+    phases = [
+        [
+            (order_record.id, order_fields, plans[i].record.id, traces[i])
+            for i, (order_record, order_fields) in orders.items()
+            if plans[i].is_entry == is_entry
+        ]
+        for is_entry in (False, True)
+    ]
+    # 分組送出會等出場委託的券商回應，交給 broker-phase 執行緒池，不阻塞 event loop
+    scheduled = schedule_orders_in_phases(phases)
+    if not wait:
+        for i in orders:
+            results[i] = _order_signal_response(plans[i].order, plans[i].record.id, "accepted")
+    else:
+        try:
+            futures = await _wait_order(scheduled, deadline - time.monotonic())
+        except asyncio.TimeoutError:
+            # 進場組尚未送出即已逾時：全部回覆 accepted，委託仍在背景依序送出
+            futures = {}
+        for i, (order_record, _) in orders.items():
+            plan = plans[i]
+            if order_record.id not in futures:
+                results[i] = _order_signal_response(plan.order, plan.record.id, "accepted")
+                continue
+            try:
+                order_id, _result = await _wait_order(futures[order_record.id], deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                results[i] = _order_signal_response(plan.order, plan.record.id, "accepted")
+            except UnitradeOutcomeUnknown:
+                results[i] = _order_signal_response(plan.order, plan.record.id, "unknown", message=_UNKNOWN_MESSAGE)
+            except Exception as exc:
+                results[i] = _order_signal_response(plan.order, plan.record.id, "failed", message=str(exc))
+            else:
+                results[i] = _order_signal_response(plan.order, plan.record.id, "ok", order_id=order_id)
+
+    for i, first in repeats.items():
+        results[i] = results[first]
+    for i, result in enumerate(results):
+        outcome = "replayed" if i in repeats or i not in plans else result.status
+        SIGNALS_TOTAL.inc(strategy=items[i].strategy, product=result.actual_product, outcome=outcome)
+    return results
 
 
 # ==================== 策略管理 API ====================
@@ -678,6 +1518,7 @@ def create_strategy(
     db.add(strategy)
     db.commit()
     db.refresh(strategy)
+    invalidate_strategy_cache()
     logger.info("Strategy created: %s", config.strategy_name)
     return strategy.to_dict()
 
@@ -702,6 +1543,7 @@ def update_strategy(
     strategy.updated_at = datetime.utcnow()
     db.commit()
     db.refresh(strategy)
+    invalidate_strategy_cache()
     logger.info("Strategy updated: %s", strategy_name)
     return strategy.to_dict()
 
@@ -720,6 +1562,7 @@ def delete_strategy(
 
     db.delete(strategy)
     db.commit()
+    invalidate_strategy_cache()
     logger.info("Strategy deleted: %s", strategy_name)
     return {"status": "ok", "message": f"已刪除策略: {strategy_name}"}
 
@@ -740,6 +1583,7 @@ def toggle_strategy(
     strategy.updated_at = datetime.utcnow()
     db.commit()
     db.refresh(strategy)
+    invalidate_strategy_cache()
     logger.info("Strategy toggled: %s enabled=%s", strategy_name, strategy.enabled)
     return strategy.to_dict()
 
@@ -747,27 +1591,54 @@ def toggle_strategy(
 # ==================== 訊號歷史 API ====================
 
 @app.get("/signals")
-def list_signals(
-    db: Session = Depends(get_db),
+async def list_signals(
+    response: Response,
+    db: AsyncSession = Depends(get_async_db),
     limit: int = 100,
     offset: int = 0,
     strategy: Optional[str] = None,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    status: Optional[str] = None,
+    symbol: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    fields: Optional[str] = None,
 ):
-    """列出訊號歷史"""
-    query = db.query(SignalHistory).order_by(SignalHistory.created_at.desc())
+    """列出訊號歷史（keyset 分頁；symbol 比對實際下單商品；fields 只回傳指定欄位）"""
+    names = list_fields(SignalHistory, fields, "created_at")
+    query = select(*list_columns(SignalHistory, names))
     if strategy:
         query = query.filter(SignalHistory.strategy_name == strategy)
-    signals = query.offset(offset).limit(min(limit, 1000)).all()
-    return [s.to_dict() for s in signals]
+    if status:
+        query = query.filter(SignalHistory.status == status)
+    if symbol:
+        query = query.filter(SignalHistory.actual_product == symbol)
+    rows = await _keyset_page(
+        db, query, SignalHistory, SignalHistory.created_at, response,
+        limit, offset, before_id, after_id, date_from, date_to,
+    )
+    return rows_response(names, rows, response)
+
+
+@app.get("/signals/changes")
+async def list_signal_changes(
+    db: AsyncSession = Depends(get_async_db),
+    since: Optional[str] = None,
+    limit: int = CHANGES_MAX_ROWS,
+    fields: Optional[str] = None,
+):
+    """回傳 since 游標（updated_at,id）之後新增或狀態變更的訊號；無變更回 204"""
+    return await _changes_since(db, SignalHistory, SignalHistory.updated_at, since, limit, fields)
 
 
 @app.get("/signals/{signal_id}")
-def get_signal(
+async def get_signal(
     signal_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
     """取得單一訊號記錄"""
-    signal = db.query(SignalHistory).filter(SignalHistory.id == signal_id).first()
+    signal = await db.get(SignalHistory, signal_id)
     if not signal:
         raise HTTPException(status_code=404, detail="未找到訊號記錄")
     return signal.to_dict()
@@ -775,87 +1646,140 @@ def get_signal(
 
 # ==================== Product Lookup Proxy ====================
 
-@app.get("/product-lookup/tw")
-async def product_lookup_tw():
-    """代理查詢台灣期交所保證金表"""
-    url = "https://messagebus.pfctrade.com:9998/futuremarginquery"
+async def _margin_table_response(source: str, request: Request) -> Response:
     try:
-        async with httpx.AsyncClient(verify=False, timeout=10.0) as client:
-            r = await client.get(url)
-            r.raise_for_status()
-            try:
-                data = r.json()
-                if isinstance(data, list):
-                    return data
-            except Exception:
-                pass
-            return _parse_margin_html(r.text)
+        table = await get_margin_table(source)
     except httpx.TimeoutException:
         raise HTTPException(status_code=504, detail="查詢逾時")
     except Exception as e:
         raise HTTPException(status_code=502, detail=f"查詢失敗: {str(e)}")
 
+    max_age = max(0, int(PRODUCT_LOOKUP_TTL - table.age))
+    headers = {
+        "ETag": table.etag,
+        "Cache-Control": f"public, max-age={max_age}, stale-while-revalidate={int(PRODUCT_LOOKUP_STALE_TTL)}",
+        "Last-Modified": table.fetched_wall.strftime("%a, %d %b %Y %H:%M:%S GMT"),
+    }
+    if table.etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    return Response(content=table.body, media_type="application/json", headers=headers)
 
-@app.get("/product-lookup/foreign")
-async def product_lookup_foreign():
-    """代理查詢海外期貨保證金表"""
-    url = "https://messagebus.pfctrade.com:9998/foreignfuturemarginquery"
+
+@app.get("/product-lookup/search")
+async def product_lookup_search(
+    q: str = "",
+    exchange: Optional[str] = None,
+    source: Optional[Literal["tw", "foreign"]] = None,
+    limit: int = 20,
+    offset: int = 0,
+):
+    """商品代號 / 名稱搜尋（策略編輯器自動完成用）
+
+    代號完全相同 → 代號前綴 → 名稱前綴 → 子字串依序排列；exchange 為完全比對。
+    保證金欄位已轉為數字，每筆附 source（tw / foreign）。
+    """
+    limit = max(1, min(limit, 100))
+    offset = max(0, offset)
     try:
-        async with httpx.AsyncClient(verify=False, timeout=10.0) as client:
-            r = await client.get(url)
-            r.raise_for_status()
-            try:
-                data = r.json()
-                if isinstance(data, list):
-                    return data
-            except Exception:
-                pass
-            return _parse_margin_html(r.text)
+        return await search_products(q, exchange, [source] if source else list(MARGIN_SOURCES), limit, offset)
     except httpx.TimeoutException:
         raise HTTPException(status_code=504, detail="查詢逾時")
     except Exception as e:
         raise HTTPException(status_code=502, detail=f"查詢失敗: {str(e)}")
 
 
+@app.get("/product-lookup/tw")
+async def product_lookup_tw(request: Request):
+    """代理查詢台灣期交所保證金表（快取，見 product_lookup）"""
+    return await _margin_table_response("tw", request)
+
+
+@app.get("/product-lookup/foreign")
+async def product_lookup_foreign(request: Request):
+    """代理查詢海外期貨保證金表（快取，見 product_lookup）"""
+    return await _margin_table_response("foreign", request)
+
+
 # ==================== 成交紀錄 API ====================
 
 @app.get("/trades")
-def list_trades(
-    db: Session = Depends(get_db),
+async def list_trades(
+    response: Response,
+    db: AsyncSession = Depends(get_async_db),
     limit: int = 100,
     offset: int = 0,
     product_id: Optional[str] = None,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    fields: Optional[str] = None,
 ):
-    """列出成交回報（來自 dtrade.on_match 推播）"""
-    query = db.query(TradeRecord).order_by(TradeRecord.created_at.desc())
+    """列出成交回報（來自 dtrade.on_match 推播，keyset 分頁；fields 只回傳指定欄位）"""
+    names = list_fields(TradeRecord, fields, "created_at")
+    query = select(*list_columns(TradeRecord, names))
     if product_id:
         query = query.filter(TradeRecord.product_id == product_id)
-    trades = query.offset(offset).limit(min(limit, 1000)).all()
-    return [t.to_dict() for t in trades]
+    rows = await _keyset_page(
+        db, query, TradeRecord, TradeRecord.created_at, response,
+        limit, offset, before_id, after_id, date_from, date_to,
+    )
+    return rows_response(names, rows, response)
+
+
+@app.get("/trades/changes")
+async def list_trade_changes(
+    db: AsyncSession = Depends(get_async_db),
+    since: Optional[str] = None,
+    limit: int = CHANGES_MAX_ROWS,
+    fields: Optional[str] = None,
+):
+    """回傳 since 游標（created_at,id）之後的新成交；成交記錄不會更新，無新成交回 204"""
+    return await _changes_since(db, TradeRecord, TradeRecord.created_at, since, limit, fields)
 
 
 @app.get("/order-replies")
-def list_order_replies(
-    db: Session = Depends(get_db),
+async def list_order_replies(
+    response: Response,
+    db: AsyncSession = Depends(get_async_db),
     limit: int = 100,
     offset: int = 0,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    status: Optional[str] = None,
+    strategy: Optional[str] = None,
+    symbol: Optional[str] = None,
+    source: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    fields: Optional[str] = None,
 ):
-    """列出有交易所回報狀態的委託（fill_status 已被 on_reply 更新）"""
-    orders = (
-        db.query(OrderHistory)
-        .filter(OrderHistory.fill_status.isnot(None))
-        .order_by(OrderHistory.updated_at.desc())
-        .offset(offset)
-        .limit(min(limit, 1000))
-        .all()
+    """列出有交易所回報狀態的委託（fill_status 已被 on_reply 更新，依 created_at keyset 分頁；
+    fields 只回傳指定欄位）。回報會持續更新 updated_at，不可作為分頁游標；輪詢狀態變更請用 /orders/changes"""
+    names = list_fields(OrderHistory, fields, "created_at")
+    query = select(*list_columns(OrderHistory, names)).filter(OrderHistory.fill_status.isnot(None))
+    if status:
+        query = query.filter(OrderHistory.status == status)
+    if strategy:
+        query = query.filter(OrderHistory.strategy == strategy)
+    if symbol:
+        query = query.filter(OrderHistory.symbol == symbol)
+    if source:
+        query = query.filter(OrderHistory.source == source)
+    rows = await _keyset_page(
+        db, query, OrderHistory, OrderHistory.created_at, response,
+        limit, offset, before_id, after_id, date_from, date_to,
     )
-    return [o.to_dict() for o in orders]
+    return rows_response(names, rows, response)
 
 
 @app.post("/history-sync")
-def history_sync():
-    """手動觸發向交易所查詢當日歷史委託與成交，補回程式重啟後遺漏的紀錄。"""
-    return trigger_history_sync()
+def history_sync(incremental: bool = False):
+    """手動觸發向交易所查詢當日歷史委託與成交，補回程式重啟後遺漏的紀錄。
+
+    incremental=true 時只從上次同步的高水位（最小在途委託）開始查詢。
+    """
+    return trigger_history_sync(incremental=incremental)
 
 
 @app.get("/scheduler-status")
@@ -870,6 +1794,7 @@ def scheduler_status():
         })
     return {
         "running": _scheduler.running,
+        "mode": broker_mode(),
         "jobs": jobs,
     }
 
@@ -904,6 +1829,10 @@ def get_margin():
     if not actno:
         raise HTTPException(status_code=500, detail="未設定 UNITRADE_ACTNO 環境變數")
 
+    return cached_account_query(("margin", actno, currency), lambda: _fetch_margin(api, actno, currency))
+
+
+def _fetch_margin(api, actno: str, currency: str) -> list:
     resp = api.daccount.get_margin(actno, currency)
     if resp is None or not getattr(resp, "ok", False):
         err = getattr(resp, "error", "") if resp else "no response"
@@ -969,6 +1898,10 @@ def get_positions():
     if not actno:
         raise HTTPException(status_code=500, detail="未設定 UNITRADE_ACTNO 環境變數")
 
+    return cached_account_query(("positions", actno), lambda: _fetch_positions(api, actno))
+
+
+def _fetch_positions(api, actno: str) -> list:
     # get_position 簽名：get_position(actno, groupid='', trader='')，無 currency 參數
     resp = api.daccount.get_position(actno)
     if resp is None or not getattr(resp, "ok", False):
@@ -1026,6 +1959,12 @@ def get_unliquidations():
     if not actno:
         raise HTTPException(status_code=500, detail="未設定 UNITRADE_ACTNO 環境變數")
 
+    return cached_account_query(
+        ("unliquidations", actno, currency), lambda: _fetch_unliquidations(api, actno, currency),
+    )
+
+
+def _fetch_unliquidations(api, actno: str, currency: str) -> list:
     resp = api.daccount.get_unliquidation(actno, currency)
     if resp is None or not getattr(resp, "ok", False):
         err = getattr(resp, "error", "") if resp else "no response"
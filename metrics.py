@@ -0,0 +1,260 @@
+"""延遲量測與 Prometheus /metrics（不依賴 prometheus_client）。
+
+訊號到成交的每個階段以 time.monotonic() 打點（OrderTrace），用來分辨慢是慢在
+DB、pydantic 驗證還是券商：
+
+    received → validated → strategy_resolved → signal_persisted → order_persisted
+             → broker_start → broker_end → reply → first_match
+
+- 各階段耗時（與前一階段的差）記入 histogram，並依 strategy / product 標記；
+  訊號與委託結果另有 counter（outcome 標記）。
+- 每筆委託的累計時間（ms，相對 received）寫入 order_history.stage_timings，
+  收盤後可直接以 SQL 分析長尾。reply / first_match 可能在閘道程序觸發，
+  以 received_at（epoch）換算，不依賴同一程序的 monotonic 時鐘。
+- 歷史同步（_sync_history）與帳務查詢（daccount.*）另有各自的 histogram。
+
+指標只存在本程序記憶體；多 worker 部署時 Prometheus 需逐一抓取。閘道模式下
+reply / first_match 的 histogram 記在閘道程序，/metrics 以 stage_timings 為準。
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+)
+SYNC_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+BATCH_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, object]) -> LabelValues:
+        return tuple(str(labels.get(n) or "") for n in self.labels)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value:g}")
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+        # label → [各 bucket 個數（非累計）..., +Inf 個數, sum]
+        self._values: Dict[LabelValues, list] = {}
+
+    def observe(self, seconds: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += seconds
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            items = [(key, list(series)) for key, series in self._values.items()]
+        for key, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series[:-1]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                bucket_labels = _format_labels(self.labels, key, 'le="%s"' % le)
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {series[-1]:.6f}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Gauge(_Metric):
+    """抓取時才呼叫 set_function 指定的函式取值（例如佇列深度）。"""
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text):
+        super().__init__(name, help_text)
+        self._function: Optional[Callable[[], float]] = None
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        self._function = function
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        if self._function is not None:
+            lines.append(f"{self.name} {self._function():g}")
+        return lines
+
+
+_registry: List[_Metric] = []
+
+
+def _register(metric):
+    _registry.append(metric)
+    return metric
+
+
+def render_metrics() -> str:
+    """Prometheus text exposition format 0.0.4。"""
+    lines: List[str] = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# ==================== 指標定義 ====================
+
+SIGNAL_STAGE_SECONDS = _register(Histogram(
+    "signal_stage_seconds",
+    "Time spent in each stage of the signal/order path (since the previous stage)",
+    ("stage", "strategy", "product"),
+))
+SIGNALS_TOTAL = _register(Counter(
+    "signals_total", "Signals processed by outcome", ("strategy", "product", "outcome"),
+))
+ORDERS_TOTAL = _register(Counter(
+    "orders_total", "Orders sent to the broker by outcome", ("source", "product", "outcome"),
+))
+BROKER_CALL_SECONDS = _register(Histogram(
+    "broker_order_call_seconds", "Duration of api.dtrade.order()", ("outcome",),
+))
+ACCOUNT_QUERY_SECONDS = _register(Histogram(
+    "account_query_seconds", "Duration of api.daccount queries", ("query", "outcome"),
+))
+HISTORY_SYNC_SECONDS = _register(Histogram(
+    "history_sync_seconds", "Duration of _sync_history runs", ("mode", "outcome"), SYNC_BUCKETS,
+))
+HISTORY_SYNC_PHASE_SECONDS = _register(Histogram(
+    "history_sync_phase_seconds", "Per-phase time inside _sync_history", ("phase",), SYNC_BUCKETS,
+))
+
+CALLBACK_QUEUE_DEPTH = _register(Gauge(
+    "callback_queue_depth", "Broker callbacks waiting for the write-behind writer",
+))
+CALLBACK_BATCH_SIZE = _register(Histogram(
+    "callback_batch_size", "Broker callbacks written per group commit", (), BATCH_BUCKETS,
+))
+CALLBACK_COMMIT_SECONDS = _register(Histogram(
+    "callback_commit_seconds", "Time to apply and commit one batch of broker callbacks",
+))
+CALLBACK_EVENT_LAG_SECONDS = _register(Histogram(
+    "callback_event_lag_seconds", "Time from broker callback to DB commit",
+))
+CALLBACK_EVENTS_DROPPED = _register(Counter(
+    "callback_events_dropped_total", "Broker callbacks not written (recovered by history sync)", ("kind",),
+))
+
+
+@contextmanager
+def timed(histogram: Histogram, **labels):
+    """量測區塊耗時；例外時 outcome="error"（若該 histogram 有 outcome 標記）。"""
+    started = time.monotonic()
+    outcome = "ok"
+    try:
+        yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        if "outcome" in histogram.labels:
+            labels.setdefault("outcome", outcome)
+        histogram.observe(time.monotonic() - started, **labels)
+
+
+# ==================== 訊號 / 委託打點 ====================
+
+class OrderTrace:
+    """單筆訊號 / 委託的階段時間點（同一程序內傳遞）。"""
+
+    __slots__ = ("started", "received_at", "marks", "strategy", "product")
+
+    def __init__(self, started: Optional[float] = None, strategy: str = "", product: str = ""):
+        now = time.monotonic()
+        self.started = started if started is not None else now
+        self.received_at = time.time() - (now - self.started)  # epoch，跨程序換算用
+        self.marks: Dict[str, float] = {"received": 0.0}
+        self.strategy = strategy
+        self.product = product
+
+    def mark(self, stage: str) -> None:
+        elapsed = time.monotonic() - self.started
+        previous = max(self.marks.values())
+        self.marks[stage] = elapsed
+        SIGNAL_STAGE_SECONDS.observe(
+            max(0.0, elapsed - previous), stage=stage, strategy=self.strategy, product=self.product,
+        )
+
+    def timings(self) -> dict:
+        """寫入 order_history.stage_timings 的格式：received_at（epoch）+ 各階段 ms。"""
+        result = {"received_at": round(self.received_at, 6)}
+        result.update({stage: round(sec * 1000, 3) for stage, sec in self.marks.items()})
+        return result
+
+
+def mark_stored_timings(
+    timings: Optional[dict], stage: str, after: str, strategy: str = "", product: str = "",
+    at: Optional[float] = None,
+) -> Optional[dict]:
+    """callback 端（可能在另一個程序）補記階段；已記錄過或沒有 received_at 時回 None。
+
+    at 為收到回報的 epoch 時間（write-behind 寫入時已晚於收到時間），預設為現在。
+    回傳新的 dict（JSON 欄位需整個重新指定才會寫回）；histogram 記錄與 after 階段的差。
+    """
+    if not timings or stage in timings or "received_at" not in timings:
+        return None
+    elapsed_ms = ((at or time.time()) - timings["received_at"]) * 1000
+    updated = dict(timings)
+    updated[stage] = round(elapsed_ms, 3)
+    if after in timings:
+        SIGNAL_STAGE_SECONDS.observe(
+            max(0.0, (elapsed_ms - timings[after]) / 1000), stage=stage, strategy=strategy, product=product,
+        )
+    return updated
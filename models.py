@@ -1,5 +1,5 @@
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, DateTime, Float, Enum, Boolean, Text, JSON
+from sqlalchemy import Column, Integer, String, DateTime, Float, Enum, Boolean, Text, JSON, Index, and_, func
 import enum
 
 from database import Base
@@ -53,7 +53,7 @@ class OrderHistory(Base):
     created_at = Column(DateTime, default=datetime.utcnow, index=True)
     
     # Order tracking fields (from Shioaji Trade object)
-    order_id = Column(String, nullable=True, index=True)  # Trade.order.id
+    order_id = Column(String, nullable=True)  # Trade.order.id
     seqno = Column(String, nullable=True)  # Trade.order.seqno
     ordno = Column(String, nullable=True)  # Trade.order.ordno
     
@@ -62,7 +62,62 @@ class OrderHistory(Base):
     fill_quantity = Column(Integer, nullable=True)  # Actual filled quantity
     fill_price = Column(Float, nullable=True)  # Average fill price
     cancel_quantity = Column(Integer, nullable=True)  # Cancelled quantity
-    updated_at = Column(DateTime, nullable=True)  # Last status update time
+    # on_match 累加器：成交口數與成交金額（價 × 量），fill_price = matched_notional / matched_qty
+    matched_qty = Column(Integer, nullable=True, default=0)
+    matched_notional = Column(Float, nullable=True, default=0)
+    updated_at = Column(DateTime, nullable=True, default=datetime.utcnow, onupdate=datetime.utcnow)  # Last status update time
+    idempotency_key = Column(String(64), nullable=True)  # /webhook 重送去重（見 idempotency.py）
+    # 各階段累計耗時（ms，相對 received_at epoch；見 metrics.py）
+    stage_timings = Column(JSON, nullable=True)
+
+    # 列表 keyset 分頁用複合索引（見 db/migrations/008_add_list_keyset_indexes.sql）
+    __table_args__ = (
+        Index("ix_order_history_created_id", created_at.desc(), id.desc()),
+        Index("ix_order_history_status_created_id", status, created_at.desc(), id.desc()),
+        Index("ix_order_history_strategy_created_id", strategy, created_at.desc(), id.desc()),
+        Index("ix_order_history_symbol_created_id", symbol, created_at.desc(), id.desc()),
+        Index("ix_order_history_source_created_id", source, created_at.desc(), id.desc()),
+        Index("ix_order_history_updated_id", updated_at, id),
+        # 券商回報 / 歷史同步以 order_id、ordno 找委託（見 012_add_callback_lookup_indexes.sql）
+        Index("ix_order_history_order_id_created", order_id, created_at),
+        Index(
+            "ix_order_history_ordno_created",
+            ordno,
+            created_at,
+            postgresql_where=ordno.isnot(None),
+        ),
+        Index(
+            "ix_order_history_strategy_positions",
+            strategy,
+            account,
+            symbol,
+            postgresql_include=["action", "matched_qty"],
+            postgresql_where=and_(strategy.isnot(None), matched_qty > 0),
+        ),
+        Index(
+            "ix_order_history_working_strategy",
+            strategy,
+            account,
+            symbol,
+            postgresql_include=["action", "quantity", "matched_qty"],
+            postgresql_where=and_(
+                strategy.isnot(None), status.in_(["pending", "submitted", "partial_filled", "unknown"]),
+            ),
+        ),
+        Index(
+            "ix_order_history_replies_created_id",
+            created_at.desc(),
+            id.desc(),
+            postgresql_where=fill_status.isnot(None),
+        ),
+        Index(
+            "ux_order_history_idempotency_key",
+            idempotency_key,
+            unique=True,
+            postgresql_where=idempotency_key.isnot(None),
+            sqlite_where=idempotency_key.isnot(None),
+        ),
+    )
 
     def to_dict(self):
         return {
@@ -89,6 +144,7 @@ class OrderHistory(Base):
             "fill_status": self.fill_status,
             "fill_quantity": self.fill_quantity,
             "fill_price": self.fill_price,
+            "matched_qty": self.matched_qty,
             "updated_at": self.updated_at.isoformat() if self.updated_at else None,
         }
 
@@ -187,9 +243,26 @@ class SignalHistory(Base):
     
     # 原始資料
     raw_payload = Column(JSON, nullable=True)
+    idempotency_key = Column(String(64), nullable=True)  # TradingView 重送去重（見 idempotency.py）
     
     # 時間戳記
     created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_signal_history_created_id", created_at.desc(), id.desc()),
+        Index("ix_signal_history_updated_id", updated_at, id),
+        Index("ix_signal_history_strategy_created_id", strategy_name, created_at.desc(), id.desc()),
+        Index("ix_signal_history_status_created_id", status, created_at.desc(), id.desc()),
+        Index("ix_signal_history_product_created_id", actual_product, created_at.desc(), id.desc()),
+        Index(
+            "ux_signal_history_idempotency_key",
+            idempotency_key,
+            unique=True,
+            postgresql_where=idempotency_key.isnot(None),
+            sqlite_where=idempotency_key.isnot(None),
+        ),
+    )
 
     def to_dict(self):
         return {
@@ -208,6 +281,7 @@ class SignalHistory(Base):
             "error_message": self.error_message,
             "raw_payload": self.raw_payload,
             "created_at": self.created_at.isoformat() if self.created_at else None,
+            "updated_at": self.updated_at.isoformat() if self.updated_at else None,
         }
 
 
@@ -241,6 +315,21 @@ class TradeRecord(Base):
 
     created_at = Column(DateTime, default=datetime.utcnow, index=True)
 
+    __table_args__ = (
+        # 成交去重鍵：同一委託的多筆部分成交共用 network_id，需搭配 matchseq / matchtime 區分
+        Index(
+            "ux_trade_records_fill_key",
+            network_id,
+            func.coalesce(match_seq, ""),
+            func.coalesce(match_time, ""),
+            unique=True,
+            postgresql_where=network_id.isnot(None),
+            sqlite_where=network_id.isnot(None),
+        ),
+        Index("ix_trade_records_created_id", created_at.desc(), id.desc()),
+        Index("ix_trade_records_product_created_id", product_id, created_at.desc(), id.desc()),
+    )
+
     def to_dict(self):
         return {
             "id": self.id,
@@ -260,3 +349,14 @@ class TradeRecord(Base):
             "mdate": self.mdate,
             "created_at": self.created_at.isoformat() if self.created_at else None,
         }
+
+
+class SyncWatermark(Base):
+    """歷史同步高水位 - 每個帳號一筆，供增量同步決定 query_reply/query_match 的起始序號"""
+    __tablename__ = "sync_watermark"
+
+    account = Column(String(50), primary_key=True)
+    resume_network_id = Column(String, nullable=True)  # 下次增量同步的起始 network_id（最小在途委託）
+    last_network_id = Column(String, nullable=True)    # 上次同步看到的最大 network_id
+    trade_date = Column(String(8), nullable=True)      # 券商交易日（tradedate），換日後改為完整同步
+    updated_at = Column(DateTime, default=datetime.utcnow)
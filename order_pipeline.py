@@ -0,0 +1,253 @@
+"""下單管線：專用的券商 I/O 執行緒池。
+
+HTTP handler 只負責在一個 transaction 內寫入 pending 委託，之後把阻塞的
+api.dtrade.order(...) 交給這裡的有界執行緒池處理，不再佔用 Starlette 的
+threadpool。呼叫端可立即回覆「已受理」，或在 timeout 內同步等待結果。
+
+- BROKER_IO_WORKERS：同時送往券商的委託數上限
+- BROKER_QUEUE_SIZE：排隊中 + 執行中的委託上限，超過即拒絕（503），避免爆量時無限堆積
+- ORDER_WAIT_TIMEOUT：同步等待的預設秒數，逾時即回覆 accepted，委託仍會在背景完成
+"""
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait as wait_futures
+from datetime import datetime
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+from unitrade.trade.ddata import DOrderObject
+
+from metrics import BROKER_CALL_SECONDS, ORDERS_TOTAL, OrderTrace
+
+from unitrade_client import (
+    UnitradeOrderError,
+    UnitradeOutcomeUnknown,
+    extract_order_id,
+    get_unitrade_client,
+    serialize_order_result,
+)
+
+logger = logging.getLogger(__name__)
+
+BROKER_IO_WORKERS = int(os.getenv("BROKER_IO_WORKERS", "4"))
+BROKER_QUEUE_SIZE = int(os.getenv("BROKER_QUEUE_SIZE", "64"))
+ORDER_WAIT_TIMEOUT = float(os.getenv("ORDER_WAIT_TIMEOUT", "10"))
+
+
+class OrderPipelineFull(RuntimeError):
+    pass
+
+
+_executor = ThreadPoolExecutor(max_workers=BROKER_IO_WORKERS, thread_name_prefix="broker-io")
+_slots = threading.BoundedSemaphore(BROKER_QUEUE_SIZE)
+# 批次訊號的分組送出會等待前一組的券商回應，另用小型執行緒池，不佔用 broker-io 執行緒
+_phase_executor = ThreadPoolExecutor(max_workers=BROKER_IO_WORKERS, thread_name_prefix="broker-phase")
+
+
+def submit_order(
+    order_record_id: int,
+    order_fields: dict,
+    signal_id: Optional[int] = None,
+    trace: Optional[OrderTrace] = None,
+) -> "Future[Tuple[str, Any]]":
+    """將已寫入 DB 的委託排入券商 I/O 執行緒池。
+
+    order_fields 為 DOrderObject 的欄位；回傳的 Future 完成時得到
+    (order_id, result)，失敗時拋出 UnitradeLoginError / UnitradeOrderError 等例外。
+    trace 會在送單前後打點，結果寫回時一併存入 stage_timings。
+    """
+    if not _slots.acquire(blocking=False):
+        raise OrderPipelineFull(f"下單佇列已滿（{BROKER_QUEUE_SIZE}），請稍後重試")
+    try:
+        future = _executor.submit(_execute_order, order_record_id, order_fields, signal_id, trace)
+    except Exception:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda _f: _slots.release())
+    return future
+
+
+def submit_orders_in_phases(
+    phases: Sequence[Sequence[Tuple[int, dict, Optional[int], Optional[OrderTrace]]]],
+    phase_timeout: Optional[float] = None,
+) -> Dict[int, "Future[Tuple[str, Any]]"]:
+    """依序送出多組委託（批次訊號：先出場、後進場）。
+
+    同一組內的委託一起排入執行緒池，並行數受 BROKER_IO_WORKERS 限制；前一組全部
+    得到券商回應（或 phase_timeout 逾時）後才送下一組。每筆為
+    (order_record_id, order_fields, signal_id, trace)；無法排入的委託（佇列已滿、
+    執行緒池已關閉）直接寫回 failed，回傳的 Future 帶該例外。
+    """
+    phase_timeout = ORDER_WAIT_TIMEOUT if phase_timeout is None else phase_timeout
+    futures: Dict[int, Future] = {}
+    previous: list = []
+    for phase in phases:
+        if not phase:
+            continue
+        if previous:
+            _, not_done = wait_futures(previous, timeout=phase_timeout)
+            if not_done:
+                logger.warning("%d orders still in flight after %.1f s, submitting next phase", len(not_done), phase_timeout)
+        previous = []
+        for order_record_id, order_fields, signal_id, trace in phase:
+            try:
+                future = submit_order(order_record_id, order_fields, signal_id=signal_id, trace=trace)
+            except Exception as exc:
+                _persist_outcome(
+                    order_record_id, signal_id, status="failed", error_message=str(exc),
+                    outcome="queue_full" if isinstance(exc, OrderPipelineFull) else "error",
+                )
+                future = Future()
+                future.set_exception(exc)
+            futures[order_record_id] = future
+            previous.append(future)
+    return futures
+
+
+def schedule_orders_in_phases(
+    phases: Sequence[Sequence[Tuple[int, dict, Optional[int], Optional[OrderTrace]]]],
+    phase_timeout: Optional[float] = None,
+) -> "Future[Dict[int, Future[Tuple[str, Any]]]]":
+    """在 broker-phase 執行緒池執行 submit_orders_in_phases，立即回傳；執行緒數有上限，超過的批次排隊。"""
+    return _phase_executor.submit(submit_orders_in_phases, phases, phase_timeout)
+
+
+def _execute_order(
+    order_record_id: int,
+    order_fields: dict,
+    signal_id: Optional[int],
+    trace: Optional[OrderTrace] = None,
+) -> Tuple[str, Any]:
+    """在 broker-io 執行緒中送單，並以單一 transaction 寫回委託與訊號結果。"""
+    trace = trace or OrderTrace(product=order_fields.get("productid", ""))
+    trace.mark("broker_start")
+    try:
+        api = get_unitrade_client()
+        result = api.dtrade.order(DOrderObject(**order_fields))
+    except UnitradeOutcomeUnknown as exc:
+        # 委託可能已送達券商：不可標記 failed（部位預約量保留），由歷史同步以委託內容認領
+        trace.mark("broker_end")
+        BROKER_CALL_SECONDS.observe(trace.marks["broker_end"] - trace.marks["broker_start"], outcome="unknown")
+        _persist_outcome(
+            order_record_id, signal_id, status="unknown",
+            error_message=str(exc), stage_timings=trace.timings(), outcome="unknown",
+        )
+        raise
+    except Exception as exc:
+        trace.mark("broker_end")
+        BROKER_CALL_SECONDS.observe(trace.marks["broker_end"] - trace.marks["broker_start"], outcome="error")
+        _persist_outcome(
+            order_record_id, signal_id, status="failed",
+            error_message=str(exc), stage_timings=trace.timings(), outcome="error",
+        )
+        raise
+    trace.mark("broker_end")
+    issend = getattr(result, "issend", True)
+    BROKER_CALL_SECONDS.observe(
+        trace.marks["broker_end"] - trace.marks["broker_start"], outcome="ok" if issend else "rejected",
+    )
+
+    # DOrderResponse: issend=False 表示本地端即拒絕（如帳號格式錯誤）
+    if not issend:
+        err_msg = getattr(result, "errormsg", None) or getattr(result, "errorcode", "下單失敗")
+        _persist_outcome(
+            order_record_id, signal_id, status="failed",
+            error_message=err_msg, order_result=serialize_order_result(result),
+            stage_timings=trace.timings(), outcome="rejected",
+        )
+        raise UnitradeOrderError(err_msg)
+
+    # seq 可能帶有尾端空白，需 strip
+    order_id = (getattr(result, "seq", None) or "").strip() or extract_order_id(result)
+    _persist_outcome(
+        order_record_id, signal_id, status="submitted",
+        order_id=order_id, order_result=serialize_order_result(result),
+        stage_timings=trace.timings(), outcome="ok",
+    )
+    return order_id, result
+
+
+def _persist_outcome(
+    order_record_id: int,
+    signal_id: Optional[int],
+    status: str,
+    order_id: Optional[str] = None,
+    order_result: Optional[str] = None,
+    error_message: Optional[str] = None,
+    stage_timings: Optional[dict] = None,
+    outcome: Optional[str] = None,
+) -> None:
+    """寫回送單結果。outcome 為 ORDERS_TOTAL 的標記（ok / rejected / error / queue_full / unknown），
+    依券商呼叫的實際結果決定，不受委託是否已由他處定案影響。"""
+    from database import SessionLocal
+    from event_stream import publish
+    from models import OrderHistory, SignalHistory
+
+    db = SessionLocal()
+    events = []
+    try:
+        order_record = db.get(OrderHistory, order_record_id)
+        if order_record is not None:
+            # 回報以 order_id 對應委託，而 order_id 在這裡才寫入，故此時 status 通常仍為 pending；
+            # 已由他處定案（例如 HTTP 端在佇列已滿時寫入 failed）的委託不覆寫。
+            # 早於此處 commit 到達的回報找不到委託，由歷史同步補齊狀態。
+            if order_record.status == "pending":
+                order_record.status = status
+            if order_id:
+                order_record.order_id = order_id
+            if order_result is not None:
+                order_record.order_result = order_result
+            if error_message is not None:
+                order_record.error_message = error_message
+            if stage_timings is not None:
+                _merge_stage_timings(db, order_record, stage_timings)
+            order_record.updated_at = datetime.utcnow()
+            db.flush()
+            events.append(("order", order_record.to_dict()))
+            ORDERS_TOTAL.inc(source=order_record.source, product=order_record.symbol, outcome=outcome or status)
+
+        if signal_id is not None:
+            signal_record = db.get(SignalHistory, signal_id)
+            if signal_record is not None:
+                signal_record.status = status if status in ("failed", "unknown") else "processed"
+                signal_record.order_id = order_id
+                if error_message is not None:
+                    signal_record.error_message = error_message
+                signal_record.updated_at = datetime.utcnow()
+                events.append(("signal", signal_record.to_dict()))
+        db.commit()
+        for kind, data in events:
+            publish(kind, data)
+    except Exception as exc:
+        logger.error("Order outcome persist error: record_id=%s %s", order_record_id, exc)
+        db.rollback()
+    finally:
+        db.close()
+
+
+def _merge_stage_timings(db, order_record, stage_timings: dict) -> None:
+    """把送單階段的時間併入 stage_timings，保留 on_reply / on_match 已補記的 reply / first_match。
+
+    PostgreSQL 上以 jsonb || 在 UPDATE 內合併，不依賴先前讀到的值；
+    其他資料庫（測試用 SQLite）退回程式端合併。
+    """
+    if db.bind.dialect.name == "postgresql":
+        from sqlalchemy import cast, func
+        from sqlalchemy.dialects.postgresql import JSONB
+
+        from models import OrderHistory
+
+        order_record.stage_timings = func.coalesce(
+            cast(OrderHistory.stage_timings, JSONB), cast({}, JSONB),
+        ).op("||")(cast(stage_timings, JSONB))
+    else:
+        order_record.stage_timings = {**(order_record.stage_timings or {}), **stage_timings}
+
+
+def shutdown_order_pipeline() -> None:
+    """等待執行中的委託完成後關閉執行緒池（lifespan 關閉時呼叫）。
+
+    先關閉 broker-phase：等待中的批次仍會把後續分組排入 broker-io，之後才能關閉 broker-io。
+    """
+    _phase_executor.shutdown(wait=True)
+    _executor.shutdown(wait=True)
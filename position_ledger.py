@@ -0,0 +1,505 @@
+"""程序內即時部位帳（StrategyConfig.max_position 檢查用）。
+
+api.daccount.get_position 是同步的券商往返，無法在每筆訊號上呼叫。這裡在記憶體
+維護兩層淨部位（多為正、空為負）：
+
+- 帳戶層 (account, product)：啟動時以 get_position 建立，之後由成交事件累加，
+  每 POSITION_RECONCILE_INTERVAL 秒再與 get_position 對帳一次。
+- 策略層 (account, product, strategy)：啟動時以 order_history 的 matched_qty
+  （買正賣負）加總建立，只保留券商仍有留倉的商品；之後由委託事件的
+  matched_qty 增量累加。
+
+另外對已送出、尚未成交的策略委託保留預約量（reservation），連續訊號在成交
+回報前也不會超過上限；委託終結（成交 / 取消 / 失敗）時釋放剩餘預約量。
+
+商品代碼一律以 contract_calendar.normalize_product 正規化後作為 key：券商
+PRODUCTID 可能補空白或帶 YYYYMM，與 order_history.symbol 的寫法不同。
+
+資料來源是事件匯流排（event_stream），閘道模式下 worker 透過事件轉發同樣能更新。
+
+多個 worker（WEB_CONCURRENCY > 1）時各自維護一份帳本，預約量只在單一 worker 內可見，
+其他 worker 的成交也要到下次對帳才會反映，不能作為上限檢查的依據。此時改以 DB 為準
+（shared_position_limits()）：訊號的 transaction 先以 pg_advisory_xact_lock 鎖定
+(account, strategy)，再由 order_history 讀取已成交淨部位與所有 worker 未成交的委託量
+（lock_shared_positions），委託寫入並 commit 後才釋放鎖，下一筆訊號必定看得到。
+記憶體帳本仍負責對帳、出場的帳戶層上限與 /positions/ledger。
+"""
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, Optional, Tuple
+
+from contract_calendar import normalize_product
+
+logger = logging.getLogger(__name__)
+
+POSITION_RECONCILE_INTERVAL = float(os.getenv("POSITION_RECONCILE_INTERVAL", "60"))
+POSITION_RESERVATION_TTL = float(os.getenv("POSITION_RESERVATION_TTL", "300"))
+POSITION_LIMITS_ENABLED = os.getenv("POSITION_LIMITS_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# 與 database.py 相同：uvicorn worker 數
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+
+_FINAL_STATUSES = {"filled", "cancelled", "failed"}
+# 尚未終結、剩餘口數仍可能成交的委託（unknown 可能已送達券商）
+_WORKING_STATUSES = ("pending", "submitted", "partial_filled", "unknown")
+
+AccountKey = Tuple[str, str]            # (account, product)
+StrategyKey = Tuple[str, str, str]      # (account, product, strategy)
+
+
+@dataclass
+class Reservation:
+    key: StrategyKey
+    qty: int                    # 有號數量：買正賣負
+    created_at: float
+    record_id: Optional[int] = None
+
+
+@dataclass
+class SharedPosition:
+    """DB 上的策略部位（lock_shared_positions）：已成交淨部位與未成交委託量（買正、賣負）。"""
+    filled: int = 0
+    buying: int = 0
+    selling: int = 0
+
+    def working(self, sign: int = 0) -> int:
+        if sign > 0:
+            return self.buying
+        if sign < 0:
+            return self.selling
+        return self.buying + self.selling
+
+    def add(self, qty: int) -> None:
+        if qty > 0:
+            self.buying += qty
+        else:
+            self.selling += qty
+
+
+@dataclass
+class SizingDecision:
+    allowed: int                # 可下單口數（0 = 拒絕）
+    position: int               # 目前策略淨部位（含預約量）
+    reason: Optional[str] = None
+
+
+class PositionLedger:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._accounts: Dict[AccountKey, int] = {}
+        self._strategies: Dict[StrategyKey, int] = {}
+        self._reservations: Dict[int, Reservation] = {}     # id(Reservation) → Reservation
+        self._by_record: Dict[int, Reservation] = {}
+        self._matched: Dict[int, int] = {}                   # order record id → 已計入的 matched_qty
+        self._discarded: Dict[StrategyKey, int] = {}         # 對帳時捨棄的歷史部位（券商已無留倉）
+        self._finished: set = set()                          # 綁定前就已終結的委託
+        self._fill_seq = 0                                   # 對帳期間是否有新成交
+        self.seeded_at: Optional[float] = None
+        self.reconciled_at: Optional[float] = None
+
+    # ── 查詢 ────────────────────────────────────────────────────────
+
+    def position(self, account: str, product: str, strategy: Optional[str] = None) -> int:
+        product = normalize_product(product)
+        if strategy is None:
+            return self._accounts.get((account, product), 0)
+        return self._strategies.get((account, product, strategy), 0)
+
+    def _working(self, key: Tuple[str, ...], sign: int = 0) -> int:
+        """未成交預約量；key 為 (account, product) 時合計所有策略。sign 非 0 時只計同方向的預約。"""
+        return sum(
+            r.qty for r in self._reservations.values()
+            if r.key[:len(key)] == key and (sign == 0 or r.qty * sign > 0)
+        )
+
+    def size_order(
+        self,
+        account: str,
+        product: str,
+        strategy: str,
+        bs: str,
+        qty: int,
+        is_entry: bool,
+        max_position: Optional[int],
+        shared: Optional[Dict[StrategyKey, SharedPosition]] = None,
+    ) -> Tuple[SizingDecision, Optional[Reservation]]:
+        """檢查並預約一筆策略委託；回傳 (決策, 預約)。allowed 為 0 時不會建立預約。
+
+        進場：|部位 + 預約 + 本筆| 不得超過 max_position，超過則截量。
+        出場：只能平掉同方向的既有部位（含已預約的出場），超過則截量。策略層
+        沒有這個商品的紀錄（例如部位在啟用本系統前建立）時改以帳戶層部位為上限，
+        帳戶層也查無資料則放行。
+
+        shared 為 lock_shared_positions 的結果時，策略部位與未成交量改用 DB 上的值
+        （出場不再以帳戶層部位截量），並把本筆預約量加入，同一個 transaction 的後續
+        訊號（批次）會一併計入。
+        """
+        product = normalize_product(product)
+        key = (account, product, strategy)
+        sign = 1 if bs == "B" else -1
+        with self._lock:
+            if shared is not None:
+                view = shared.setdefault(key, SharedPosition())
+                filled, known, working = view.filled, view.filled != 0, view.working
+            else:
+                view = None
+                filled, known = self._strategies.get(key, 0), key in self._strategies
+                working = lambda s=0: self._working(key, s)  # noqa: E731
+            current = filled + working()
+            if is_entry:
+                limit = max_position if max_position and max_position > 0 else None
+                # 同方向加碼可用 limit - |部位|；反方向部位時最多翻到另一側的 limit
+                room = qty if limit is None else max(0, limit - sign * current)
+                allowed = min(qty, room)
+                reason = None if allowed == qty else f"超過最大持倉 {limit} 口（目前 {current}）"
+            elif self.seeded_at is None:
+                # 尚未與券商對帳成功：不知道實際部位，出場一律放行，避免無法平倉
+                allowed, reason = qty, None
+            else:
+                # 出場方向與既有部位相反：賣出平多單、買進平空單。
+                # 只計已成交部位，並扣掉已送出但未成交的同方向出場單
+                account_key = (account, product)
+                account_held = self._accounts.get(account_key)
+                if account_held is not None:
+                    account_held = max(0, -sign * (account_held + self._working(account_key, sign)))
+                if known:
+                    current = filled + working(sign)
+                    held = max(0, -sign * current)
+                    # 帳戶層只含本 worker 收到的成交；以 DB 為準時不拿它限制策略部位
+                    if account_held is not None and view is None:
+                        held = min(held, account_held)
+                    allowed = min(qty, held)
+                    reason = None if allowed == qty else f"可平倉 {held} 口（策略部位 {filled}）"
+                elif account_held is not None:
+                    allowed = min(qty, account_held)
+                    reason = None if allowed == qty else f"可平倉 {account_held} 口（無策略部位，依帳戶部位）"
+                else:
+                    allowed, reason = qty, None
+            if allowed <= 0:
+                return SizingDecision(0, current, reason), None
+            reservation = Reservation(key, sign * allowed, time.monotonic())
+            self._reservations[id(reservation)] = reservation
+            if view is not None:
+                view.add(reservation.qty)
+            return SizingDecision(allowed, current, reason), reservation
+
+    # ── 預約量 ──────────────────────────────────────────────────────
+
+    def bind(self, reservation: Reservation, record_id: int) -> None:
+        """綁定委託記錄 id；綁定前已收到的成交先從預約量扣除。"""
+        with self._lock:
+            if id(reservation) not in self._reservations:
+                return
+            if record_id in self._finished:
+                self._drop(reservation)
+                return
+            reservation.record_id = record_id
+            self._by_record[record_id] = reservation
+            self._consume(reservation, self._matched.get(record_id, 0))
+
+    def release(self, reservation: Optional[Reservation]) -> None:
+        if reservation is None:
+            return
+        with self._lock:
+            self._drop(reservation)
+
+    def _drop(self, reservation: Reservation) -> None:
+        self._reservations.pop(id(reservation), None)
+        if reservation.record_id is not None:
+            self._by_record.pop(reservation.record_id, None)
+
+    def _consume(self, reservation: Reservation, filled: int) -> None:
+        sign = 1 if reservation.qty > 0 else -1
+        remaining = abs(reservation.qty) - filled
+        if remaining <= 0:
+            self._drop(reservation)
+        else:
+            reservation.qty = sign * remaining
+
+    # ── 事件 ────────────────────────────────────────────────────────
+
+    def on_event(self, event: dict) -> None:
+        kind = event.get("type")
+        data = event.get("data") or {}
+        if kind == "order":
+            self._on_order(data)
+        elif kind == "fill" and not data.get("seq"):
+            # 未關聯到本系統委託的成交（例如券商端手動下單）只影響帳戶層
+            qty = int(data.get("match_qty") or 0)
+            sign = 1 if data.get("bs") == "B" else -1
+            if qty and data.get("product_id"):
+                with self._lock:
+                    key = (data.get("account") or "", normalize_product(data["product_id"]))
+                    self._accounts[key] = self._accounts.get(key, 0) + sign * qty
+                    self._fill_seq += 1
+
+    def _on_order(self, order: dict) -> None:
+        record_id = order.get("id")
+        if record_id is None:
+            return
+        matched = int(order.get("matched_qty") or 0)
+        with self._lock:
+            delta = matched - self._matched.get(record_id, 0)
+            if delta > 0:
+                self._matched[record_id] = matched
+                sign = 1 if order.get("action") == "B" else -1
+                account, product = order.get("account") or "", normalize_product(order.get("symbol") or "")
+                self._accounts[(account, product)] = self._accounts.get((account, product), 0) + sign * delta
+                if order.get("strategy"):
+                    key = (account, product, order["strategy"])
+                    self._strategies[key] = self._strategies.get(key, 0) + sign * delta
+                self._fill_seq += 1
+                reservation = self._by_record.get(record_id)
+                if reservation is not None:
+                    self._consume(reservation, delta)
+            if order.get("status") in _FINAL_STATUSES:
+                reservation = self._by_record.get(record_id)
+                if reservation is not None:
+                    self._drop(reservation)
+                elif order.get("strategy"):
+                    self._finished.add(record_id)
+
+    # ── 建立 / 對帳 ────────────────────────────────────────────────
+
+    def fill_seq(self) -> int:
+        return self._fill_seq
+
+    def load(
+        self,
+        accounts: Dict[AccountKey, int],
+        strategies: Dict[StrategyKey, int],
+        fill_seq: int,
+        discarded: Optional[Dict[StrategyKey, int]] = None,
+    ) -> bool:
+        """以券商 / DB 快照取代帳本；快照期間有新成交則放棄（下一輪再對帳）。
+
+        discarded 為 order_history 中因券商已無留倉而捨棄的歷史部位，
+        lock_shared_positions 以同樣的量扣除，兩邊的策略部位一致。
+        """
+        with self._lock:
+            if fill_seq != self._fill_seq:
+                return False
+            drift = {
+                k: (self._accounts.get(k, 0), v)
+                for k, v in accounts.items() if self._accounts.get(k, 0) != v
+            }
+            if drift and self.seeded_at is not None:
+                logger.warning("Position ledger drift corrected: %s", drift)
+            self._accounts = dict(accounts)
+            self._strategies = dict(strategies)
+            self._discarded = dict(discarded or {})
+            self._finished.clear()
+            now = time.monotonic()
+            for reservation in list(self._reservations.values()):
+                if now - reservation.created_at > POSITION_RESERVATION_TTL:
+                    self._drop(reservation)
+            if self.seeded_at is None:
+                self.seeded_at = now
+            self.reconciled_at = now
+            return True
+
+    def discarded(self, key: StrategyKey) -> int:
+        with self._lock:
+            return self._discarded.get(key, 0)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "seeded": self.seeded_at is not None,
+                "reconciled_ago_s": round(time.monotonic() - self.reconciled_at, 1) if self.reconciled_at else None,
+                "accounts": [
+                    {"account": a, "product": p, "position": q}
+                    for (a, p), q in sorted(self._accounts.items()) if q
+                ],
+                "strategies": [
+                    {
+                        "account": key[0], "product": key[1], "strategy": key[2],
+                        "position": self._strategies.get(key, 0), "working": self._working(key),
+                    }
+                    for key in sorted(set(self._strategies) | {r.key for r in self._reservations.values()})
+                    if self._strategies.get(key, 0) or self._working(key)
+                ],
+            }
+
+
+_ledger = PositionLedger()
+
+
+def get_position_ledger() -> PositionLedger:
+    return _ledger
+
+
+def _attr(obj, name: str):
+    value = getattr(obj, name, None)
+    return value if value is not None else getattr(obj, name.lower(), None)
+
+
+def _broker_positions(actno: str) -> Optional[Dict[AccountKey, int]]:
+    """以 get_position 取得帳戶層淨部位；查詢失敗回 None。"""
+    from metrics import ACCOUNT_QUERY_SECONDS, timed
+    from unitrade_client import get_unitrade_client
+
+    with timed(ACCOUNT_QUERY_SECONDS, query="ledger_position"):
+        resp = get_unitrade_client().daccount.get_position(actno)
+    if resp is None or not getattr(resp, "ok", False):
+        err = getattr(resp, "error", "") if resp else "no response"
+        if "查無資料" in str(err):
+            return {}
+        logger.warning("Position ledger: get_position failed: %s", err)
+        return None
+    raw = resp.data
+    items = raw if isinstance(raw, (list, tuple)) else ([raw] if raw is not None else [])
+    positions: Dict[AccountKey, int] = {}
+    for item in items:
+        product = _attr(item, "PRODUCTID")
+        if not product:
+            continue
+        buy = int(_attr(item, "CURRENT_BUY_OPEN_POSITION") or 0)
+        sell = int(_attr(item, "CURRENT_SELL_OPEN_POSITION") or 0)
+        key = (actno, normalize_product(str(product)))
+        positions[key] = positions.get(key, 0) + buy - sell
+    return positions
+
+
+def _strategy_positions(held: Dict[AccountKey, int]) -> Tuple[Dict[StrategyKey, int], Dict[StrategyKey, int]]:
+    """以 order_history 的 matched_qty 加總策略部位，只保留券商仍有留倉的商品。
+
+    回傳 (策略部位, 捨棄的歷史部位)。
+    """
+    from sqlalchemy import case, func
+
+    from database import SessionLocal
+    from models import OrderHistory
+
+    db = SessionLocal()
+    try:
+        signed = case((OrderHistory.action == "B", OrderHistory.matched_qty), else_=-OrderHistory.matched_qty)
+        rows = (
+            db.query(OrderHistory.account, OrderHistory.symbol, OrderHistory.strategy, func.sum(signed))
+            .filter(OrderHistory.strategy.isnot(None), OrderHistory.matched_qty > 0)
+            .group_by(OrderHistory.account, OrderHistory.symbol, OrderHistory.strategy)
+            .all()
+        )
+    finally:
+        db.close()
+    # 同一商品可能以不同寫法存入 symbol，正規化後再合計
+    positions: Dict[StrategyKey, int] = {}
+    for account, symbol, strategy, net in rows:
+        key = (account or "", normalize_product(symbol), strategy)
+        positions[key] = positions.get(key, 0) + int(net or 0)
+    kept = {key: net for key, net in positions.items() if net and held.get(key[:2], 0) != 0}
+    discarded = {key: net for key, net in positions.items() if net and key not in kept}
+    return kept, discarded
+
+
+def shared_position_limits() -> bool:
+    """多個 worker 時上限檢查改以 DB 為準（lock_shared_positions）。"""
+    return POSITION_LIMITS_ENABLED and WEB_CONCURRENCY > 1
+
+
+async def lock_shared_positions(db, pairs: Iterable[Tuple[str, str]]) -> Dict[StrategyKey, SharedPosition]:
+    """鎖定 (account, strategy) 並由 order_history 讀取策略部位與未成交委託量。
+
+    PostgreSQL 以 pg_advisory_xact_lock 鎖定，鎖在 transaction 結束（commit / rollback）時
+    釋放，呼叫端須在同一個 transaction 寫入委託；依排序後的順序加鎖，批次之間不會死結。
+    其他資料庫沒有 advisory lock，只讀取不鎖定（啟動時已警告）。
+    """
+    from sqlalchemy import case, func, select
+
+    from models import OrderHistory
+
+    pairs = sorted(set(pairs))
+    if not pairs:
+        return {}
+    if db.bind.dialect.name == "postgresql":
+        for account, strategy in pairs:
+            await db.execute(select(func.pg_advisory_xact_lock(func.hashtext(f"position:{account}:{strategy}"))))
+
+    strategies = {strategy for _, strategy in pairs}
+    signed = case((OrderHistory.action == "B", OrderHistory.matched_qty), else_=-OrderHistory.matched_qty)
+    filled = await db.execute(
+        select(OrderHistory.account, OrderHistory.symbol, OrderHistory.strategy, func.sum(signed))
+        .where(OrderHistory.strategy.in_(strategies), OrderHistory.matched_qty > 0)
+        .group_by(OrderHistory.account, OrderHistory.symbol, OrderHistory.strategy)
+    )
+    working = await db.execute(
+        select(
+            OrderHistory.account, OrderHistory.symbol, OrderHistory.strategy, OrderHistory.action,
+            func.sum(OrderHistory.quantity - func.coalesce(OrderHistory.matched_qty, 0)),
+        )
+        .where(OrderHistory.strategy.in_(strategies), OrderHistory.status.in_(_WORKING_STATUSES))
+        .group_by(OrderHistory.account, OrderHistory.symbol, OrderHistory.strategy, OrderHistory.action)
+    )
+
+    wanted = set(pairs)
+    positions: Dict[StrategyKey, SharedPosition] = {}
+    for account, symbol, strategy, net in filled:
+        if (account or "", strategy) in wanted:
+            key = (account or "", normalize_product(symbol), strategy)
+            positions.setdefault(key, SharedPosition()).filled += int(net or 0)
+    for account, symbol, strategy, action, remaining in working:
+        if (account or "", strategy) in wanted and remaining and remaining > 0:
+            key = (account or "", normalize_product(symbol), strategy)
+            positions.setdefault(key, SharedPosition()).add(int(remaining) if action == "B" else -int(remaining))
+    # 與記憶體帳本一致：扣掉對帳時因券商已無留倉而捨棄的歷史部位
+    for key, view in positions.items():
+        view.filled -= _ledger.discarded(key)
+    return positions
+
+
+def reconcile_positions() -> bool:
+    """與券商對帳並重建帳本（啟動時與定期執行）。"""
+    actno = os.getenv("UNITRADE_ACTNO", "")
+    if not actno:
+        return False
+    seq = _ledger.fill_seq()
+    try:
+        accounts = _broker_positions(actno)
+        if accounts is None:
+            return False
+        strategies, discarded = _strategy_positions(accounts)
+    except Exception as exc:
+        logger.warning("Position ledger reconcile failed: %s", exc)
+        return False
+    if not _ledger.load(accounts, strategies, seq, discarded):
+        logger.info("Position ledger reconcile skipped: fills arrived during snapshot")
+        return False
+    logger.info("Position ledger reconciled: %d products, %d strategy positions", len(accounts), len(strategies))
+    return True
+
+
+_stop = threading.Event()
+_thread: Optional[threading.Thread] = None
+
+
+def _reconcile_loop() -> None:
+    while not _stop.is_set():
+        reconcile_positions()
+        _stop.wait(POSITION_RECONCILE_INTERVAL)
+
+
+def start_position_ledger() -> None:
+    """訂閱事件並啟動背景對帳執行緒（第一次對帳即為啟動時的建立）。"""
+    global _thread
+    from database import engine
+    from event_stream import get_event_bus
+
+    if shared_position_limits() and engine.dialect.name != "postgresql":
+        logger.error(
+            "WEB_CONCURRENCY=%d but %s has no advisory locks: max_position is checked against "
+            "order_history without locking, concurrent signals on different workers can exceed it",
+            WEB_CONCURRENCY, engine.dialect.name,
+        )
+
+    get_event_bus().add_listener(_ledger.on_event)
+    if _thread is None or not _thread.is_alive():
+        _stop.clear()
+        _thread = threading.Thread(target=_reconcile_loop, name="position-reconcile", daemon=True)
+        _thread.start()
+
+
+def stop_position_ledger() -> None:
+    _stop.set()
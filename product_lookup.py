@@ -0,0 +1,308 @@
+"""pfctrade 保證金表代理快取（/product-lookup/tw、/product-lookup/foreign）。
+
+保證金表一天最多更新一次，卻在每次開啟策略編輯器 / 儀表板時整表重抓並重新
+解析 HTML。這裡以共用的連線池 httpx client 抓取，解析結果連同序列化好的
+JSON 與 ETag 一起快取：
+
+- PRODUCT_LOOKUP_TTL 秒內直接回快取（fresh）。
+- 超過 TTL 但未超過 PRODUCT_LOOKUP_STALE_TTL：立即回舊資料，背景重新抓取
+  （stale-while-revalidate）。
+- 同一來源同時間只會有一個上游請求，並行的呼叫共用同一個 task（request coalescing）。
+- 上游逾時或失敗時，只要曾經抓到過資料就回舊資料（stale-if-error），
+  並在 PRODUCT_LOOKUP_RETRY 秒內不再重試，避免上游異常時每個請求都卡 10 秒。
+
+每次刷新同時建立 ProductIndex（保證金欄位轉為數字、code/name 預先小寫），
+供 /product-lookup/search 自動完成使用，不必把整張表送到前端再過濾。
+"""
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+PRODUCT_LOOKUP_TTL = float(os.getenv("PRODUCT_LOOKUP_TTL", "3600"))
+PRODUCT_LOOKUP_STALE_TTL = float(os.getenv("PRODUCT_LOOKUP_STALE_TTL", "86400"))
+PRODUCT_LOOKUP_RETRY = float(os.getenv("PRODUCT_LOOKUP_RETRY", "30"))
+PRODUCT_LOOKUP_TIMEOUT = float(os.getenv("PRODUCT_LOOKUP_TIMEOUT", "10"))
+
+MARGIN_SOURCES = {
+    "tw": "https://messagebus.pfctrade.com:9998/futuremarginquery",
+    "foreign": "https://messagebus.pfctrade.com:9998/foreignfuturemarginquery",
+}
+
+
+# 非數值欄位；其餘欄位（各種保證金）若可解析則轉為數字
+_TEXT_FIELDS = {"exchange", "code", "name", "currency"}
+
+
+def _to_number(value: Any) -> Any:
+    """"12,345" → 12345、"1,234.5" → 1234.5；無法解析時原樣回傳。"""
+    if not isinstance(value, str):
+        return value
+    text = value.replace(",", "").strip()
+    if not text:
+        return None
+    try:
+        number = float(text)
+    except ValueError:
+        return value
+    return int(number) if number.is_integer() else number
+
+
+class ProductIndex:
+    """單一保證金表的查詢索引（刷新時建立一次，之後唯讀）。
+
+    - 代號前綴：依小寫 code 排序後以 bisect 取區間，O(log n)
+    - 代號 / 名稱子字串：掃描預先小寫的 code / name
+    - 交易所：完全比對（不分大小寫）
+    """
+
+    def __init__(self, rows: List[dict], source: str):
+        self.items: List[dict] = []
+        for row in rows:
+            item = {k: (v if k in _TEXT_FIELDS else _to_number(v)) for k, v in row.items()}
+            item["source"] = source
+            self.items.append(item)
+        self._codes = [str(i.get("code") or "").lower() for i in self.items]
+        self._names = [str(i.get("name") or "").lower() for i in self.items]
+        self._exchanges = [str(i.get("exchange") or "").lower() for i in self.items]
+        self._by_code = sorted(range(len(self.items)), key=lambda i: self._codes[i])
+        self._sorted_codes = [self._codes[i] for i in self._by_code]
+
+    def match(self, q: str, exchange: Optional[str] = None) -> List[Tuple[int, str, dict]]:
+        """回傳 (rank, code, item)；rank 0=代號完全相同、1=代號前綴、2=名稱前綴、3=子字串。"""
+        q = q.lower()
+        exchange = exchange.lower() if exchange else None
+
+        def _wanted(i: int) -> bool:
+            return exchange is None or self._exchanges[i] == exchange
+
+        if not q:
+            return [(0, self._codes[i], self.items[i]) for i in self._by_code if _wanted(i)]
+
+        lo = bisect.bisect_left(self._sorted_codes, q)
+        hi = bisect.bisect_left(self._sorted_codes, q + "\uffff")
+        prefix = self._by_code[lo:hi]
+        results = [
+            (0 if self._codes[i] == q else 1, self._codes[i], self.items[i])
+            for i in prefix if _wanted(i)
+        ]
+        skip = set(prefix)
+        for i, (code, name) in enumerate(zip(self._codes, self._names)):
+            if i in skip or not (q in code or q in name) or not _wanted(i):
+                continue
+            results.append((2 if name.startswith(q) else 3, code, self.items[i]))
+        return results
+
+
+@dataclass
+class MarginTable:
+    rows: List[dict]
+    body: bytes           # 預先序列化的 JSON，回應時不必每次 dumps
+    etag: str
+    fetched_at: float     # monotonic
+    fetched_wall: datetime
+    index: ProductIndex
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.fetched_at
+
+
+@dataclass
+class _Entry:
+    table: Optional[MarginTable] = None
+    inflight: Optional["asyncio.Task"] = None
+    failed_at: float = field(default=float("-inf"))
+
+
+_entries: Dict[str, _Entry] = {source: _Entry() for source in MARGIN_SOURCES}
+_client: Optional[httpx.AsyncClient] = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            verify=False,
+            timeout=PRODUCT_LOOKUP_TIMEOUT,
+            limits=httpx.Limits(max_connections=4, max_keepalive_connections=2),
+        )
+    return _client
+
+
+async def close_product_lookup_client() -> None:
+    """關閉共用 client 並取消進行中的抓取（lifespan 關閉時呼叫）。"""
+    global _client
+    for entry in _entries.values():
+        if entry.inflight is not None and not entry.inflight.done():
+            entry.inflight.cancel()
+        entry.inflight = None
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def _parse_margin_html(html_text: str) -> list:
+    """Parse pfctrade margin HTML table into list of dicts."""
+    from html.parser import HTMLParser
+
+    class _TblParser(HTMLParser):
+        def __init__(self):
+            super().__init__()
+            self.rows = []
+            self._row = None
+            self._cell = None
+
+        def handle_starttag(self, tag, attrs):
+            if tag == "tr":
+                self._row = []
+            elif tag in ("td", "th") and self._row is not None:
+                self._cell = ""
+
+        def handle_endtag(self, tag):
+            if tag in ("td", "th") and self._cell is not None:
+                self._row.append(self._cell.strip())
+                self._cell = None
+            elif tag == "tr" and self._row is not None:
+                if any(c for c in self._row):
+                    self.rows.append(self._row)
+                self._row = None
+
+        def handle_data(self, data):
+            if self._cell is not None:
+                self._cell += data
+
+    parser = _TblParser()
+    parser.feed(html_text)
+    if len(parser.rows) < 2:
+        return []
+    HEADER_MAP = {
+        "交易所": "exchange",
+        "商品代號": "code",
+        "商品名稱": "name",
+        "原始保證金": "original_margin",
+        "維持保證金": "maintenance_margin",
+        "幣別": "currency",
+    }
+    headers = [HEADER_MAP.get(h, h) for h in parser.rows[0]]
+    return [
+        {headers[i]: row[i] for i in range(len(headers))}
+        for row in parser.rows[1:]
+        if len(row) >= len(headers)
+    ]
+
+
+def _build_table(text: str, source: str) -> MarginTable:
+    """解析上游回應（JSON 或 HTML 表格）並預先序列化；在 worker thread 執行。"""
+    rows = None
+    try:
+        data = json.loads(text)
+        if isinstance(data, list):
+            rows = data
+    except ValueError:
+        pass
+    if rows is None:
+        rows = _parse_margin_html(text)
+    body = json.dumps(rows, ensure_ascii=False).encode()
+    etag = '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+    return MarginTable(rows, body, etag, time.monotonic(), datetime.utcnow(), ProductIndex(rows, source))
+
+
+async def _refresh(source: str) -> MarginTable:
+    entry = _entries[source]
+    started = time.monotonic()
+    try:
+        r = await _get_client().get(MARGIN_SOURCES[source])
+        r.raise_for_status()
+        table = await asyncio.to_thread(_build_table, r.text, source)
+    except Exception as exc:
+        entry.failed_at = time.monotonic()
+        logger.warning("Product lookup refresh failed: source=%s %s: %s", source, type(exc).__name__, exc)
+        raise
+    entry.table = table
+    logger.info(
+        "Product lookup refreshed: source=%s rows=%d in %.0f ms",
+        source, len(table.rows), (time.monotonic() - started) * 1000,
+    )
+    return table
+
+
+def _start_refresh(source: str) -> "asyncio.Task":
+    """回傳進行中的抓取 task；沒有才建立新的（同一來源的並行請求共用）。"""
+    entry = _entries[source]
+    if entry.inflight is None or entry.inflight.done():
+        task = asyncio.get_running_loop().create_task(_refresh(source))
+
+        def _done(t: "asyncio.Task") -> None:
+            if entry.inflight is t:
+                entry.inflight = None
+            if not t.cancelled():
+                t.exception()  # 背景刷新失敗已記錄，避免 "exception was never retrieved"
+
+        task.add_done_callback(_done)
+        entry.inflight = task
+    return entry.inflight
+
+
+async def get_margin_table(source: str) -> MarginTable:
+    """取得保證金表（fresh → 直接回；stale → 回舊資料並背景更新；無資料 → 等待抓取）。
+
+    上游失敗時若有舊資料一律回舊資料；完全沒有資料才拋出 httpx 例外。
+    """
+    entry = _entries[source]
+    table = entry.table
+    if table is not None:
+        age = table.age
+        if age < PRODUCT_LOOKUP_TTL:
+            return table
+        recently_failed = time.monotonic() - entry.failed_at < PRODUCT_LOOKUP_RETRY
+        if age < PRODUCT_LOOKUP_STALE_TTL or recently_failed:
+            if not recently_failed:
+                _start_refresh(source)
+            return table
+
+    try:
+        # shield：單一呼叫端斷線取消時不影響其他共用同一 task 的請求
+        return await asyncio.shield(_start_refresh(source))
+    except Exception:
+        if entry.table is not None:
+            logger.warning("Serving stale product lookup table: source=%s age=%.0fs", source, entry.table.age)
+            return entry.table
+        raise
+
+
+async def search_products(
+    q: str,
+    exchange: Optional[str] = None,
+    sources: Optional[List[str]] = None,
+    limit: int = 20,
+    offset: int = 0,
+) -> dict:
+    """跨保證金表搜尋商品，依相關度（完全 → 前綴 → 子字串）再依代號排序後分頁。
+
+    任一來源無法取得時略過該來源；全部失敗才拋出例外。
+    """
+    sources = sources or list(MARGIN_SOURCES)
+    tables = await asyncio.gather(*(get_margin_table(s) for s in sources), return_exceptions=True)
+    available = [t for t in tables if isinstance(t, MarginTable)]
+    if not available:
+        raise next(t for t in tables if isinstance(t, BaseException))
+
+    matches = []
+    for table in available:
+        matches.extend(table.index.match(q.strip(), exchange))
+    matches.sort(key=lambda m: (m[0], m[1]))
+    return {
+        "total": len(matches),
+        "items": [m[2] for m in matches[offset:offset + limit]],
+    }
@@ -0,0 +1,444 @@
+"""模擬券商（UNITRADE_BACKEND=sim）：程序內的 Unitrade SDK 替身。
+
+unitrade_client 與其他模組都假設背後是真的 unitrade.unitrade.Unitrade session，
+沒有正式帳號與網路就無法壓測或做效能分析。這裡實作本系統用到的 SDK 子集，
+介面與回傳物件的欄位名稱與 SDK 相同，下單 / 回報 / 帳務查詢走的是完全相同的程式路徑：
+
+- login / get_accounts
+- dtrade.order → 回傳 issend / seq；之後非同步觸發 on_reply、on_match
+- dtrade.query_reply / query_match（以 network_id 為游標分頁，與 _sync_history 相容）
+- daccount.get_margin / get_position / get_unliquidation（由模擬成交累計部位與損益）
+
+回報由單一 callback 執行緒依時間順序觸發（與 SDK 的 websocket 執行緒相同，同一委託的
+on_reply 一定早於 on_match）。延遲分佈、部分成交比例、拒單比例皆可由環境變數設定：
+
+    延遲格式：fixed:20 | uniform:10,50 | lognormal:<中位數>,<p99>（單位 ms，純數字視為 fixed）
+
+    SIM_ORDER_LATENCY      dtrade.order() 往返                 預設 lognormal:15,80
+    SIM_REPLY_LATENCY      dtrade.order() 返回 → on_reply      預設 lognormal:30,150
+    SIM_MATCH_LATENCY      on_reply → 每一筆 on_match          預設 lognormal:50,500
+    SIM_QUERY_LATENCY      daccount.* / query_*                預設 lognormal:80,400
+    SIM_LOCAL_REJECT_RATE  本地拒單（issend=False）比例         預設 0
+    SIM_REJECT_RATE        交易所拒單（on_reply 委託失敗）比例   預設 0.02
+    SIM_PARTIAL_FILL_RATE  分成多筆成交的比例（委託 >1 口）      預設 0.2
+    SIM_NO_FILL_RATE       委託成功但不成交的比例               預設 0
+    SIM_SEED               亂數種子（重現同一組情境）
+    SIM_BASE_PRICE         市價單的起始成交價                   預設 20000
+
+SIM_SEED 設定時每個元件各自以「種子 + 元件名稱」建立亂數產生器，不共用同一個序列：
+每筆委託的延遲、拒單與分筆成交由「種子 + 委託序號」決定，不受 broker-io 執行緒交錯
+或查詢次數影響；成交價與查詢延遲各有獨立的序列（成交價仍隨回報的先後而定）。
+
+get_position / get_unliquidation 的 PRODUCTID 與正式券商相同，為補空白的
+「基底 + YYYYMM」（TXFF6 → "TXF202606 "），與下單代碼不同，用來驗證比對端的正規化。
+
+狀態只存在本程序記憶體，重啟即清空；只用於壓測與離線測試，不可用於正式環境。
+"""
+import heapq
+import itertools
+import logging
+import math
+import os
+import random
+import threading
+import time
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SIM_ORDER_LATENCY = os.getenv("SIM_ORDER_LATENCY", "lognormal:15,80")
+SIM_REPLY_LATENCY = os.getenv("SIM_REPLY_LATENCY", "lognormal:30,150")
+SIM_MATCH_LATENCY = os.getenv("SIM_MATCH_LATENCY", "lognormal:50,500")
+SIM_QUERY_LATENCY = os.getenv("SIM_QUERY_LATENCY", "lognormal:80,400")
+SIM_LOCAL_REJECT_RATE = float(os.getenv("SIM_LOCAL_REJECT_RATE", "0"))
+SIM_REJECT_RATE = float(os.getenv("SIM_REJECT_RATE", "0.02"))
+SIM_PARTIAL_FILL_RATE = float(os.getenv("SIM_PARTIAL_FILL_RATE", "0.2"))
+SIM_NO_FILL_RATE = float(os.getenv("SIM_NO_FILL_RATE", "0"))
+SIM_SEED = os.getenv("SIM_SEED")
+SIM_BASE_PRICE = float(os.getenv("SIM_BASE_PRICE", "20000"))
+
+SIM_SERVER = "sim://local"
+_INITIAL_EQUITY = 1_000_000.0
+_MARGIN_PER_LOT = 80_000.0
+_POINT_VALUE = 50.0           # 每點價值（以小台為準）
+_Z99 = 2.326                  # 標準常態 p99
+
+
+def _component_rng(*key) -> random.Random:
+    """元件專用的亂數產生器；未設定 SIM_SEED 時不可重現。"""
+    if SIM_SEED is None:
+        return random.Random()
+    return random.Random(":".join(str(k) for k in (SIM_SEED,) + key))
+
+
+def _broker_product_id(productid: str) -> str:
+    """下單代碼 → 券商帳務查詢的 PRODUCTID（TXFF6 → "TXF202606 "），非月份代碼者原樣補空白。"""
+    code = productid.strip()
+    if len(code) >= 3 and "A" <= code[-2] <= "L" and code[-1].isdigit():
+        this_year = datetime.now().year
+        year = this_year - this_year % 10 + int(code[-1])
+        if year < this_year - 1:
+            year += 10
+        code = f"{code[:-2]}{year}{ord(code[-2]) - ord('A') + 1:02d}"
+    return code.ljust(10)
+
+
+class LatencyDistribution:
+    """延遲分佈（規格字串見模組說明），sample() 回傳秒數；可傳入委託專用的 rng。"""
+
+    def __init__(self, spec: str, rng: random.Random):
+        self.spec = spec
+        self._rng = rng
+        kind, _, params = spec.strip().partition(":")
+        if not params:
+            kind, params = "fixed", kind
+        try:
+            values = [float(v) / 1000 for v in params.split(",")]
+        except ValueError:
+            raise ValueError(f"invalid latency spec: {spec!r}") from None
+        if kind == "fixed" and len(values) == 1:
+            self._sample = lambda r: values[0]
+        elif kind == "uniform" and len(values) == 2:
+            low, high = values
+            self._sample = lambda r: r.uniform(low, high)
+        elif kind == "lognormal" and len(values) == 2 and 0 < values[0] <= values[1]:
+            mu = math.log(values[0])
+            sigma = math.log(values[1] / values[0]) / _Z99
+            self._sample = lambda r: r.lognormvariate(mu, sigma)
+        else:
+            raise ValueError(f"invalid latency spec: {spec!r}")
+
+    def sample(self, rng: Optional[random.Random] = None) -> float:
+        return max(0.0, self._sample(rng or self._rng))
+
+
+class _CallbackDispatcher:
+    """依到期時間觸發 callback 的單一執行緒（同一時間點依排入順序）。"""
+
+    def __init__(self, on_error: Callable[[Exception], None]):
+        self._on_error = on_error
+        self._heap: List[tuple] = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._running = 0
+
+    def schedule(self, due: float, fn: Callable, *args) -> None:
+        with self._cond:
+            heapq.heappush(self._heap, (due, next(self._counter), fn, args))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="sim-broker-callbacks", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                    self._cond.wait(timeout)
+                _, _, fn, args = heapq.heappop(self._heap)
+                self._running += 1
+            try:
+                fn(*args)
+            except Exception as exc:  # callback 例外不可中斷回報執行緒
+                self._on_error(exc)
+            finally:
+                with self._cond:
+                    self._running -= 1
+
+    def pending(self) -> int:
+        """尚未觸發或正在執行的 callback 數。"""
+        with self._cond:
+            return len(self._heap) + self._running
+
+
+class _SimOrder:
+    __slots__ = ("seq", "orderno", "networkid", "actno", "subact", "productid", "bs",
+                 "ordertype", "price", "qty", "note", "status", "matched", "fills")
+
+    def __init__(self, seq, orderno, networkid, order):
+        self.seq = seq
+        self.orderno = orderno
+        self.networkid = networkid
+        self.actno = getattr(order, "actno", "") or ""
+        self.subact = getattr(order, "subactno", "") or ""
+        self.productid = getattr(order, "productid", "") or ""
+        self.bs = getattr(order, "bs", "") or "B"
+        self.ordertype = getattr(order, "ordertype", "") or "L"
+        self.price = float(getattr(order, "price", 0) or 0)
+        self.qty = int(getattr(order, "orderqty", 0) or 0)
+        self.note = getattr(order, "note", "") or ""
+        self.status = "委託中"
+        self.matched = 0
+        self.fills = 0
+
+
+def _response(data=None, error: str = "") -> SimpleNamespace:
+    return SimpleNamespace(ok=not error, data=data, error=error)
+
+
+def _network_id_key(network_id: str) -> int:
+    return int(network_id) if network_id.isdigit() else -1
+
+
+class _SimExchange:
+    """委託簿、成交與部位的共用狀態（dtrade / daccount 共用）。"""
+
+    def __init__(self, api: "SimulatedUnitrade"):
+        self.api = api
+        # 委託相關的亂數改用每筆委託自己的 rng（見 place），這裡只是未傳入時的預設
+        self.order_latency = LatencyDistribution(SIM_ORDER_LATENCY, _component_rng("order_latency"))
+        self.reply_latency = LatencyDistribution(SIM_REPLY_LATENCY, _component_rng("reply_latency"))
+        self.match_latency = LatencyDistribution(SIM_MATCH_LATENCY, _component_rng("match_latency"))
+        self.query_latency = LatencyDistribution(SIM_QUERY_LATENCY, _component_rng("query_latency"))
+        self.price_rng = _component_rng("price")   # 只在 callback 執行緒（持有 lock）使用
+        self.dispatcher = _CallbackDispatcher(api._report_error)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.orders: Dict[str, _SimOrder] = {}          # seq → 委託
+        self.matches: List[SimpleNamespace] = []
+        self.last_price: Dict[str, float] = {}
+        # (actno, productid) → [淨口數（買正賣負）, 平均成本]
+        self.positions: Dict[Tuple[str, str], list] = {}
+        self.realized: Dict[str, float] = {}
+
+    @staticmethod
+    def chance(rng: random.Random, rate: float) -> bool:
+        return rate > 0 and rng.random() < rate
+
+    # ── 下單與回報 ────────────────────────────────────────────────
+    def place(self, order) -> SimpleNamespace:
+        # 序號先取號，這筆委託的所有亂數都由「種子 + 序號」決定，與送單執行緒的交錯無關
+        with self.lock:
+            n = next(self.ids)
+        rng = _component_rng("order", n)
+        time.sleep(self.order_latency.sample(rng))
+        if self.chance(rng, SIM_LOCAL_REJECT_RATE):
+            return SimpleNamespace(issend=False, seq="", errorcode="SIM01", errormsg="模擬本地拒單")
+
+        sim = _SimOrder(f"{n:08d}", f"s{n:04x}"[-5:], f"{n:010d}", order)
+        with self.lock:
+            self.orders[sim.seq] = sim
+        now = time.monotonic()
+        reply_at = now + self.reply_latency.sample(rng)
+        if self.chance(rng, SIM_REJECT_RATE):
+            self.dispatcher.schedule(reply_at, self._reply, sim, "委託失敗：保證金不足", "FUF")
+        else:
+            self.dispatcher.schedule(reply_at, self._reply, sim, "委託成功", "0000")
+            if sim.qty > 0 and not self.chance(rng, SIM_NO_FILL_RATE):
+                due = reply_at
+                for qty in self._split(rng, sim.qty):
+                    due += self.match_latency.sample(rng)
+                    self.dispatcher.schedule(due, self._match, sim, qty)
+        return SimpleNamespace(
+            issend=True, seq=sim.seq, errorcode="", errormsg="", networkid=sim.networkid,
+        )
+
+    def _split(self, rng: random.Random, qty: int) -> List[int]:
+        if qty < 2 or not self.chance(rng, SIM_PARTIAL_FILL_RATE):
+            return [qty]
+        pieces = rng.randint(2, min(qty, 4))
+        cuts = sorted(rng.sample(range(1, qty), pieces - 1))
+        return [b - a for a, b in zip([0] + cuts, cuts + [qty])]
+
+    def _reply_record(self, sim: _SimOrder, statuscode: str = "") -> SimpleNamespace:
+        return SimpleNamespace(
+            seq=sim.seq, orderno=sim.orderno, networkid=sim.networkid,
+            orderstatus=sim.status, statuscode=statuscode, matchqty=str(sim.matched),
+            tradedate=datetime.now().strftime("%Y%m%d"), investoracno=sim.actno, subact=sim.subact,
+            productid=sim.productid, bs=sim.bs, orderqty=str(sim.qty), orderprice=str(sim.price),
+            note=sim.note,
+        )
+
+    def _reply(self, sim: _SimOrder, status: str, statuscode: str) -> None:
+        with self.lock:
+            sim.status = status
+            reply = self._reply_record(sim, statuscode)
+        callback = getattr(self.api.dtrade, "on_reply", None)
+        if callback:
+            callback(reply)
+
+    def _fill_price(self, sim: _SimOrder) -> float:
+        if sim.ordertype == "L" and sim.price > 0:
+            return sim.price
+        last = self.last_price.get(sim.productid, SIM_BASE_PRICE)
+        last = max(1.0, last + round(self.price_rng.gauss(0, 2)))
+        self.last_price[sim.productid] = last
+        return last
+
+    def _match(self, sim: _SimOrder, qty: int) -> None:
+        with self.lock:
+            price = self._fill_price(sim)
+            sim.matched += qty
+            sim.fills += 1
+            now = datetime.now()
+            match = SimpleNamespace(
+                networkid=sim.networkid, orderno=sim.orderno, matchseq=str(sim.fills),
+                matchtime=now.strftime("%H%M%S%f")[:9], mdate=now.strftime("%Y%m%d"),
+                matchprice=str(price), matchqty=str(qty), investoracno=sim.actno, subact=sim.subact,
+                productkind="F", productid=sim.productid, bs=sim.bs, note=sim.note,
+            )
+            self.matches.append(match)
+            self._apply_position(sim.actno, sim.productid, qty if sim.bs == "B" else -qty, price)
+            # 部分成交期間 query_reply 維持「委託成功」，只更新成交口數
+            done = sim.matched >= sim.qty
+            if done:
+                sim.status = "全部成交"
+            reply = self._reply_record(sim, "0000") if done else None
+        on_match = getattr(self.api.dtrade, "on_match", None)
+        if on_match:
+            on_match(match)
+        on_reply = getattr(self.api.dtrade, "on_reply", None)
+        if reply is not None and on_reply:
+            on_reply(reply)
+
+    def _apply_position(self, actno: str, productid: str, signed_qty: int, price: float) -> None:
+        position = self.positions.setdefault((actno, productid), [0, 0.0])
+        held, avg = position
+        if held == 0 or (held > 0) == (signed_qty > 0):
+            position[1] = (avg * abs(held) + price * abs(signed_qty)) / (abs(held) + abs(signed_qty))
+        else:
+            closed = min(abs(held), abs(signed_qty))
+            pnl = (price - avg) * closed * (1 if held > 0 else -1) * _POINT_VALUE
+            self.realized[actno] = self.realized.get(actno, 0.0) + pnl
+            if abs(signed_qty) > abs(held):
+                position[1] = price
+        position[0] = held + signed_qty
+        if position[0] == 0:
+            position[1] = 0.0
+
+    # ── 查詢 ──────────────────────────────────────────────────────
+    def query(self, records: List[SimpleNamespace], count: int, start: str) -> SimpleNamespace:
+        time.sleep(self.query_latency.sample())
+        start_key = _network_id_key(start) if start else 0
+        rows = sorted(
+            (r for r in records if _network_id_key(r.networkid) >= start_key),
+            key=lambda r: _network_id_key(r.networkid),
+        )[:count]
+        if not rows:
+            return _response(error="查無資料")
+        return _response(rows)
+
+    def open_positions(self, actno: str) -> List[Tuple[str, int, float]]:
+        with self.lock:
+            return [
+                (productid, held, avg)
+                for (owner, productid), (held, avg) in self.positions.items()
+                if owner == actno and held != 0
+            ]
+
+
+class _SimDTrade:
+    def __init__(self, exchange: _SimExchange):
+        self._exchange = exchange
+        self.on_connected = None
+        self.on_disconnected = None
+        self.on_reply = None
+        self.on_match = None
+
+    def get_current_server(self) -> str:
+        return SIM_SERVER
+
+    def order(self, order) -> SimpleNamespace:
+        return self._exchange.place(order)
+
+    def query_reply(self, actno: str, count: int, start: str = "", *_args) -> SimpleNamespace:
+        exchange = self._exchange
+        with exchange.lock:
+            records = [exchange._reply_record(o) for o in exchange.orders.values() if o.actno == actno]
+        return exchange.query(records, count, start)
+
+    def query_match(self, actno: str, count: int, start: str = "", *_args) -> SimpleNamespace:
+        exchange = self._exchange
+        with exchange.lock:
+            records = [m for m in exchange.matches if m.investoracno == actno]
+        return exchange.query(records, count, start)
+
+
+class _SimDAccount:
+    def __init__(self, exchange: _SimExchange):
+        self._exchange = exchange
+
+    def _mark(self, productid: str, avg: float) -> float:
+        return self._exchange.last_price.get(productid, avg)
+
+    def get_margin(self, actno: str, currency: str = "TWD") -> SimpleNamespace:
+        exchange = self._exchange
+        time.sleep(exchange.query_latency.sample())
+        positions = exchange.open_positions(actno)
+        floating = sum((self._mark(p, avg) - avg) * held * _POINT_VALUE for p, held, avg in positions)
+        lots = sum(abs(held) for _, held, _ in positions)
+        realized = exchange.realized.get(actno, 0.0)
+        equity = _INITIAL_EQUITY + realized + floating
+        original = lots * _MARGIN_PER_LOT
+        now = datetime.now()
+        return _response([SimpleNamespace(
+            ACTNO=actno, ACCOUNT_DATE=now.strftime("%Y%m%d"), CURRENCY=currency or "TWD",
+            CTDAB=equity, LCTDAB=_INITIAL_EQUITY, LTDAB=_INITIAL_EQUITY, DWAMT=0,
+            IAMT=original, MAMT=original * 0.75, ORDCEXCESS=equity - original, ORDIAMT=0,
+            OSPRTLOS=realized, PRTLOS=floating, OPTOSPRTLOS=0, OPTPRTLOS=0, ORIGNFEE=0, CTAXAMT=0,
+            OPTRATE=round(equity / original * 100, 2) if original else None,
+            UPDATE_DATE=now.strftime("%Y%m%d"), UPDATE_TIME=now.strftime("%H%M%S"),
+        )])
+
+    def get_position(self, actno: str, groupid: str = "", trader: str = "") -> SimpleNamespace:
+        exchange = self._exchange
+        time.sleep(exchange.query_latency.sample())
+        data = [
+            SimpleNamespace(
+                PRODUCT=productid, PRODUCTID=_broker_product_id(productid), PRODUCTKIND="F",
+                CURRENT_BUY_OPEN_POSITION=max(held, 0), CURRENT_SELL_OPEN_POSITION=max(-held, 0),
+                OPEN_BUY_POSITION_AVERAGE_COST=avg if held > 0 else 0,
+                OPEN_SELL_POSITION_AVERAGE_COST=avg if held < 0 else 0,
+                REFERENCE_REALPRICE=self._mark(productid, avg),
+                FLOATING_PNL=(self._mark(productid, avg) - avg) * held * _POINT_VALUE,
+            )
+            for productid, held, avg in exchange.open_positions(actno)
+        ]
+        return _response(data) if data else _response(error="查無資料")
+
+    def get_unliquidation(self, actno: str, currency: str = "") -> SimpleNamespace:
+        exchange = self._exchange
+        time.sleep(exchange.query_latency.sample())
+        data = []
+        for productid, held, avg in exchange.open_positions(actno):
+            floating = (self._mark(productid, avg) - avg) * held * _POINT_VALUE
+            data.append(SimpleNamespace(
+                PRODUCTID=_broker_product_id(productid), BS="B" if held > 0 else "S", TOTALOTQTY=abs(held),
+                AVGMATCHPRICE=avg, REALPRICE=self._mark(productid, avg),
+                REFTOTALPL=floating, NET_PROFIT_LOSS=floating,
+            ))
+        return _response(data) if data else _response(error="查無資料")
+
+
+class SimulatedUnitrade:
+    """與 unitrade.unitrade.Unitrade 相同介面的模擬券商。"""
+
+    def __init__(self):
+        self.on_error = None
+        self._exchange = _SimExchange(self)
+        self.dtrade = _SimDTrade(self._exchange)
+        self.daccount = _SimDAccount(self._exchange)
+        self._accounts: List[str] = []
+
+    def _report_error(self, exc: Exception) -> None:
+        logger.error("Simulated broker callback error: %s", exc)
+        if self.on_error:
+            self.on_error(exc)
+
+    def login(self, ws_url: str = "", account: str = "", password: str = "",
+              cert_file: str = "", cert_password: str = "") -> None:
+        self._accounts = [os.getenv("UNITRADE_ACTNO") or account or "SIM0000001"]
+        logger.warning("Simulated broker backend in use — orders are NOT sent to the exchange")
+        if self.dtrade.on_connected:
+            self._exchange.dispatcher.schedule(time.monotonic(), self.dtrade.on_connected)
+
+    def get_accounts(self) -> List[str]:
+        return list(self._accounts)
+
+    def pending_callbacks(self) -> int:
+        """還會觸發的 on_reply / on_match 數；0 表示所有委託的回報都已送出（signal_replay 用）。"""
+        return self._exchange.dispatcher.pending()
@@ -0,0 +1,170 @@
+"""StrategyConfig 程序內快取（/signal 熱路徑使用）。
+
+策略設定一週只改幾次，卻每天被讀取上千次；每筆訊號都查一次 DB 會直接
+拖慢訊號到下單的延遲。這裡把整張 strategy_config 表載入記憶體，以
+strategy_name 為 key 提供查詢。
+
+同步策略：
+- 本程序內的 /strategies 寫入（新增/更新/刪除/啟停）呼叫
+  invalidate_strategy_cache() 立即失效。
+- 其他 uvicorn worker 的寫入則靠版本檢查：快取超過 STRATEGY_CACHE_TTL 秒後，
+  以一次 `SELECT count(*), max(updated_at)` 比對版本，有變動才重新載入整表。
+- 另設 STRATEGY_CACHE_MAX_AGE 秒強制重載，避免繞過 API 直接改 DB 未更新
+  updated_at 時永遠讀到舊資料。
+
+非同步端點使用 *_async 版本：查詢以 AsyncSession.run_sync 執行同一套同步查詢，
+但查詢期間不持有 _cache_lock（event loop 上不可阻塞等鎖），並行的重載頂多多查一次。
+"""
+import logging
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from models import StrategyConfig
+
+logger = logging.getLogger(__name__)
+
+STRATEGY_CACHE_TTL = float(os.getenv("STRATEGY_CACHE_TTL", "2"))
+STRATEGY_CACHE_MAX_AGE = float(os.getenv("STRATEGY_CACHE_MAX_AGE", "300"))
+
+_cache_lock = threading.Lock()
+_configs: Dict[str, StrategyConfig] = {}
+_version: Optional[tuple] = None
+_loaded_at: float = 0.0   # 上次整表載入（monotonic）
+_checked_at: float = 0.0  # 上次版本檢查（monotonic）
+
+
+def _read_version(db: Session) -> tuple:
+    count, last_updated = db.query(
+        func.count(StrategyConfig.id), func.max(StrategyConfig.updated_at)
+    ).one()
+    return (count, last_updated)
+
+
+def _fetch_all(db: Session, version: Optional[tuple] = None) -> Tuple[List[StrategyConfig], tuple]:
+    """整表查詢，回傳 detached 物件與版本。"""
+    if version is None:
+        version = _read_version(db)
+    rows = db.query(StrategyConfig).all()
+    for row in rows:
+        # 脫離 session，避免 commit 時被 expire 而在其他請求觸發 lazy load
+        db.expunge(row)
+    return rows, version
+
+
+def _fetch_named(db: Session, strategy_names: Iterable[str]) -> List[StrategyConfig]:
+    rows = db.query(StrategyConfig).filter(
+        StrategyConfig.strategy_name.in_(list(strategy_names))
+    ).all()
+    for row in rows:
+        db.expunge(row)
+    return rows
+
+
+def _install(rows: List[StrategyConfig], version: tuple) -> None:
+    """以整表查詢結果取代快取內容（呼叫端須持有 _cache_lock）。"""
+    global _configs, _version, _loaded_at, _checked_at
+    _configs = {row.strategy_name: row for row in rows}
+    _version = version
+    _loaded_at = _checked_at = time.monotonic()
+    logger.info("Strategy cache loaded: %d strategies", len(_configs))
+
+
+def _reload(db: Session, version: Optional[tuple] = None) -> None:
+    """整表載入並以 detached 物件取代快取內容（呼叫端須持有 _cache_lock）。"""
+    _install(*_fetch_all(db, version))
+
+
+def _ensure_fresh(db: Session) -> None:
+    global _checked_at
+    now = time.monotonic()
+    if _version is not None and now - _checked_at < STRATEGY_CACHE_TTL:
+        return
+
+    with _cache_lock:
+        now = time.monotonic()
+        if _version is not None and now - _checked_at < STRATEGY_CACHE_TTL:
+            return
+        if _version is None or now - _loaded_at >= STRATEGY_CACHE_MAX_AGE:
+            _reload(db)
+            return
+        version = _read_version(db)
+        if version != _version:
+            _reload(db, version)
+        else:
+            _checked_at = now
+
+
+def get_strategy_config(db: Session, strategy_name: str) -> Optional[StrategyConfig]:
+    """以 strategy_name 取得策略設定（detached 快照，唯讀使用）。
+
+    快取未命中時直接查 DB 一次，讓其他 worker 剛建立的策略不必等 TTL。
+    """
+    _ensure_fresh(db)
+    config = _configs.get(strategy_name)
+    if config is not None:
+        return config
+
+    rows = _fetch_named(db, [strategy_name])
+    return _remember(rows).get(strategy_name)
+
+
+def _remember(rows: List[StrategyConfig]) -> Dict[str, StrategyConfig]:
+    """把快取未命中後查到的策略加入快取。"""
+    with _cache_lock:
+        for row in rows:
+            _configs[row.strategy_name] = row
+    return {row.strategy_name: row for row in rows}
+
+
+# ==================== 非同步端點使用 ====================
+
+async def _ensure_fresh_async(db: AsyncSession) -> None:
+    global _checked_at
+    now = time.monotonic()
+    if _version is not None and now - _checked_at < STRATEGY_CACHE_TTL:
+        return
+    version = None
+    if _version is not None and now - _loaded_at < STRATEGY_CACHE_MAX_AGE:
+        version = await db.run_sync(_read_version)
+        if version == _version:
+            with _cache_lock:
+                _checked_at = time.monotonic()
+            return
+    rows, version = await db.run_sync(_fetch_all, version)
+    with _cache_lock:
+        _install(rows, version)
+
+
+async def get_strategy_config_async(db: AsyncSession, strategy_name: str) -> Optional[StrategyConfig]:
+    """get_strategy_config 的非同步版本。"""
+    await _ensure_fresh_async(db)
+    config = _configs.get(strategy_name)
+    if config is not None:
+        return config
+    rows = await db.run_sync(_fetch_named, [strategy_name])
+    return _remember(rows).get(strategy_name)
+
+
+async def get_strategy_configs_async(db: AsyncSession, strategy_names: Iterable[str]) -> Dict[str, StrategyConfig]:
+    """批次取得多個策略設定（/signals/batch）；快取未命中的名稱以單一 IN 查詢補齊。"""
+    await _ensure_fresh_async(db)
+    names = set(strategy_names)
+    found = {name: _configs[name] for name in names if name in _configs}
+    missing = names - found.keys()
+    if missing:
+        found.update(_remember(await db.run_sync(_fetch_named, missing)))
+    return found
+
+
+def invalidate_strategy_cache() -> None:
+    """立即失效本程序的快取，下次查詢時整表重載。"""
+    global _version
+    with _cache_lock:
+        _version = None
+    logger.info("Strategy cache invalidated")
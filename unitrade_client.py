@@ -2,11 +2,14 @@ import json
 import logging
 import os
 import threading
+import time
 from datetime import datetime
 from typing import Any, Optional
 
 from unitrade.unitrade import Unitrade
 
+from contract_calendar import normalize_product
+
 logger = logging.getLogger(__name__)
 
 
@@ -18,9 +21,17 @@ class UnitradeOrderError(RuntimeError):
     pass
 
 
+class UnitradeOutcomeUnknown(RuntimeError):
+    """下單請求可能已送達券商閘道，但沒有收到回應：不可重送，委託標記 unknown 待歷史同步對帳。"""
+
+
 _client_lock = threading.Lock()
 _client: Optional[Unitrade] = None
 
+# 閘道模式：設定 UNITRADE_GATEWAY_SOCKET 的 HTTP worker 不自行登入，改經 socket 交給閘道程序
+_gateway_server_mode = False
+_gateway_client = None
+
 
 def _get_env(name: str, required: bool = True) -> Optional[str]:
     value = os.getenv(name)
@@ -29,24 +40,66 @@ def _get_env(name: str, required: bool = True) -> Optional[str]:
     return value
 
 
+def enable_gateway_server_mode() -> None:
+    """由 broker_gateway 程序呼叫：本程序為閘道本身，需直接登入 Unitrade。"""
+    global _gateway_server_mode
+    _gateway_server_mode = True
+
+
+def broker_mode() -> str:
+    """回傳目前程序的券商連線模式：embedded / gateway / gateway-client。"""
+    if _gateway_server_mode:
+        return "gateway"
+    if os.getenv("UNITRADE_GATEWAY_SOCKET"):
+        return "gateway-client"
+    return "embedded"
+
+
+def broker_backend() -> str:
+    """券商後端：unitrade（正式 SDK，預設）或 sim（sim_broker 模擬券商，壓測 / 離線測試用）。"""
+    return (os.getenv("UNITRADE_BACKEND") or "unitrade").strip().lower()
+
+
+def _get_gateway_client():
+    global _gateway_client
+    if _gateway_client is None:
+        with _client_lock:
+            if _gateway_client is None:
+                from broker_gateway import GatewayClient
+                _gateway_client = GatewayClient(os.environ["UNITRADE_GATEWAY_SOCKET"])
+    return _gateway_client
+
+
 def get_unitrade_client() -> Unitrade:
-    """Get a logged-in Unitrade client (singleton)."""
+    """Get a logged-in Unitrade client (singleton).
+
+    閘道模式下回傳 GatewayClient 代理，介面與 SDK 相同，實際呼叫由閘道程序執行。
+    """
     global _client
     if _client is not None:
         return _client
 
+    if broker_mode() == "gateway-client":
+        return _get_gateway_client()
+
     with _client_lock:
         if _client is not None:
             return _client
 
-        ws_url = _get_env("UNITRADE_WS_URL")
-        account = _get_env("UNITRADE_ACCOUNT")
-        password = _get_env("UNITRADE_PASSWORD")
-        cert_file = _get_env("UNITRADE_CERT_FILE")
+        # 模擬券商不需要登入資訊
+        simulated = broker_backend() == "sim"
+        ws_url = _get_env("UNITRADE_WS_URL", required=not simulated) or ""
+        account = _get_env("UNITRADE_ACCOUNT", required=not simulated) or ""
+        password = _get_env("UNITRADE_PASSWORD", required=not simulated) or ""
+        cert_file = _get_env("UNITRADE_CERT_FILE", required=not simulated) or ""
         cert_password = _get_env("UNITRADE_CERT_PASSWORD", required=False) or ""
 
         try:
-            api = Unitrade()
+            if simulated:
+                from sim_broker import SimulatedUnitrade
+                api = SimulatedUnitrade()
+            else:
+                api = Unitrade()
 
             # 依官方文件：先掛 callbacks，再執行 login
             # 確保連線事件與委託回報在登入過程中不會被漏掉
@@ -54,7 +107,7 @@ def get_unitrade_client() -> Unitrade:
 
             api.login(ws_url, account, password, cert_file, cert_password)
             _client = api
-            logger.info("Unitrade login succeeded")
+            logger.info("Unitrade login succeeded (backend=%s)", broker_backend())
 
             # 登入後取得可用交易帳號清單（用於診斷 actno 設定是否正確）
             try:
@@ -121,9 +174,11 @@ def _setup_order_callbacks(api: Unitrade) -> None:
     - on_disconnected : dtrade 斷線通知
     - on_reply        : 委託回報（含交易所拒絕，如保證金不足）→ 更新 OrderHistory
     - on_match        : 成交回報 → 建立 TradeRecord 並更新 OrderHistory
+
+    on_reply / on_match 只把回報交給 callback_writer 的佇列，DB 寫入由 writer 執行緒
+    批次 commit（_apply_reply / _apply_match），不佔用 SDK 的事件接收執行緒。
     """
-    from database import SessionLocal
-    from models import OrderHistory, TradeRecord
+    from callback_writer import submit_callback
 
     # ── 全域錯誤事件 ──────────────────────────────────────────────
     def on_error(err) -> None:
@@ -143,119 +198,174 @@ def _setup_order_callbacks(api: Unitrade) -> None:
     api.dtrade.on_connected = dtrade_on_connected
     api.dtrade.on_disconnected = dtrade_on_disconnected
 
-    # ── 委託回報 (on_reply) ───────────────────────────────────────
+    # ── 委託 / 成交回報 ───────────────────────────────────────────
     def on_reply(reply) -> None:
-        """DOrderReply: orderstatus, statuscode, seq, orderno, matchqty ..."""
-        db = SessionLocal()
-        try:
-            seq = (getattr(reply, "seq", None) or "").strip()
-            if not seq:
-                return
-            order = db.query(OrderHistory).filter(OrderHistory.order_id == seq).first()
-            if order:
-                orderstatus = getattr(reply, "orderstatus", None)
-                order.fill_status = orderstatus
-                # 同步邏輯狀態，但不允許回降（避免中間狀態蓋掉已成交/部分成交）
-                new_status = _orderstatus_to_db_status(orderstatus)
-                _FINALITY = {"pending": 0, "submitted": 1, "partial_filled": 2,
-                             "filled": 3, "cancelled": 3, "failed": 3}
-                if _FINALITY.get(new_status, 1) >= _FINALITY.get(order.status or "pending", 0):
-                    order.status = new_status
-                order.ordno = getattr(reply, "orderno", None)
-                filled = getattr(reply, "matchqty", None)
-                if filled is not None:
-                    try:
-                        order.fill_quantity = int(filled)
-                    except (ValueError, TypeError):
-                        pass
-                order.updated_at = datetime.utcnow()
-                db.commit()
-                logger.info(
-                    "on_reply: seq=%s orderstatus=%s status=%s",
-                    seq, orderstatus, order.status,
-                )
-        except Exception as exc:
-            logger.error("on_reply callback error: %s", exc)
-            db.rollback()
-        finally:
-            db.close()
+        submit_callback(_apply_reply, reply)
 
-    # ── 成交回報 (on_match) ───────────────────────────────────────
     def on_match(match) -> None:
-        """DMatchReply: productid, bs, matchprice, matchqty, orderno ..."""
-        db = SessionLocal()
+        submit_callback(_apply_match, match)
+
+    api.dtrade.on_reply = on_reply
+    api.dtrade.on_match = on_match
+    logger.info("Unitrade callbacks registered (on_error / on_connected / on_disconnected / on_reply / on_match)")
+
+
+# 狀態不回降：較低的 finality 不可覆寫較高的（避免中間狀態蓋掉已成交/部分成交）
+_FINALITY = {"pending": 0, "unknown": 1, "submitted": 1, "partial_filled": 2,
+             "filled": 3, "cancelled": 3, "failed": 3}
+
+
+def _apply_reply(db, reply, received_at: float) -> list:
+    """委託回報 (DOrderReply: orderstatus, statuscode, seq, orderno, matchqty ...) → OrderHistory。
+
+    由 callback_writer 在批次 transaction 內呼叫；回傳 commit 後要發佈的事件。
+    """
+    from metrics import mark_stored_timings
+    from models import OrderHistory
+
+    seq = (getattr(reply, "seq", None) or "").strip()
+    if not seq:
+        return []
+    # 同一 seq 可能有多筆記錄，與歷史同步一致取最新一筆
+    order = (
+        db.query(OrderHistory)
+        .filter(OrderHistory.order_id == seq)
+        .order_by(OrderHistory.created_at.desc())
+        .first()
+    )
+    if not order:
+        return []
+    orderstatus = getattr(reply, "orderstatus", None)
+    order.fill_status = orderstatus
+    new_status = _orderstatus_to_db_status(orderstatus)
+    if _FINALITY.get(new_status, 1) >= _FINALITY.get(order.status or "pending", 0):
+        order.status = new_status
+    order.ordno = getattr(reply, "orderno", None)
+    filled = getattr(reply, "matchqty", None)
+    if filled is not None:
         try:
-            orderno = getattr(match, "orderno", None)
-            match_price_raw = getattr(match, "matchprice", None)
-            match_qty_raw = getattr(match, "matchqty", None)
-
-            match_price = float(match_price_raw) if match_price_raw else None
-            match_qty = int(match_qty_raw) if match_qty_raw else None
-
-            # 建立成交記錄
-            trade = TradeRecord(
-                network_id=getattr(match, "networkid", None),
-                orderno=orderno,
-                account=getattr(match, "investoracno", None),
-                sub_account=getattr(match, "subact", None),
-                product_kind=getattr(match, "productkind", None),
-                product_id=getattr(match, "productid", None),
-                bs=getattr(match, "bs", None),
-                match_price=match_price,
-                match_qty=match_qty,
-                match_seq=getattr(match, "matchseq", None),
-                match_time=getattr(match, "matchtime", None),
-                note=getattr(match, "note", None),
-                mdate=getattr(match, "mdate", None),
+            order.fill_quantity = int(filled)
+        except (ValueError, TypeError):
+            pass
+    timings = mark_stored_timings(
+        order.stage_timings, "reply", "broker_end", order.strategy, order.symbol, at=received_at,
+    )
+    if timings is not None:
+        order.stage_timings = timings
+    order.updated_at = datetime.utcnow()
+    logger.info("on_reply: seq=%s orderstatus=%s status=%s", seq, orderstatus, order.status)
+    return [("order", order.to_dict())]
+
+
+def _apply_match(db, match, received_at: float) -> list:
+    """成交回報 (DMatchReply: productid, bs, matchprice, matchqty, orderno ...) → TradeRecord。
+
+    由 callback_writer 在批次 transaction 內呼叫；同一筆成交被唯一索引擋下時
+    flush 會拋出 IntegrityError，由 writer 回滾後逐筆重試。
+    """
+    from metrics import mark_stored_timings
+    from models import OrderHistory, TradeRecord
+
+    orderno = getattr(match, "orderno", None)
+    network_id = getattr(match, "networkid", None)
+    match_seq = getattr(match, "matchseq", None)
+    match_time = getattr(match, "matchtime", None)
+    match_price_raw = getattr(match, "matchprice", None)
+    match_qty_raw = getattr(match, "matchqty", None)
+
+    match_price = float(match_price_raw) if match_price_raw else None
+    match_qty = int(match_qty_raw) if match_qty_raw else None
+
+    # 冪等：重播的成交回報（相同去重鍵）不可重複累加
+    if network_id and _fill_exists(db, network_id, match_seq, match_time):
+        logger.info(
+            "on_match: duplicate fill ignored network_id=%s matchseq=%s matchtime=%s",
+            network_id, match_seq, match_time,
+        )
+        return []
+
+    # 建立成交記錄
+    trade = TradeRecord(
+        network_id=network_id,
+        orderno=orderno,
+        account=getattr(match, "investoracno", None),
+        sub_account=getattr(match, "subact", None),
+        product_kind=getattr(match, "productkind", None),
+        product_id=getattr(match, "productid", None),
+        bs=getattr(match, "bs", None),
+        match_price=match_price,
+        match_qty=match_qty,
+        match_seq=match_seq,
+        match_time=match_time,
+        note=getattr(match, "note", None),
+        mdate=getattr(match, "mdate", None),
+    )
+
+    # 嘗試關聯 OrderHistory；鎖定該列讓同一委託的並行成交依序累加
+    linked_order = None
+    if orderno:
+        linked_order = (
+            db.query(OrderHistory)
+            .filter(OrderHistory.ordno == orderno)
+            .order_by(OrderHistory.created_at.desc())
+            .with_for_update()
+            .first()
+        )
+        if linked_order:
+            trade.seq = linked_order.order_id
+            _apply_fill(linked_order, match_price, match_qty)
+            timings = mark_stored_timings(
+                linked_order.stage_timings, "first_match", "reply",
+                linked_order.strategy, linked_order.symbol, at=received_at,
             )
+            if timings is not None:
+                linked_order.stage_timings = timings
+
+    db.add(trade)
+    db.flush()
+    events = [("fill", trade.to_dict())]
+    if linked_order:
+        events.append(("order", linked_order.to_dict()))
+    logger.info(
+        "on_match: orderno=%s product=%s bs=%s price=%s qty=%s total_fill_qty=%s",
+        orderno,
+        getattr(match, "productid", ""),
+        getattr(match, "bs", ""),
+        match_price,
+        match_qty,
+        linked_order.matched_qty if linked_order else None,
+    )
+    return events
+
+
+def _fill_exists(db, network_id: str, match_seq: Optional[str], match_time: Optional[str]) -> bool:
+    """以 (network_id, match_seq, match_time) 判斷成交是否已記錄。
+
+    同一委託的多筆部分成交共用 network_id，單靠 network_id 會把後續成交誤判為重複。
+    條件與唯一索引 ux_trade_records_fill_key 的運算式相同，直接以該索引查找。
+    """
+    from sqlalchemy import func, literal_column
 
-            # 嘗試關聯 OrderHistory
-            linked_order = None
-            if orderno:
-                linked_order = db.query(OrderHistory).filter(OrderHistory.ordno == orderno).first()
-                if linked_order:
-                    trade.seq = linked_order.order_id
-
-            # 先 flush 成交記錄，使本筆也納入後續的加權均價計算
-            db.add(trade)
-            db.flush()
-
-            # 若有關聯委託，以 trade_records 重新計算加權平均成交價與累計成交量
-            if linked_order:
-                all_trades = (
-                    db.query(TradeRecord)
-                    .filter(TradeRecord.seq == linked_order.order_id)
-                    .all()
-                )
-                total_qty = sum(t.match_qty or 0 for t in all_trades)
-                if total_qty > 0:
-                    linked_order.fill_price = round(
-                        sum((t.match_price or 0) * (t.match_qty or 0) for t in all_trades) / total_qty,
-                        2,
-                    )
-                linked_order.fill_quantity = total_qty
-                linked_order.status = "filled" if total_qty >= linked_order.quantity else "partial_filled"
-                linked_order.updated_at = datetime.utcnow()
+    from models import TradeRecord
 
-            db.commit()
-            logger.info(
-                "on_match: orderno=%s product=%s bs=%s price=%s qty=%s total_fill_qty=%s",
-                orderno,
-                getattr(match, "productid", ""),
-                getattr(match, "bs", ""),
-                match_price,
-                match_qty,
-                linked_order.fill_quantity if linked_order else None,
-            )
-        except Exception as exc:
-            logger.error("on_match callback error: %s", exc)
-            db.rollback()
-        finally:
-            db.close()
+    empty = literal_column("''")  # 常數須與索引運算式一致，不可為綁定參數
+    return db.query(TradeRecord.id).filter(
+        TradeRecord.network_id == network_id,
+        func.coalesce(TradeRecord.match_seq, empty) == (match_seq or ""),
+        func.coalesce(TradeRecord.match_time, empty) == (match_time or ""),
+    ).first() is not None
 
-    api.dtrade.on_reply = on_reply
-    api.dtrade.on_match = on_match
-    logger.info("Unitrade callbacks registered (on_error / on_connected / on_disconnected / on_reply / on_match)")
+
+def _apply_fill(order, match_price: Optional[float], match_qty: Optional[int]) -> None:
+    """將一筆成交累加到委託上（O(1)），並更新均價、成交量與狀態。"""
+    qty = match_qty or 0
+    order.matched_qty = (order.matched_qty or 0) + qty
+    order.matched_notional = (order.matched_notional or 0) + (match_price or 0) * qty
+    if order.matched_qty > 0:
+        order.fill_price = round(order.matched_notional / order.matched_qty, 2)
+    order.fill_quantity = order.matched_qty
+    order.status = "filled" if order.matched_qty >= order.quantity else "partial_filled"
+    order.updated_at = datetime.utcnow()
 
 
 def _orderstatus_to_db_status(orderstatus: Optional[str]) -> str:
@@ -279,154 +389,168 @@ def _orderstatus_to_db_status(orderstatus: Optional[str]) -> str:
     return "submitted"
 
 
-def _sync_history(api: Unitrade, actno: str) -> dict:
-    """向交易所查詢當日歷史委託與成交，upsert 進資料庫。
+_SYNC_IN_CHUNK = 1000
+
+
+def _chunked(values: list, size: int = _SYNC_IN_CHUNK):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def _to_int(raw) -> Optional[int]:
+    try:
+        return int(raw) if raw else None
+    except (ValueError, TypeError):
+        return None
+
+
+def _to_float(raw) -> Optional[float]:
+    try:
+        return float(raw) if raw else None
+    except (ValueError, TypeError):
+        return None
+
+
+SYNC_PAGE_SIZE = int(os.getenv("SYNC_PAGE_SIZE", "500"))
+_SYNC_MAX_PAGES = 1000  # 防呆：券商若忽略起始序號參數，避免無限翻頁
+
 
-    - query_reply → 有舊記錄就更新，沒有就新建 OrderHistory（包含非本系統下的單）
-    - query_match → 以 network_id 去重，新成交記錄補建 TradeRecord
-    回傳同步統計 dict。
+def _network_id_key(network_id: str):
+    return (0, int(network_id), "") if network_id.isdigit() else (1, 0, network_id)
+
+
+def _next_network_id(network_id: str) -> Optional[str]:
+    if not network_id.isdigit():
+        return None
+    return str(int(network_id) + 1).zfill(len(network_id))
+
+
+def _iter_pages(fetch, actno: str, page_size: int, start: str, stats: dict, kind: str):
+    """以 network_id 為游標逐頁查詢 query_reply / query_match，直到資料取完。
+
+    起始序號為含括（inclusive），下一頁從本頁最大 network_id 開始：同一委託的多筆
+    部分成交共用 network_id，頁面切在中間時重抓該序號，再由去重鍵排除已寫入的成交。
+    整頁都是同一序號而無法前進時才跳到下一個序號。
+    """
+    cursor = start
+    for _ in range(_SYNC_MAX_PAGES):
+        t0 = time.perf_counter()
+        resp = fetch(actno, page_size, cursor, "", "", "")
+        stats["timings_ms"][f"fetch_{kind}"] = round(
+            stats["timings_ms"].get(f"fetch_{kind}", 0) + (time.perf_counter() - t0) * 1000, 2
+        )
+        if not resp or not getattr(resp, "ok", False):
+            err = getattr(resp, "error", "unknown") if resp else "no response"
+            if "查無資料" not in str(err):
+                stats[f"{kind}_error"] = err
+                logger.warning("query_%s failed: %s", kind, err)
+            return
+        data = resp.data or []
+        stats[f"{kind}_pages"] += 1
+        yield data
+
+        if len(data) < page_size:
+            return
+        ids = [getattr(d, "networkid", None) or "" for d in data]
+        last = max(ids, key=_network_id_key)
+        if not last:
+            return
+        if last == cursor:
+            last = _next_network_id(last)
+            if last is None:
+                logger.warning("query_%s page cannot advance past network_id=%s", kind, cursor)
+                return
+        cursor = last
+    logger.warning("query_%s stopped after %d pages", kind, _SYNC_MAX_PAGES)
+
+
+def _load_watermark(db, actno: str):
+    from models import SyncWatermark
+
+    return db.get(SyncWatermark, actno)
+
+
+def _sync_history(api: Unitrade, actno: str, incremental: bool = False) -> dict:
+    """向交易所查詢當日歷史委託與成交，逐頁批次 upsert 進資料庫。
+
+    - query_reply → 以一次 IN 查詢預取既有委託，記憶體內比對後更新 / 批次新建
+      OrderHistory（包含非本系統下的單）
+    - query_match → 預取既有成交去重鍵與 ordno 對應的委託，批次寫入新 TradeRecord
+      （PostgreSQL 以 INSERT ... ON CONFLICT DO NOTHING 防止與 on_match 競爭重複）
+
+    以 SYNC_PAGE_SIZE 逐頁翻到底，每頁 commit 一次，記憶體用量與當日筆數無關。
+    同步結束時把「仍在途中（未終結）委託的最小 network_id」存為該帳號的高水位；
+    incremental=True 時從高水位開始查詢 — 之後的新成交與狀態變化只會出現在在途委託
+    或新委託上。券商交易日與高水位不同時自動改為完整同步。
+    回傳同步統計 dict，timings_ms 為各階段累計耗時。
     """
     from database import SessionLocal
-    from models import OrderHistory, TradeRecord
+    from models import SyncWatermark
 
-    logger.info("Starting history sync for actno=%s", actno)
+    logger.info("Starting history sync for actno=%s incremental=%s", actno, incremental)
     db = SessionLocal()
     stats = {"reply_updated": 0, "reply_created": 0, "match_inserted": 0,
-             "reply_error": None, "match_error": None}
-    try:
-        # ── 歷史委託回報 (query_reply) ────────────────────────────
-        reply_resp = api.dtrade.query_reply(actno, 500, "", "", "", "")
-        if reply_resp and getattr(reply_resp, "ok", False):
-            for reply in (reply_resp.data or []):
-                seq = (getattr(reply, "seq", None) or "").strip()
-                if not seq:
-                    continue
+             "reply_error": None, "match_error": None,
+             "reply_pages": 0, "match_pages": 0, "start_network_id": "",
+             "timings_ms": {}}
+    timings = stats["timings_ms"]
+    started = time.perf_counter()
 
-                orderstatus = getattr(reply, "orderstatus", None)
-                ordno = getattr(reply, "orderno", None)
-                filled_raw = getattr(reply, "matchqty", None)
-                try:
-                    filled = int(filled_raw) if filled_raw else None
-                except (ValueError, TypeError):
-                    filled = None
+    def _add_timing(name: str, since: float) -> None:
+        timings[name] = round(timings.get(name, 0) + (time.perf_counter() - since) * 1000, 2)
 
-                order = (
-                    db.query(OrderHistory)
-                    .filter(OrderHistory.order_id == seq)
-                    .order_by(OrderHistory.created_at.desc())
-                    .first()
-                )
-                if order:
-                    # 更新已有記錄
-                    order.fill_status = orderstatus
-                    if ordno:
-                        order.ordno = ordno
-                    if filled is not None:
-                        order.fill_quantity = filled
-                    order.status = _orderstatus_to_db_status(orderstatus)
-                    order.updated_at = datetime.utcnow()
-                    stats["reply_updated"] += 1
-                else:
-                    # 新建記錄（非本系統下的單，例如透過其他工具下的）
-                    productid = getattr(reply, "productid", None) or "UNKNOWN"
-                    bs = getattr(reply, "bs", None) or "B"
-                    qty_raw = getattr(reply, "orderqty", None)
-                    try:
-                        qty = int(qty_raw) if qty_raw else 0
-                    except (ValueError, TypeError):
-                        qty = 0
-                    price_raw = getattr(reply, "orderprice", None)
-                    try:
-                        price = float(price_raw) if price_raw else None
-                    except (ValueError, TypeError):
-                        price = None
-
-                    new_order = OrderHistory(
-                        symbol=productid,
-                        action=bs,
-                        quantity=qty,
-                        price=price,
-                        account=getattr(reply, "investoracno", None) or actno,
-                        sub_account=getattr(reply, "subact", None) or "",
-                        order_id=seq,
-                        ordno=ordno,
-                        fill_status=orderstatus,
-                        fill_quantity=filled,
-                        status=_orderstatus_to_db_status(orderstatus),
-                        source="sync",
-                        updated_at=datetime.utcnow(),
-                        note=getattr(reply, "note", None),
-                    )
-                    db.add(new_order)
-                    stats["reply_created"] += 1
+    try:
+        start = ""
+        if incremental:
+            watermark = _load_watermark(db, actno)
+            if watermark and watermark.resume_network_id:
+                probe = api.dtrade.query_reply(actno, 1, "", "", "", "")
+                probe_data = (getattr(probe, "data", None) or []) if probe and getattr(probe, "ok", False) else []
+                trade_date = getattr(probe_data[0], "tradedate", None) if probe_data else None
+                if trade_date and trade_date == watermark.trade_date:
+                    start = watermark.resume_network_id
+        stats["start_network_id"] = start
 
+        # ── 歷史委託回報 (query_reply) ────────────────────────────
+        working_ids, max_id, trade_date = [], "", None
+        for page in _iter_pages(api.dtrade.query_reply, actno, SYNC_PAGE_SIZE, start, stats, "reply"):
+            t0 = time.perf_counter()
+            for reply in page:
+                network_id = getattr(reply, "networkid", None) or ""
+                if not network_id:
+                    continue
+                trade_date = getattr(reply, "tradedate", None) or trade_date
+                if not max_id or _network_id_key(network_id) > _network_id_key(max_id):
+                    max_id = network_id
+                if _orderstatus_to_db_status(getattr(reply, "orderstatus", None)) in ("submitted", "partial_filled"):
+                    working_ids.append(network_id)
+            _apply_replies(db, actno, page, stats)
             db.commit()
-            logger.info(
-                "History sync reply: updated=%d created=%d",
-                stats["reply_updated"], stats["reply_created"],
-            )
-        else:
-            err = getattr(reply_resp, "error", "unknown") if reply_resp else "no response"
-            stats["reply_error"] = err
-            logger.warning("query_reply failed: %s", err)
+            _add_timing("apply_reply", t0)
+        logger.info(
+            "History sync reply: updated=%d created=%d pages=%d",
+            stats["reply_updated"], stats["reply_created"], stats["reply_pages"],
+        )
 
         # ── 歷史成交回報 (query_match) ────────────────────────────
-        match_resp = api.dtrade.query_match(actno, 500, "", "", "", "")
-        if match_resp and getattr(match_resp, "ok", False):
-            for match in (match_resp.data or []):
-                orderno = getattr(match, "orderno", None)
-                network_id = getattr(match, "networkid", None)
-
-                # 以 network_id 去重
-                if network_id:
-                    exists = db.query(TradeRecord).filter(
-                        TradeRecord.network_id == network_id
-                    ).first()
-                    if exists:
-                        continue
-
-                match_price_raw = getattr(match, "matchprice", None)
-                match_qty_raw = getattr(match, "matchqty", None)
-                match_price = float(match_price_raw) if match_price_raw else None
-                match_qty = int(match_qty_raw) if match_qty_raw else None
-
-                trade = TradeRecord(
-                    network_id=network_id,
-                    orderno=orderno,
-                    account=getattr(match, "investoracno", None),
-                    sub_account=getattr(match, "subact", None),
-                    product_kind=getattr(match, "productkind", None),
-                    product_id=getattr(match, "productid", None),
-                    bs=getattr(match, "bs", None),
-                    match_price=match_price,
-                    match_qty=match_qty,
-                    match_seq=getattr(match, "matchseq", None),
-                    match_time=getattr(match, "matchtime", None),
-                    note=getattr(match, "note", None),
-                    mdate=getattr(match, "mdate", None),
-                )
-
-                # 嘗試關聯 OrderHistory（先用 ordno，找不到再用 seq）
-                if orderno:
-                    linked = db.query(OrderHistory).filter(
-                        OrderHistory.ordno == orderno
-                    ).first()
-                    if linked:
-                        trade.seq = linked.order_id
-                        linked.fill_price = match_price
-                        linked.fill_quantity = match_qty
-                        linked.status = "filled"
-                        linked.updated_at = datetime.utcnow()
-
-                db.add(trade)
-                stats["match_inserted"] += 1
-
+        for page in _iter_pages(api.dtrade.query_match, actno, SYNC_PAGE_SIZE, start, stats, "match"):
+            t0 = time.perf_counter()
+            _apply_matches(db, page, stats)
             db.commit()
-            logger.info("History sync match: inserted=%d", stats["match_inserted"])
-        else:
-            err = getattr(match_resp, "error", "unknown") if match_resp else "no response"
-            stats["match_error"] = err
-            logger.warning("query_match failed: %s", err)
+            _add_timing("apply_match", t0)
+        logger.info("History sync match: inserted=%d pages=%d", stats["match_inserted"], stats["match_pages"])
+
+        # ── 高水位：下次增量同步從最小的在途委託開始 ───────────────
+        if max_id and not stats["reply_error"] and not stats["match_error"]:
+            resume = min(working_ids, key=_network_id_key) if working_ids else max_id
+            watermark = _load_watermark(db, actno) or SyncWatermark(account=actno)
+            watermark.resume_network_id = resume
+            watermark.last_network_id = max_id
+            watermark.trade_date = trade_date
+            watermark.updated_at = datetime.utcnow()
+            db.merge(watermark)
+            db.commit()
+            stats["resume_network_id"] = resume
 
     except Exception as exc:
         logger.error("History sync error: %s", exc)
@@ -435,12 +559,204 @@ def _sync_history(api: Unitrade, actno: str) -> dict:
     finally:
         db.close()
 
+    timings["total"] = round((time.perf_counter() - started) * 1000, 2)
     return stats
 
 
-def trigger_history_sync() -> dict:
-    """手動觸發歷史同步，供 /history-sync 端點呼叫。"""
+def _apply_replies(db, actno: str, replies: list, stats: dict) -> None:
+    """批次套用委託回報：一次預取既有委託，其餘在記憶體內比對。"""
+    from models import OrderHistory
+
+    by_seq = {}
+    for reply in replies:
+        seq = (getattr(reply, "seq", None) or "").strip()
+        if seq:
+            by_seq[seq] = reply  # 同一 seq 以最後一筆（最新狀態）為準
+    if not by_seq:
+        return
+
+    # 同一 seq 可能有多筆記錄，沿用「最新一筆」的既有語意
+    existing = {}
+    for chunk in _chunked(list(by_seq)):
+        rows = (
+            db.query(OrderHistory)
+            .filter(OrderHistory.order_id.in_(chunk))
+            .order_by(OrderHistory.created_at.asc())
+            .all()
+        )
+        for row in rows:
+            existing[row.order_id] = row
+
+    now = datetime.utcnow()
+    new_orders = []
+    unknown = None
+    for seq, reply in by_seq.items():
+        orderstatus = getattr(reply, "orderstatus", None)
+        ordno = getattr(reply, "orderno", None)
+        filled = _to_int(getattr(reply, "matchqty", None))
+
+        order = existing.get(seq)
+        if order is None:
+            if unknown is None:
+                # 閘道中斷、結果未知的委託沒有 order_id，只能以委託內容認領
+                unknown = (
+                    db.query(OrderHistory)
+                    .filter(OrderHistory.status == "unknown", OrderHistory.order_id.is_(None))
+                    .order_by(OrderHistory.created_at.asc())
+                    .all()
+                )
+            order = _claim_unknown(unknown, reply, actno)
+            if order is not None:
+                order.order_id = seq
+                logger.info("History sync: unknown order reconciled record_id=%s seq=%s", order.id, seq)
+        if order:
+            # 更新已有記錄
+            order.fill_status = orderstatus
+            if ordno:
+                order.ordno = ordno
+            if filled is not None:
+                order.fill_quantity = filled
+            order.status = _orderstatus_to_db_status(orderstatus)
+            order.updated_at = now
+            stats["reply_updated"] += 1
+        else:
+            # 新建記錄（非本系統下的單，例如透過其他工具下的）
+            new_orders.append(OrderHistory(
+                symbol=getattr(reply, "productid", None) or "UNKNOWN",
+                action=getattr(reply, "bs", None) or "B",
+                quantity=_to_int(getattr(reply, "orderqty", None)) or 0,
+                price=_to_float(getattr(reply, "orderprice", None)),
+                account=getattr(reply, "investoracno", None) or actno,
+                sub_account=getattr(reply, "subact", None) or "",
+                order_id=seq,
+                ordno=ordno,
+                fill_status=orderstatus,
+                fill_quantity=filled,
+                status=_orderstatus_to_db_status(orderstatus),
+                source="sync",
+                updated_at=now,
+                note=getattr(reply, "note", None),
+            ))
+    if new_orders:
+        db.add_all(new_orders)
+        stats["reply_created"] += len(new_orders)
+    db.flush()
+
+
+def _claim_unknown(unknown: list, reply, actno: str):
+    """以帳號 / 商品 / 買賣 / 口數找出最早一筆 unknown 委託並移出候選清單。"""
+    account = getattr(reply, "investoracno", None) or actno
+    product = normalize_product(getattr(reply, "productid", None) or "")
+    bs = getattr(reply, "bs", None)
+    qty = _to_int(getattr(reply, "orderqty", None))
+    for i, order in enumerate(unknown):
+        if (
+            (order.account or actno) == account
+            and normalize_product(order.symbol or "") == product
+            and order.action == bs
+            and order.quantity == qty
+        ):
+            return unknown.pop(i)
+    return None
+
+
+def _apply_matches(db, matches: list, stats: dict) -> None:
+    """批次套用成交回報：預取去重鍵與關聯委託，批次寫入新成交後累加到委託。"""
+    from sqlalchemy import insert
+
+    from models import OrderHistory, TradeRecord
+
+    def _fill_key(network_id, match_seq, match_time) -> tuple:
+        return (network_id, match_seq or "", match_time or "")
+
+    # 預取既有成交去重鍵
+    network_ids = list({getattr(m, "networkid", None) for m in matches} - {None, ""})
+    known_keys = set()
+    for chunk in _chunked(network_ids):
+        for nid, mseq, mtime in db.query(
+            TradeRecord.network_id, TradeRecord.match_seq, TradeRecord.match_time
+        ).filter(TradeRecord.network_id.in_(chunk)):
+            known_keys.add(_fill_key(nid, mseq, mtime))
+
+    rows = []
+    for match in matches:
+        network_id = getattr(match, "networkid", None)
+        match_seq = getattr(match, "matchseq", None)
+        match_time = getattr(match, "matchtime", None)
+        if network_id:
+            key = _fill_key(network_id, match_seq, match_time)
+            if key in known_keys:
+                continue
+            known_keys.add(key)  # 同一批回應內的重複也一併略過
+        rows.append({
+            "network_id": network_id,
+            "orderno": getattr(match, "orderno", None),
+            "account": getattr(match, "investoracno", None),
+            "sub_account": getattr(match, "subact", None),
+            "product_kind": getattr(match, "productkind", None),
+            "product_id": getattr(match, "productid", None),
+            "bs": getattr(match, "bs", None),
+            "match_price": _to_float(getattr(match, "matchprice", None)),
+            "match_qty": _to_int(getattr(match, "matchqty", None)),
+            "match_seq": match_seq,
+            "match_time": match_time,
+            "note": getattr(match, "note", None),
+            "mdate": getattr(match, "mdate", None),
+            "seq": None,
+        })
+    if not rows:
+        return
+
+    # 預取 ordno 對應的委託（鎖定列，避免與 on_match 的累加互相覆蓋）
+    ordnos = list({r["orderno"] for r in rows} - {None, ""})
+    linked = {}
+    for chunk in _chunked(ordnos):
+        for order in (
+            db.query(OrderHistory)
+            .filter(OrderHistory.ordno.in_(chunk))
+            .order_by(OrderHistory.created_at.asc())
+            .with_for_update()
+        ):
+            linked[order.ordno] = order
+    for row in rows:
+        order = linked.get(row["orderno"])
+        if order is not None:
+            row["seq"] = order.order_id
+
+    # 批次寫入；PostgreSQL 以 ON CONFLICT 擋下與 on_match 並行寫入的同一筆成交，
+    # 只對實際寫入的列累加，確保不會重複計算
+    inserted = []
+    if db.bind.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+        for chunk in _chunked(rows):
+            result = db.execute(
+                pg_insert(TradeRecord)
+                .values(chunk)
+                .on_conflict_do_nothing()
+                .returning(TradeRecord.orderno, TradeRecord.match_price, TradeRecord.match_qty)
+            )
+            inserted.extend(result.all())
+    else:
+        db.execute(insert(TradeRecord), rows)
+        inserted = [(r["orderno"], r["match_price"], r["match_qty"]) for r in rows]
+
+    for orderno, match_price, match_qty in inserted:
+        order = linked.get(orderno)
+        if order is not None:
+            _apply_fill(order, match_price, match_qty)
+    stats["match_inserted"] += len(inserted)
+
+
+def trigger_history_sync(incremental: bool = False) -> dict:
+    """觸發歷史同步，供 /history-sync 端點與排程呼叫（incremental 見 _sync_history）。"""
     global _client
+    if broker_mode() == "gateway-client":
+        try:
+            return _get_gateway_client().history_sync(incremental)
+        except Exception as exc:
+            return {"status": "error", "message": str(exc)}
+
     if _client is None:
         return {"status": "error", "message": "Unitrade 尚未連線，請確認後端已成功登入"}
 
@@ -448,14 +764,25 @@ def trigger_history_sync() -> dict:
     if not actno:
         return {"status": "error", "message": "未設定 UNITRADE_ACTNO 環境變數"}
 
+    from metrics import HISTORY_SYNC_PHASE_SECONDS, HISTORY_SYNC_SECONDS
+
+    mode = "incremental" if incremental else "full"
     try:
-        stats = _sync_history(_client, actno)
+        stats = _sync_history(_client, actno, incremental=incremental)
+        for phase, ms in stats["timings_ms"].items():
+            if phase != "total":
+                HISTORY_SYNC_PHASE_SECONDS.observe(ms / 1000, phase=phase)
+        HISTORY_SYNC_SECONDS.observe(
+            stats["timings_ms"].get("total", 0) / 1000,
+            mode=mode, outcome="error" if "exception" in stats else "ok",
+        )
         if "exception" in stats:
             return {"status": "error", "message": stats["exception"]}
         msg = (
-            f"同步完成：委託 {stats['reply_updated']} 筆更新 / "
+            f"{'增量' if stats['start_network_id'] else ''}同步完成：委託 {stats['reply_updated']} 筆更新 / "
             f"{stats['reply_created']} 筆新建；"
             f"成交 {stats['match_inserted']} 筆新建"
+            f"（耗時 {stats['timings_ms'].get('total', 0)} ms）"
         )
         if stats.get("reply_error"):
             msg += f"（委託查詢錯誤：{stats['reply_error']}）"
@@ -463,4 +790,36 @@ def trigger_history_sync() -> dict:
             msg += f"（成交查詢錯誤：{stats['match_error']}）"
         return {"status": "ok", "message": msg}
     except Exception as exc:
-        return {"status": "error", "message": str(exc)}
\ No newline at end of file
+        return {"status": "error", "message": str(exc)}
+
+
+def _scheduled_sync_job(label: str, incremental: bool = False) -> None:
+    """排程觸發的歷史同步作業（同步執行，在 scheduler 執行緒中呼叫）。"""
+    logger.info("[排程同步] 觸發點: %s", label)
+    result = trigger_history_sync(incremental=incremental)
+    logger.info("[排程同步] 結果: %s", result)
+
+
+def register_history_sync_jobs(scheduler) -> None:
+    """向 APScheduler 註冊每日歷史同步排程（HTTP worker 與閘道程序共用）。
+
+    台灣期貨換日時間表（Asia/Taipei）：
+      凌晨場結束：每日 05:00 → 排程 04:50 完整同步，確保夜盤資料不遺漏
+      日盤收盤後：每日 14:00 → 排程 13:55 增量同步（從高水位開始），保存日盤完整紀錄
+    """
+    from apscheduler.triggers.cron import CronTrigger
+
+    scheduler.add_job(
+        _scheduled_sync_job,
+        CronTrigger(hour=4, minute=50, timezone="Asia/Taipei"),
+        args=["換日前(04:50)"],
+        id="sync_before_rollover",
+        replace_existing=True,
+    )
+    scheduler.add_job(
+        _scheduled_sync_job,
+        CronTrigger(hour=13, minute=55, timezone="Asia/Taipei"),
+        args=["日盤收盤後(13:55)", True],
+        id="sync_after_day_close",
+        replace_existing=True,
+    )